@@ -6,7 +6,7 @@ from helpdesk.models import Queue, Ticket, FollowUp, PreSetReply, KBCategory, Ti
     SMSTemplate, TicketNotification
 from helpdesk.models import EscalationExclusion, EmailTemplate, KBItem
 from helpdesk.models import TicketChange, Attachment, IgnoreEmail, SavedSearch
-from helpdesk.models import CustomField
+from helpdesk.models import CustomField, EmailIngestionRun, BulkActionJob
 
 
 @admin.register(Queue)
@@ -68,6 +68,20 @@ class EmailTemplateAdmin(admin.ModelAdmin):
     list_filter = ('locale', )
 
 
+@admin.register(EmailIngestionRun)
+class EmailIngestionRunAdmin(admin.ModelAdmin):
+    list_display = ('queue', 'started', 'messages', 'tickets_created', 'followups_created', 'ignored', 'failed')
+    list_filter = ('queue',)
+    date_hierarchy = 'started'
+
+
+@admin.register(BulkActionJob)
+class BulkActionJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'action', 'user', 'status', 'total', 'processed', 'changed', 'created', 'finished')
+    list_filter = ('status', 'action')
+    readonly_fields = ('total', 'processed', 'changed', 'last_ticket_id', 'created', 'started', 'finished')
+
+
 @admin.register(TicketTimeTrack)
 class TicketTimeTrackAdmin(admin.ModelAdmin):
     list_display = ('ticket', 'time', 'tracked_at', 'tracked_by')
@@ -1,15 +1,74 @@
+import django
 from django.conf import settings
 from django import forms
 from django.contrib.auth import get_user_model
+from django.db import connection
 from django.db.models import Q
 from django.forms import ModelChoiceField
 from django_filters import FilterSet, filters, OrderingFilter
 
-from helpdesk.models import Ticket, Queue
+from helpdesk.models import Ticket, Queue, CustomField, TicketCustomFieldValue, custom_field_typed_values
 from helpdesk.utils import ExtendedOrderingFilter
 
+if django.VERSION >= (1, 11):
+    from django.db.models import OuterRef, Subquery
+
 User = get_user_model()
 
+# Custom fields are filtered and sorted on as cf_<name>, with cf_<name>_min
+# and cf_<name>_max for the range of numbers, dates and times.
+CUSTOM_FIELD_PREFIX = 'cf_'
+
+CUSTOM_FIELD_FILTERS = {
+    'integer': filters.NumberFilter,
+    'decimal': filters.NumberFilter,
+    'date': filters.DateFilter,
+    'datetime': filters.DateTimeFilter,
+    'time': filters.TimeFilter,
+    'boolean': filters.BooleanFilter,
+}
+
+
+class CustomFieldOrderingFilter(ExtendedOrderingFilter):
+    """
+    Also sorts by the custom fields added with add_custom_field(), on the
+    indexed column holding their values.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.custom_fields = {}
+        super(CustomFieldOrderingFilter, self).__init__(*args, **kwargs)
+
+    def add_custom_field(self, param, field):
+        self.custom_fields[param] = field
+        self.param_map[param] = param
+        self.extra['choices'] = self.extra['choices'] + [
+            (param, field.label), ('-%s' % param, self.descending_fmt % field.label)]
+
+    def annotate_custom_field(self, qs, param, field):
+        if django.VERSION >= (1, 11):
+            values = TicketCustomFieldValue.objects.filter(ticket=OuterRef('pk'), field=field)
+            return qs.annotate(**{param: Subquery(values.values(field.value_column)[:1])})
+        # Django < 1.11 has no Subquery, the same subquery is added with extra()
+        quote_name = connection.ops.quote_name
+        sql = 'SELECT {value} FROM {values} WHERE {values}.{ticket} = {tickets}.{id} AND {values}.{field} = %s'.format(
+            value=quote_name(field.value_column),
+            values=quote_name(TicketCustomFieldValue._meta.db_table),
+            ticket=quote_name('ticket_id'),
+            field=quote_name('field_id'),
+            tickets=quote_name(Ticket._meta.db_table),
+            id=quote_name('id'),
+        )
+        return qs.extra(select={param: sql}, select_params=[field.pk])
+
+    def filter(self, qs, value):
+        for param in value or ():
+            param = param.lstrip('-')
+            field = self.custom_fields.get(param)
+            if field is not None:
+                qs = self.annotate_custom_field(qs, param, field)
+        return super(CustomFieldOrderingFilter, self).filter(qs, value)
+
 
 class TicketsFilter(FilterSet):
     no_assigned = filters.BooleanFilter(name='assigned_to', method='no_assigned_filter')
@@ -48,7 +107,7 @@ class TicketsFilter(FilterSet):
                                       'placeholder': 'Search by Keywords',
                                       'class': 'form-control'}))
 
-    order_by = ExtendedOrderingFilter(
+    order_by = CustomFieldOrderingFilter(
         fields=['id', 'queue', 'priority', 'assigned_to', 'status', 'title', 'description', 'created', 'due_date',
                 'time_tracks', 'money_tracks', 'time_open'],
         ordering_map={
@@ -59,6 +118,41 @@ class TicketsFilter(FilterSet):
 
     )
 
+    def __init__(self, *args, **kwargs):
+        super(TicketsFilter, self).__init__(*args, **kwargs)
+        self.custom_field_lookups = {}
+        for field in CustomField.objects.cached():
+            self.add_custom_field_filters(field)
+
+    def add_custom_field_filters(self, field):
+        param = CUSTOM_FIELD_PREFIX + field.name
+        filter_class = CUSTOM_FIELD_FILTERS.get(field.data_type, filters.CharFilter)
+        lookups = [(param, 'exact')]
+        if filter_class not in (filters.CharFilter, filters.BooleanFilter):
+            lookups += [(param + '_min', 'gte'), (param + '_max', 'lte')]
+        for name, lookup in lookups:
+            self.filters[name] = filter_class(name=name, label=field.label, method=self.custom_field_filter)
+            self.custom_field_lookups[name] = (field, lookup)
+        self.filters['order_by'].add_custom_field(param, field)
+
+    def custom_field_filter(self, queryset, name, value):
+        """
+        Tickets with a value of the custom field matching the lookup, found
+        through the (field, value) index of the field's typed column.
+        """
+        field, lookup = self.custom_field_lookups[name]
+        column = field.value_column
+        if column == 'value':
+            # multi-line text is not indexed
+            condition = {'value__icontains': value}
+        else:
+            value = custom_field_typed_values(field.data_type, value)[column]
+            if value is None:
+                return queryset.none()
+            condition = {'%s__%s' % (column, lookup): value}
+        values = TicketCustomFieldValue.objects.filter(field=field, **condition)
+        return queryset.filter(id__in=values.values('ticket_id'))
+
     def keywords_filter(self, queryset, name, value):
         filters = Q(title__icontains=value) | Q(description__icontains=value)
         if value.startswith('#') and value[1:].isdigit():
@@ -10,8 +10,9 @@ import re
 import traceback
 
 from captcha.fields import ReCaptchaField
-from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.core.exceptions import ValidationError
 from django.core.validators import validate_email
+from django.db.models import Q
 from django.utils.six import StringIO
 from django import forms
 from django.forms import extras
@@ -20,10 +21,10 @@ from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 
-from helpdesk.lib import send_templated_mail, safe_template_context, process_attachments
+from helpdesk.lib import send_templated_mail, safe_template_context, process_attachments, decode_ticket_query
 from helpdesk.models import (Ticket, Queue, FollowUp, Attachment, IgnoreEmail, TicketCC,
                              CustomField, TicketCustomFieldValue, TicketDependency, TicketTimeTrack, TicketMoneyTrack,
-                             TicketNotification, SavedSearch)
+                             TicketNotification, SavedSearch, UserSettings, BulkActionJob)
 from helpdesk import settings as helpdesk_settings
 
 User = get_user_model()
@@ -93,33 +94,35 @@ class EditTicketForm(CustomFieldMixin, forms.ModelForm):
         """
         super(EditTicketForm, self).__init__(*args, **kwargs)
 
-        for field in CustomField.objects.all():
-            try:
-                current_value = TicketCustomFieldValue.objects.get(ticket=self.instance, field=field)
-                initial_value = current_value.value
-            except TicketCustomFieldValue.DoesNotExist:
-                initial_value = None
+        current_values = dict(
+            (cfv.field_id, cfv) for cfv in TicketCustomFieldValue.objects.filter(ticket=self.instance)
+        ) if self.instance.pk else {}
+        self._custom_field_values = current_values
+
+        for field in CustomField.objects.cached():
+            current_value = current_values.get(field.id)
             instanceargs = {
                 'label': field.label,
                 'help_text': field.help_text,
                 'required': field.required,
-                'initial': initial_value,
+                'initial': current_value.value if current_value else None,
             }
 
             self.customfield_to_field(field, instanceargs)
 
     def save(self, *args, **kwargs):
-
+        custom_fields = CustomField.objects.by_name()
+        new_values = []
         for field, value in self.cleaned_data.items():
             if field.startswith('custom_'):
-                field_name = field.replace('custom_', '', 1)
-                customfield = CustomField.objects.get(name=field_name)
-                try:
-                    cfv = TicketCustomFieldValue.objects.get(ticket=self.instance, field=customfield)
-                except ObjectDoesNotExist:
-                    cfv = TicketCustomFieldValue(ticket=self.instance, field=customfield)
-                cfv.value = value
-                cfv.save()
+                customfield = custom_fields[field.replace('custom_', '', 1)]
+                cfv = self._custom_field_values.get(customfield.id)
+                if cfv is None:
+                    new_values.append(TicketCustomFieldValue(ticket=self.instance, field=customfield, value=value))
+                elif cfv.value != value:
+                    cfv.value = value
+                    cfv.save(update_fields=['value'])
+        TicketCustomFieldValue.objects.bulk_create(new_values)
 
         return super(EditTicketForm, self).save(*args, **kwargs)
 
@@ -185,12 +188,9 @@ class AbstractTicketForm(CustomFieldMixin, forms.Form):
     )
 
     def _add_form_custom_fields(self, staff_only_filter=None):
-        if staff_only_filter is None:
-            queryset = CustomField.objects.all()
-        else:
-            queryset = CustomField.objects.filter(staff_only=staff_only_filter)
-
-        for field in queryset:
+        for field in CustomField.objects.cached():
+            if staff_only_filter is not None and field.staff_only != staff_only_filter:
+                continue
             instanceargs = {
                 'label': field.label,
                 'help_text': field.help_text,
@@ -215,14 +215,13 @@ class AbstractTicketForm(CustomFieldMixin, forms.Form):
         return ticket, queue
 
     def _create_custom_fields(self, ticket):
-        for field, value in self.cleaned_data.items():
-            if field.startswith('custom_'):
-                field_name = field.replace('custom_', '', 1)
-                custom_field = CustomField.objects.get(name=field_name)
-                cfv = TicketCustomFieldValue(ticket=ticket,
-                                             field=custom_field,
-                                             value=value)
-                cfv.save()
+        custom_fields = CustomField.objects.by_name()
+        TicketCustomFieldValue.objects.bulk_create([
+            TicketCustomFieldValue(ticket=ticket,
+                                   field=custom_fields[field.replace('custom_', '', 1)],
+                                   value=value)
+            for field, value in self.cleaned_data.items() if field.startswith('custom_')
+        ])
 
     def _create_follow_up(self, ticket, title, user=None):
         followup = FollowUp(ticket=ticket,
@@ -261,7 +260,7 @@ class AbstractTicketForm(CustomFieldMixin, forms.Form):
 
         if ticket.assigned_to and \
                 ticket.assigned_to != user and \
-                ticket.assigned_to.usersettings_helpdesk.settings.get('email_on_ticket_assign', False) and \
+                UserSettings.objects.settings_for(ticket.assigned_to).get('email_on_ticket_assign', False) and \
                 ticket.assigned_to.email and \
                 ticket.assigned_to.email not in messages_sent_to:
             send_templated_mail(
@@ -344,7 +343,7 @@ class TicketForm(AbstractTicketForm):
         else:
             title = _('Ticket Opened')
         followup = self._create_follow_up(ticket, title=title, user=user)
-        followup.save()
+        followup.save(touch_ticket=False)
 
         files = self._attach_files_to_follow_up(followup)
         self._send_messages(ticket=ticket,
@@ -399,7 +398,7 @@ class PublicTicketForm(AbstractTicketForm):
         self._create_custom_fields(ticket)
 
         followup = self._create_follow_up(ticket, title=_('Ticket Opened Via Web'))
-        followup.save()
+        followup.save(touch_ticket=False)
 
         files = self._attach_files_to_follow_up(followup)
         self._send_messages(ticket=ticket,
@@ -598,3 +597,61 @@ class SavedSearchAddForm(forms.ModelForm):
     class Meta:
         model = SavedSearch
         fields = ['title', 'shared', 'query']
+
+
+class BulkActionJobForm(forms.ModelForm):
+    """
+    Queues a bulk action on every ticket matching either a ticket list query
+    (the urlsafe query of the list) or one of the user's saved searches.
+    """
+    assigned_to = forms.ModelChoiceField(
+        empty_label=_('-- Unassign --'),
+        widget=forms.Select(attrs={'class': 'form-control', 'id': 'id_job_assigned_to'}),
+        queryset=User.objects.filter(is_staff=True),
+        label=_('Assign To'),
+        required=False
+    )
+    saved_query = forms.ModelChoiceField(
+        widget=forms.HiddenInput(),
+        queryset=SavedSearch.objects.none(),
+        label=_('Saved Query'),
+        required=False
+    )
+
+    class Meta:
+        model = BulkActionJob
+        fields = ('action', 'assigned_to', 'query')
+        widgets = {
+            'action': forms.Select(attrs={'class': 'form-control', 'id': 'id_job_action'}),
+            'query': forms.HiddenInput(),
+        }
+
+    def __init__(self, *args, **kwargs):
+        self.user = kwargs.pop('user')
+        super(BulkActionJobForm, self).__init__(*args, **kwargs)
+        self.fields['query'].required = False
+        self.fields['saved_query'].queryset = SavedSearch.objects.filter(
+            Q(user=self.user) | Q(shared__exact=True))
+
+    def clean(self):
+        cleaned_data = super(BulkActionJobForm, self).clean()
+        saved_query = cleaned_data.get('saved_query')
+        if saved_query:
+            cleaned_data['query'] = saved_query.query
+        elif not cleaned_data.get('query'):
+            raise ValidationError(_('Choose the tickets with a query or a saved query.'))
+        try:
+            decode_ticket_query(cleaned_data['query'])
+        except ValueError:
+            raise ValidationError(_('The query cannot be read.'))
+        return cleaned_data
+
+    def save(self, commit=True):
+        job = super(BulkActionJobForm, self).save(commit=False)
+        job.user = self.user
+        job.query = self.cleaned_data['query']
+        if job.action != BulkActionJob.ACTION_ASSIGN:
+            job.assigned_to = None
+        if commit:
+            job.save()
+        return job
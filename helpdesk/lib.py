@@ -6,6 +6,7 @@ django-helpdesk - A Django powered ticket tracker for small enterprise.
 lib.py - Common functions (eg multipart e-mail)
 """
 
+import json
 import logging
 import mimetypes
 import os
@@ -22,11 +23,19 @@ except ImportError:
     from base64 import decodestring as b64decode
 
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Q
-from django.utils.encoding import smart_text
+from django.utils import timezone
+from django.utils.encoding import python_2_unicode_compatible, smart_text
 from django.utils.safestring import mark_safe
+from django.utils.translation import ugettext as _
 
-from helpdesk.models import Attachment, EmailTemplate, SMSTemplate
+from helpdesk import settings as helpdesk_settings
+from helpdesk.filters import TicketsFilter
+from helpdesk.models import (
+    Attachment, BulkActionJob, EmailTemplate, FollowUp, Queue, SMSTemplate, Ticket, get_site_base_url,
+)
+from helpdesk.utils import to_query_dict
 
 logger = logging.getLogger('helpdesk')
 
@@ -64,15 +73,23 @@ def send_templated_mail(template_name,
         along with the File objects to be read. files can be blank.
 
     """
-    from django.core.mail import EmailMultiAlternatives
-    from django.template import engines
-    from_string = engines['django'].from_string
+    msg = build_templated_mail(template_name, context, recipients, sender=sender, bcc=bcc, files=files)
+    if msg is None:
+        return  # just ignore if template doesn't exist
+    return msg.send(fail_silently)
 
-    from helpdesk.models import EmailTemplate
-    from helpdesk.settings import HELPDESK_EMAIL_SUBJECT_TEMPLATE, \
-        HELPDESK_EMAIL_FALLBACK_LOCALE
 
-    locale = context['queue'].get('locale') or HELPDESK_EMAIL_FALLBACK_LOCALE
+def get_email_template(template_name, locale, templates=None):
+    """
+    Return the EmailTemplate for template_name in the given locale, falling
+    back to the template without a locale, or None if neither exists.
+
+    templates is an optional dict used to remember the templates already
+    looked up, eg while sending a batch of e-mails.
+    """
+    key = (template_name.lower(), locale)
+    if templates is not None and key in templates:
+        return templates[key]
 
     try:
         t = EmailTemplate.objects.get(template_name__iexact=template_name, locale=locale)
@@ -80,8 +97,38 @@ def send_templated_mail(template_name,
         try:
             t = EmailTemplate.objects.get(template_name__iexact=template_name, locale__isnull=True)
         except EmailTemplate.DoesNotExist:
-            logger.warning('template "%s" does not exist, no mail sent', template_name)
-            return  # just ignore if template doesn't exist
+            t = None
+
+    if templates is not None:
+        templates[key] = t
+    return t
+
+
+def build_templated_mail(template_name,
+                         context,
+                         recipients,
+                         sender=None,
+                         bcc=None,
+                         files=None,
+                         templates=None):
+    """
+    Render an e-mail template into an EmailMultiAlternatives message without
+    sending it; see send_templated_mail() for the arguments. Returns None if
+    the template does not exist.
+    """
+    from django.core.mail import EmailMultiAlternatives
+    from django.template import engines
+    from_string = engines['django'].from_string
+
+    from helpdesk.settings import HELPDESK_EMAIL_SUBJECT_TEMPLATE, \
+        HELPDESK_EMAIL_FALLBACK_LOCALE
+
+    locale = context['queue'].get('locale') or HELPDESK_EMAIL_FALLBACK_LOCALE
+
+    t = get_email_template(template_name, locale, templates)
+    if t is None:
+        logger.warning('template "%s" does not exist, no mail sent', template_name)
+        return None
 
     subject_part = from_string(
         HELPDESK_EMAIL_SUBJECT_TEMPLATE % {
@@ -121,7 +168,58 @@ def send_templated_mail(template_name,
         for filename, filefield in files:
             msg.attach_file(filefield.path)
 
-    return msg.send(fail_silently)
+    return msg
+
+
+class MailBatch(object):
+    """
+    Collects templated e-mails and sends them over a single mail connection,
+    looking each template up only once. Use it as a context manager; queued
+    messages are sent every `size` messages and when the block exits:
+
+        with MailBatch(fail_silently=True) as batch:
+            for ticket in tickets:
+                batch.add('escalated_owner', context, recipients=...)
+    """
+
+    def __init__(self, fail_silently=False, size=500):
+        self.fail_silently = fail_silently
+        self.size = size
+        self.messages = []
+        self.templates = {}
+        self.connection = None
+        self.sent = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def add(self, template_name, context, recipients, sender=None, bcc=None, files=None):
+        msg = build_templated_mail(template_name, context, recipients, sender=sender, bcc=bcc,
+                                   files=files, templates=self.templates)
+        if msg is not None:
+            self.messages.append(msg)
+            if len(self.messages) >= self.size:
+                self.flush()
+
+    def flush(self):
+        from django.core.mail import get_connection
+
+        if not self.messages:
+            return
+        if self.connection is None:
+            self.connection = get_connection(fail_silently=self.fail_silently)
+            self.connection.open()
+        self.sent += self.connection.send_messages(self.messages) or 0
+        self.messages = []
 
 
 def send_templated_sms(template_name, context, recipients, sender=None, fail_silently=False):
@@ -211,7 +309,39 @@ def apply_query(queryset, params):
     return queryset
 
 
-def safe_template_context(ticket):
+@python_2_unicode_compatible
+class LazyContextValue(object):
+    """
+    A template context value which is only worked out the first time a
+    template uses it, and then remembered for every later render. Django
+    templates call callable context values, so {{ ticket.get_status }}
+    renders the value itself.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.value = None
+
+    def __call__(self):
+        if self.func is not None:
+            self.value = '%s' % self.func()
+            self.func = None
+        return self.value
+
+    def __str__(self):
+        return self()
+
+
+# Ticket fields that safe_template_context() depends on; when any of them
+# changes, a memoized context is built again.
+TEMPLATE_CONTEXT_STATE_FIELDS = (
+    'id', 'title', 'created', 'modified', 'submitter_email', 'status',
+    'on_hold', 'description', 'resolution', 'priority', 'last_escalation',
+    'queue_id', 'assigned_to_id', 'open_dependency_count',
+)
+
+
+def safe_template_context(ticket, base_url=None):
     """
     Return a dictionary that can be used as a template context to render
     comments and other details with ticket or queue parameters. Note that
@@ -224,8 +354,30 @@ def safe_template_context(ticket):
 
     The downside to this is that if we make changes to the model, we will also
     have to update this code. Perhaps we can find a better way in the future.
+
+    base_url is used to build the ticket_url and staff_url links, and
+    defaults to the URL of the current Site.
+
+    The context is memoized on the ticket, so every e-mail and SMS sent for
+    the same event shares one context as long as the ticket does not change.
+    Callers get their own copy of the outer dictionary and may add keys to
+    it, but must not change the nested 'ticket' and 'queue' dictionaries.
     """
+    base_url = base_url or get_site_base_url()
+    state = (base_url,) + tuple(getattr(ticket, field) for field in TEMPLATE_CONTEXT_STATE_FIELDS)
+    memo = ticket.__dict__.get('_safe_template_context')
+    if memo is None or memo[0] != state:
+        memo = (state, build_template_context(ticket, base_url))
+        ticket._safe_template_context = memo
+    return dict(memo[1])
 
+
+def build_template_context(ticket, base_url):
+    """
+    Build the context returned by safe_template_context(). The ticket status
+    (which checks the ticket's dependencies) and the name of its owner are
+    only looked up if a template uses them.
+    """
     context = {
         'queue': {},
         'ticket': {}
@@ -243,7 +395,6 @@ def safe_template_context(ticket):
                   'status', 'get_status_display', 'on_hold', 'description',
                   'resolution', 'priority', 'get_priority_display',
                   'last_escalation', 'ticket', 'ticket_for_url',
-                  'get_status', 'ticket_url', 'staff_url', '_get_assigned_to'
                   ):
         attr = getattr(ticket, field, None)
         if callable(attr):
@@ -251,6 +402,11 @@ def safe_template_context(ticket):
         else:
             context['ticket'][field] = attr
 
+    context['ticket']['get_status'] = LazyContextValue(lambda: ticket.get_status)
+    context['ticket']['_get_assigned_to'] = LazyContextValue(ticket._get_assigned_to)
+    context['ticket']['ticket_url'] = ticket.get_ticket_url(base_url)
+    context['ticket']['staff_url'] = ticket.get_staff_url(base_url)
+
     context['ticket']['queue'] = context['queue']
     context['ticket']['assigned_to'] = context['ticket']['_get_assigned_to']
 
@@ -263,18 +419,13 @@ def text_is_spam(text, request):
     # This will return 'True' is the given text is deemed to be spam, or
     # False if it is not spam. If it cannot be checked for some reason, we
     # assume it isn't spam.
-    from django.contrib.sites.models import Site
     try:
         from helpdesk.akismet import Akismet
     except:
         return False
-    try:
-        site = Site.objects.get_current()
-    except:
-        site = Site(domain='configure-django-sites.com')
 
     ak = Akismet(
-        blog_url='http://%s/' % site.domain,
+        blog_url='%s/' % get_site_base_url(),
         agent='django-helpdesk',
     )
 
@@ -324,3 +475,184 @@ def process_attachments(followup, attached_files):
                 attachments.append([filename, att.file])
 
     return attachments
+
+
+def bulk_update_tickets(tickets, user, title, public=True, new_status=None, **changes):
+    """
+    Apply `changes` (eg assigned_to=user) to every ticket of the queryset
+    with a single UPDATE, and record them with one bulk-created FollowUp per
+    ticket, titled `title` and made by `user`. This leaves the same trail as
+    saving each ticket and its follow-up in turn. With new_status, the
+    tickets' status is changed too.
+
+    Returns the list of tickets which were changed, updated in memory to
+    match the database, so that notifications can be sent afterwards.
+    """
+    now = timezone.now()
+    changes['modified'] = now
+    if new_status is not None:
+        changes['status'] = new_status
+        changes['modified_status'] = now
+
+    with transaction.atomic():
+        tickets = list(tickets.select_related('queue', 'assigned_to'))
+        if not tickets:
+            return tickets
+
+        Ticket.objects.filter(pk__in=[t.id for t in tickets]).update(**changes)
+        if new_status is not None:
+            Ticket.objects.refresh_dependents([t.id for t in tickets])
+        FollowUp.objects.bulk_create([FollowUp(
+            ticket_id=t.id,
+            date=now,
+            title=title,
+            public=public,
+            user=user,
+            new_status=new_status,
+        ) for t in tickets])
+
+    for t in tickets:
+        for field, value in changes.items():
+            setattr(t, field, value)
+        t._loaded_status = t.status
+    return tickets
+
+
+def queue_closed_mail(mails, ticket, closed_by):
+    """
+    Queue the e-mails telling the submitter, CCs, owner and queue CC that
+    the ticket was closed on a MailBatch. The owner is not told if they
+    closed the ticket themselves.
+    """
+    context = safe_template_context(ticket)
+    context.update(resolution=ticket.resolution)
+    sender = ticket.queue.from_address
+
+    messages_sent_to = []
+
+    if ticket.submitter_email:
+        mails.add('closed_submitter', context, recipients=ticket.submitter_email, sender=sender)
+        messages_sent_to.append(ticket.submitter_email)
+
+    for cc in ticket.ticketcc_set.all():
+        if cc.email_address not in messages_sent_to:
+            mails.add('closed_submitter', context, recipients=cc.email_address, sender=sender)
+            messages_sent_to.append(cc.email_address)
+
+    if ticket.assigned_to and \
+            closed_by != ticket.assigned_to and \
+            ticket.assigned_to.email and \
+            ticket.assigned_to.email not in messages_sent_to:
+        mails.add('closed_owner', context, recipients=ticket.assigned_to.email, sender=sender)
+        messages_sent_to.append(ticket.assigned_to.email)
+
+    if ticket.queue.updated_ticket_cc and \
+            ticket.queue.updated_ticket_cc not in messages_sent_to:
+        mails.add('closed_cc', context, recipients=ticket.queue.updated_ticket_cc, sender=sender)
+
+
+def decode_ticket_query(query):
+    """
+    Decode the ticket list filters of a saved search or bulk action job into
+    a QueryDict. Raises ValueError if the query cannot be decoded.
+    """
+    query = str(query)
+    # queries rendered from a bytes object under Python 3 have its repr
+    if query.startswith("b'") and query.endswith("'"):
+        query = query[2:-1]
+    data = json.loads(b64decode(query).decode())
+    if not isinstance(data, dict):
+        raise ValueError('Not a ticket list query')
+    return to_query_dict(data)
+
+
+def bulk_job_tickets(job):
+    """
+    The tickets matching the ticket list filters saved on a BulkActionJob,
+    limited to the queues of the user who queued it.
+    """
+    # unlike the ticket list, a query which cannot be decoded is an error
+    # rather than no filter at all
+    data = decode_ticket_query(job.query)
+    # the job runs through the tickets by id, whatever the list was sorted by
+    for p in ('order_by', 'page', 'page_size'):
+        data.pop(p, None)
+    tickets = Ticket.objects.filter(Queue.objects.user_filter(job.user))
+    return TicketsFilter(data, queryset=tickets).qs.order_by('id')
+
+
+def run_bulk_job(job, chunk_size=None):
+    """
+    Apply the action of a BulkActionJob to its tickets, chunk_size tickets
+    (HELPDESK_BULK_JOB_CHUNK_SIZE by default) per transaction. The progress
+    of the job is saved along with each chunk, so a job which was
+    interrupted carries on after the last chunk done. A worker whose job was
+    claimed again by another one, eg because a chunk took longer than
+    HELPDESK_BULK_JOB_STALE_TIMEOUT, rolls back its chunk and stops.
+    """
+    chunk_size = chunk_size or helpdesk_settings.HELPDESK_BULK_JOB_CHUNK_SIZE
+    tickets = bulk_job_tickets(job)
+    if job.started is None:
+        job.started = timezone.now()
+        job.total = tickets.count()
+    job.status = BulkActionJob.RUNNING_STATUS
+    if not job.save_progress('status', 'started', 'total'):
+        logger.warning('Bulk action job %d was claimed by another worker', job.pk)
+        job.refresh_from_db()
+        return job
+
+    if job.action == BulkActionJob.ACTION_ASSIGN:
+        if job.assigned_to:
+            title = _('Assigned to [{}] in bulk update').format(job.assigned_to.get_username())
+        else:
+            title = _('Unassigned in bulk update')
+
+    while True:
+        ids = list(tickets.filter(id__gt=job.last_ticket_id).values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            break
+        lost = False
+        chunk = Ticket.objects.filter(id__in=ids)
+        closed = []
+        with transaction.atomic():
+            if job.action == BulkActionJob.ACTION_ASSIGN:
+                if job.assigned_to:
+                    chunk = chunk.exclude(assigned_to=job.assigned_to)
+                else:
+                    chunk = chunk.filter(assigned_to__isnull=False)
+                changed = len(bulk_update_tickets(chunk, job.user, title, assigned_to=job.assigned_to))
+            elif job.action == BulkActionJob.ACTION_DELETE:
+                deleted, deleted_per_model = chunk.delete()
+                changed = deleted_per_model.get(Ticket._meta.label, 0)
+            else:
+                public = job.action == BulkActionJob.ACTION_CLOSE_PUBLIC
+                chunk = chunk.exclude(status=Ticket.CLOSED_STATUS)
+                if public:
+                    chunk = chunk.prefetch_related('ticketcc_set__user')
+                closed = bulk_update_tickets(chunk, job.user, _('Closed in bulk update'),
+                                             public=public, new_status=Ticket.CLOSED_STATUS)
+                changed = len(closed)
+
+            job.processed += len(ids)
+            job.changed += changed
+            job.last_ticket_id = ids[-1]
+            if not job.save_progress('processed', 'changed', 'last_ticket_id'):
+                transaction.set_rollback(True)
+                lost = True
+
+        if lost:
+            logger.warning('Bulk action job %d was claimed by another worker', job.pk)
+            job.refresh_from_db()
+            return job
+
+        if job.action == BulkActionJob.ACTION_CLOSE_PUBLIC:
+            with MailBatch(fail_silently=True) as mails:
+                for ticket in closed:
+                    queue_closed_mail(mails, ticket, job.user)
+
+    job.status = BulkActionJob.DONE_STATUS
+    job.finished = timezone.now()
+    if not job.save_progress('status', 'finished'):
+        logger.warning('Bulk action job %d was claimed by another worker', job.pk)
+        job.refresh_from_db()
+    return job
@@ -12,7 +12,6 @@ from __future__ import print_function
 
 from datetime import timedelta, date
 import getopt
-from optparse import make_option
 import sys
 
 from django.core.management.base import BaseCommand, CommandError
@@ -22,28 +21,24 @@ from helpdesk.models import EscalationExclusion, Queue
 
 class Command(BaseCommand):
 
-    def __init__(self):
-        BaseCommand.__init__(self)
-
-        self.option_list += (
-            make_option(
-                '--days', '-d',
-                help='Days of week (monday, tuesday, etc)'),
-            make_option(
-                '--occurrences', '-o',
-                type='int',
-                default=1,
-                help='Occurrences: How many weeks ahead to exclude this day'),
-            make_option(
-                '--queues', '-q',
-                help='Queues to include (default: all). Use queue slugs'),
-            make_option(
-                '--escalate-verbosely', '-x',
-                action='store_true',
-                default=False,
-                dest='escalate-verbosely',
-                help='Display a list of dates excluded'),
-        )
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', '-d',
+            help='Days of week (monday, tuesday, etc)')
+        parser.add_argument(
+            '--occurrences', '-o',
+            type=int,
+            default=1,
+            help='Occurrences: How many weeks ahead to exclude this day')
+        parser.add_argument(
+            '--queues', '-q',
+            help='Queues to include (default: all). Use queue slugs')
+        parser.add_argument(
+            '--escalate-verbosely', '-x',
+            action='store_true',
+            default=False,
+            dest='escalate-verbosely',
+            help='Display a list of dates excluded')
 
     def handle(self, *args, **options):
         days = options['days']
@@ -84,23 +79,32 @@ day_names = {
 
 def create_exclusions(days, occurrences, verbose, queues):
     days = days.split(',')
+    today = date.today()
+    # dates which already have an exclusion, loaded once for the whole
+    # period rather than checked one date at a time
+    existing = set(EscalationExclusion.objects.filter(
+        date__gte=today, date__lt=today + timedelta(weeks=occurrences),
+    ).values_list('date', flat=True))
+
     for day in days:
         day_name = day
         day = day_names[day]
-        workdate = date.today()
+        workdate = today
         i = 0
         while i < occurrences:
             if day == workdate.weekday():
-                if EscalationExclusion.objects.filter(date=workdate).count() == 0:
+                if workdate not in existing:
                     esc = EscalationExclusion(name='Auto Exclusion for %s' % day_name, date=workdate)
                     esc.save()
+                    existing.add(workdate)
 
                     if verbose:
                         print("Created exclusion for %s %s" % (day_name, workdate))
 
-                    for q in queues:
-                        esc.queues.add(q)
-                        if verbose:
+                    if queues:
+                        esc.queues.add(*queues)
+                    if verbose:
+                        for q in queues:
                             print("  - for queue %s" % q)
 
                 i += 1
@@ -11,11 +11,12 @@ from __future__ import print_function
 
 from datetime import timedelta, date
 import getopt
-from optparse import make_option
+import re
 import sys
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db.models import Q
+from django.db import connection, transaction
+from django.db.models import F, Q
 from django.utils.translation import ugettext as _
 
 try:
@@ -24,29 +25,39 @@ except ImportError:
     from datetime import datetime as timezone
 
 from helpdesk.models import Queue, Ticket, FollowUp, EscalationExclusion, TicketChange
-from helpdesk.lib import send_templated_mail, safe_template_context
+from helpdesk.lib import MailBatch, safe_template_context
+
+# number of tickets escalated per UPDATE / bulk_create statement
+CHUNK_SIZE = 500
 
 
 class Command(BaseCommand):
 
-    def __init__(self):
-        BaseCommand.__init__(self)
-
-        self.option_list += (
-            make_option(
-                '--queues',
-                help='Queues to include (default: all). Use queue slugs'),
-            make_option(
-                '--verboseescalation',
-                action='store_true',
-                default=False,
-                help='Display a list of dates excluded'),
-        )
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--queues',
+            help='Queues to include (default: all). Use queue slugs')
+        parser.add_argument(
+            '--verboseescalation',
+            action='store_true',
+            default=False,
+            help='Display a list of dates excluded')
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            default=False,
+            dest='dry_run',
+            help='Only print how many tickets would be escalated in each queue')
+        parser.add_argument(
+            '--shard',
+            help='Only escalate tickets of shard N out of M (written N/M, '
+                 'e.g. 1/4), to split a run across several processes')
 
     def handle(self, *args, **options):
         verbose = False
         queue_slugs = None
         queues = []
+        shard = None
 
         if options['verboseescalation']:
             verbose = True
@@ -62,124 +73,235 @@ class Command(BaseCommand):
                     raise CommandError("Queue %s does not exist." % queue)
                 queues.append(queue)
 
-        escalate_tickets(queues=queues, verbose=verbose)
-
-
-def escalate_tickets(queues, verbose):
-    """ Only include queues with escalation configured """
+        if options['shard']:
+            try:
+                shard = parse_shard(options['shard'])
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        counts = escalate_tickets(queues=queues, verbose=verbose,
+                                  dry_run=options['dry_run'], shard=shard)
+
+        if options['dry_run']:
+            for q, count in counts:
+                self.stdout.write("%s: %d tickets would be escalated" % (q.slug, count))
+
+
+def parse_shard(value):
+    """
+    Parse a shard written as N/M into a (remainder, modulus) pair: shard N of
+    M covers the tickets whose id leaves a remainder of N - 1 when divided by
+    M, so running shards 1/M to M/M covers every ticket exactly once.
+    """
+    match = re.match(r'^(\d+)/(\d+)$', value.strip())
+    if not match:
+        raise ValueError("Shard %s should be written as N/M, e.g. 1/4" % value)
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        raise ValueError("Shard %s should have 1 <= N <= M" % value)
+    return index - 1, count
+
+
+def eligible_tickets(q, req_last_escl_date, shard=None):
+    """
+    Return the tickets of a queue which are due for escalation: open, not on
+    hold, not already at the highest priority, and not escalated (or, if
+    never escalated, created) since req_last_escl_date.
+    """
+    tickets = Ticket.objects.filter(
+        queue=q,
+    ).filter(
+        Q(status=Ticket.OPEN_STATUS) |
+        Q(status=Ticket.REOPENED_STATUS)
+    ).exclude(
+        priority=1
+    ).filter(
+        Q(on_hold__isnull=True) |
+        Q(on_hold=False)
+    ).filter(
+        Q(last_escalation__lte=req_last_escl_date) |
+        Q(last_escalation__isnull=True, created__lte=req_last_escl_date)
+    )
+    if shard is not None:
+        remainder, modulus = shard
+        tickets = tickets.annotate(id_shard=F('id') % modulus).filter(id_shard=remainder)
+    return tickets
+
+
+def escalate_tickets(queues, verbose, dry_run=False, shard=None):
+    """
+    Escalate the tickets of every queue with escalation configured (or of
+    the queues listed by slug). Returns a list of (queue, number of tickets)
+    pairs; with dry_run, the tickets are only counted and nothing is written.
+    """
     queryset = Queue.objects.filter(escalate_days__isnull=False).exclude(escalate_days=0)
     if queues:
         queryset = queryset.filter(slug__in=queues)
+    queryset = list(queryset)
+    counts = []
+    if not queryset:
+        return counts
+
+    today = date.today()
+    # pick up exclusions added by other processes since the previous run
+    EscalationExclusion.objects.clear_calendar_cache()
+    calendar = EscalationExclusion.objects.calendar()
 
-    for q in queryset:
-        last = date.today() - timedelta(days=q.escalate_days)
-        today = date.today()
-        workdate = last
-
-        days = 0
-
-        while workdate < today:
-            if EscalationExclusion.objects.filter(date=workdate).count() == 0:
-                days += 1
-            workdate = workdate + timedelta(days=1)
-
-        req_last_escl_date = date.today() - timedelta(days=days)
-
-        if verbose:
-            print("Processing: %s" % q)
-
-        for t in q.ticket_set.filter(
-            Q(status=Ticket.OPEN_STATUS) |
-                Q(status=Ticket.REOPENED_STATUS)
-        ).exclude(
-            priority=1
-        ).filter(
-            Q(on_hold__isnull=True) |
-                Q(on_hold=False)
-        ).filter(
-            Q(last_escalation__lte=req_last_escl_date) |
-                Q(last_escalation__isnull=True, created__lte=req_last_escl_date)
-        ):
-
-            t.last_escalation = timezone.now()
-            t.priority -= 1
-            t.save()
-
-            context = safe_template_context(t)
-
-            if t.submitter_email:
-                send_templated_mail(
-                    'escalated_submitter',
-                    context,
-                    recipients=t.submitter_email,
-                    sender=t.queue.from_address,
-                    fail_silently=True,
-                )
-
-            if t.queue.updated_ticket_cc:
-                send_templated_mail(
-                    'escalated_cc',
-                    context,
-                    recipients=t.queue.updated_ticket_cc,
-                    sender=t.queue.from_address,
-                    fail_silently=True,
-                )
-
-            if t.assigned_to:
-                send_templated_mail(
-                    'escalated_owner',
-                    context,
-                    recipients=t.assigned_to.email,
-                    sender=t.queue.from_address,
-                    fail_silently=True,
-                )
+    with MailBatch(fail_silently=True) as mails:
+        for q in queryset:
+            last = today - timedelta(days=q.escalate_days)
+            days = calendar.business_days_between(last, today, q)
+
+            req_last_escl_date = today - timedelta(days=days)
 
             if verbose:
-                print("  - Esclating %s from %s>%s" % (
-                    t.ticket,
-                    t.priority + 1,
-                    t.priority
-                )
-                )
-
-            f = FollowUp(
-                ticket=t,
-                title='Ticket Escalated',
-                date=timezone.now(),
-                public=True,
-                comment=_('Ticket escalated after %s days' % q.escalate_days),
-            )
-            f.save()
-
-            tc = TicketChange(
-                followup=f,
-                field=_('Priority'),
-                old_value=t.priority + 1,
-                new_value=t.priority,
-            )
-            tc.save()
+                print("Processing: %s" % q)
+
+            eligible = eligible_tickets(q, req_last_escl_date, shard)
+            if dry_run:
+                counts.append((q, eligible.count()))
+                continue
+
+            tickets = list(eligible.select_related('queue', 'assigned_to'))
+            count = 0
+            for i in range(0, len(tickets), CHUNK_SIZE):
+                escalated = escalate_chunk(q, tickets[i:i + CHUNK_SIZE], eligible)
+                count += len(escalated)
+
+                for t in escalated:
+                    if verbose:
+                        print("  - Esclating %s from %s>%s" % (
+                            t.ticket,
+                            t.priority + 1,
+                            t.priority
+                        )
+                        )
+                    queue_escalation_mail(mails, t)
+            counts.append((q, count))
+
+    return counts
+
+
+def escalate_chunk(q, tickets, eligible):
+    """
+    Lower the priority of a chunk of tickets with one UPDATE, and record the
+    escalation with bulk-created follow-ups and ticket changes. Returns the
+    tickets which were escalated, updated in memory to match the database.
+
+    The rows are locked and checked against the eligible queryset again
+    first, so a ticket which a concurrent run has locked or has already
+    escalated is left alone rather than escalated twice.
+    """
+    now = timezone.now()
+    comment = _('Ticket escalated after %s days' % q.escalate_days)
+
+    with transaction.atomic():
+        # the feature flag is missing before Django 1.11, which has no SKIP LOCKED
+        if getattr(connection.features, 'has_select_for_update_skip_locked', False):
+            locked = eligible.select_for_update(skip_locked=True)
+        else:
+            locked = eligible.select_for_update()
+        ids = set(locked.filter(pk__in=[t.id for t in tickets]).values_list('id', flat=True))
+        tickets = [t for t in tickets if t.id in ids]
+        if not tickets:
+            return tickets
+
+        Ticket.objects.filter(pk__in=ids).update(
+            priority=F('priority') - 1,
+            last_escalation=now,
+            modified=now,
+        )
+
+        followups = [FollowUp(
+            ticket_id=t.id,
+            title='Ticket Escalated',
+            date=now,
+            public=True,
+            comment=comment,
+        ) for t in tickets]
+        FollowUp.objects.bulk_create(followups)
+        if any(f.pk is None for f in followups):
+            # the database backend does not return the ids of bulk inserts
+            followup_ids = dict(FollowUp.objects.filter(
+                ticket_id__in=ids, date=now, title='Ticket Escalated',
+            ).values_list('ticket_id', 'id'))
+            for f in followups:
+                f.pk = followup_ids[f.ticket_id]
+
+        TicketChange.objects.bulk_create([TicketChange(
+            followup_id=f.pk,
+            field=_('Priority'),
+            old_value=t.priority,
+            new_value=t.priority - 1,
+        ) for t, f in zip(tickets, followups)])
+
+    for t in tickets:
+        t.priority -= 1
+        t.last_escalation = now
+        t.modified = now
+    return tickets
+
+
+def queue_escalation_mail(mails, t):
+    context = safe_template_context(t)
+
+    if t.submitter_email:
+        mails.add(
+            'escalated_submitter',
+            context,
+            recipients=t.submitter_email,
+            sender=t.queue.from_address,
+        )
+
+    if t.queue.updated_ticket_cc:
+        mails.add(
+            'escalated_cc',
+            context,
+            recipients=t.queue.updated_ticket_cc,
+            sender=t.queue.from_address,
+        )
+
+    if t.assigned_to:
+        mails.add(
+            'escalated_owner',
+            context,
+            recipients=t.assigned_to.email,
+            sender=t.queue.from_address,
+        )
 
 
 def usage():
     print("Options:")
     print(" --queues: Queues to include (default: all). Use queue slugs")
     print(" --verboseescalation: Display a list of dates excluded")
+    print(" --dry-run: Only print how many tickets would be escalated in each queue")
+    print(" --shard N/M: Only escalate tickets of shard N out of M")
 
 
 if __name__ == '__main__':
     try:
-        opts, args = getopt.getopt(sys.argv[1:], ['queues=', 'verboseescalation'])
+        opts, args = getopt.getopt(sys.argv[1:], '', ['queues=', 'verboseescalation', 'dry-run', 'shard='])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
 
     verbose = False
+    dry_run = False
+    shard = None
     queue_slugs = None
     queues = []
 
     for o, a in opts:
         if o == '--verboseescalation':
             verbose = True
+        if o == '--dry-run':
+            dry_run = True
+        if o == '--shard':
+            try:
+                shard = parse_shard(a)
+            except ValueError as e:
+                print(e)
+                sys.exit(2)
         if o == '--queues':
             queue_slugs = a
 
@@ -193,4 +315,6 @@ if __name__ == '__main__':
                 sys.exit(2)
             queues.append(queue)
 
-    escalate_tickets(queues=queues, verbose=verbose)
+    for q, count in escalate_tickets(queues=queues, verbose=verbose, dry_run=dry_run, shard=shard):
+        if dry_run:
+            print("%s: %d tickets would be escalated" % (q.slug, count))
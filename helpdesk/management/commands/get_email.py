@@ -12,36 +12,43 @@ scripts/get_email.py - Designed to be run from cron, this script checks the
 """
 from __future__ import unicode_literals
 
+from contextlib import closing, contextmanager
 from datetime import timedelta
 import email
 import imaplib
+import json
 import mimetypes
-from os import listdir, unlink
-from os.path import isfile, join
+import mmap
+import multiprocessing
+from os import listdir, makedirs, rename, unlink, utime
+from os.path import getmtime, isdir, isfile, join
 import poplib
 import re
 import socket
 import base64
 import binascii
-from time import ctime
+from time import ctime, time
 
 from email_reply_parser import EmailReplyParser
 
 from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.management.base import BaseCommand
-from django.db.models import Q
+from django.db import connections
 from django.utils.translation import ugettext as _
 from django.utils import encoding, six, timezone
 
 from helpdesk import settings
 from helpdesk.lib import send_templated_mail, safe_template_context, process_attachments
-from helpdesk.models import Queue, Ticket, TicketCC, FollowUp, IgnoreEmail
+from helpdesk.models import Queue, Ticket, TicketCC, FollowUp, IgnoreEmail, EmailIngestionRun
 from django.contrib.auth.models import User
 
 import logging
 
 
+LOCAL_PROCESSING_DIR = 'processing'
+LOCAL_QUARANTINE_DIR = 'quarantine'
+
 STRIPPED_SUBJECT_STRINGS = [
     "Re: ",
     "Fw: ",
@@ -74,13 +81,18 @@ class Command(BaseCommand):
 
 
 def process_email(quiet=False):
+    # pick up any changes made to the ignore list since the previous run
+    IgnoreEmail.objects.clear_matcher_cache()
+
     for q in Queue.objects.filter(
             email_box_type__isnull=False,
             allow_email_submission=True):
 
         logger = logging.getLogger('django.helpdesk.queue.' + q.slug)
         if not q.logging_type or q.logging_type == 'none':
-            logging.disable(logging.CRITICAL)  # disable all messages
+            # disable all messages for this queue, without silencing the
+            # queues processed after it
+            logger.setLevel(logging.CRITICAL + 1)
         elif q.logging_type == 'info':
             logger.setLevel(logging.INFO)
         elif q.logging_type == 'warn':
@@ -97,18 +109,99 @@ def process_email(quiet=False):
         handler = logging.FileHandler(join(logdir, q.slug + '_get_email.log'))
         logger.addHandler(handler)
 
-        if not q.email_box_last_check:
-            q.email_box_last_check = timezone.now() - timedelta(minutes=30)
+        try:
+            if not q.email_box_last_check:
+                q.email_box_last_check = timezone.now() - timedelta(minutes=30)
+
+            queue_time_delta = timedelta(minutes=q.email_box_interval or 0)
 
-        queue_time_delta = timedelta(minutes=q.email_box_interval or 0)
+            if (q.email_box_last_check + queue_time_delta) < timezone.now():
+                stats = IngestionStats()
+                started = timezone.now()
+                try:
+                    process_queue(q, logger=logger, stats=stats)
+                except Exception as e:
+                    stats.error = encoding.force_text(repr(e), errors='replace')
+                    raise
+                finally:
+                    record_ingestion_run(q, started, stats, logger)
+                q.email_box_last_check = timezone.now()
+                q.save()
+        finally:
+            # long-lived processes call process_email repeatedly, so don't
+            # leave a handler (and its open log file) behind for every run
+            logger.removeHandler(handler)
+            handler.close()
+
+
+class IngestionStats(object):
+    """
+    Counters and phase timings collected while processing the mailbox of a
+    queue. Network time covers the mail server (or local mailbox) and the
+    notification e-mails sent for each message.
+    """
+    COUNTERS = ('messages', 'bytes_received', 'tickets_created',
+                'followups_created', 'ignored', 'failed')
+    PHASES = ('network', 'parse', 'db')
+
+    def __init__(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.error = ''
+
+    @contextmanager
+    def timer(self, phase):
+        started = time()
+        try:
+            yield
+        finally:
+            self.seconds[phase] += time() - started
+
+    def received(self, raw_message):
+        self.messages += 1
+        self.bytes_received += len(raw_message)
+
+    def merge(self, other):
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for phase in self.PHASES:
+            self.seconds[phase] += other.seconds[phase]
+
+    def as_dict(self):
+        data = dict((name, getattr(self, name)) for name in self.COUNTERS)
+        for phase in self.PHASES:
+            data['%s_seconds' % phase] = round(self.seconds[phase], 3)
+        return data
+
+
+def record_ingestion_run(q, started, stats, logger):
+    """
+    Write a JSON summary of a queue run to the queue log, and store it for
+    the e-mail metrics view.
+    """
+    finished = timezone.now()
+    summary = stats.as_dict()
+    logger.info(json.dumps(dict(
+        summary,
+        queue=q.slug,
+        started=started.isoformat(),
+        finished=finished.isoformat(),
+        error=stats.error,
+    ), sort_keys=True))
+    EmailIngestionRun.objects.create(
+        queue=q,
+        started=started,
+        finished=finished,
+        error=stats.error,
+        **summary
+    )
 
-        if (q.email_box_last_check + queue_time_delta) < timezone.now():
-            process_queue(q, logger=logger)
-            q.email_box_last_check = timezone.now()
-            q.save()
 
+def process_queue(q, logger, stats=None):
+    if stats is None:
+        stats = IngestionStats()
 
-def process_queue(q, logger):
     logger.info("***** %s: Begin processing mail for django-helpdesk" % ctime())
 
     if q.socks_proxy_type and q.socks_proxy_host and q.socks_proxy_port:
@@ -136,95 +229,110 @@ def process_queue(q, logger):
     email_box_type = settings.QUEUE_EMAIL_BOX_TYPE or q.email_box_type
 
     if email_box_type == 'pop3':
-        if q.email_box_ssl or settings.QUEUE_EMAIL_BOX_SSL:
-            if not q.email_box_port:
-                q.email_box_port = 995
-            server = poplib.POP3_SSL(q.email_box_host or
+        with stats.timer('network'):
+            if q.email_box_ssl or settings.QUEUE_EMAIL_BOX_SSL:
+                if not q.email_box_port:
+                    q.email_box_port = 995
+                server = poplib.POP3_SSL(q.email_box_host or
+                                         settings.QUEUE_EMAIL_BOX_HOST,
+                                         int(q.email_box_port))
+            else:
+                if not q.email_box_port:
+                    q.email_box_port = 110
+                server = poplib.POP3(q.email_box_host or
                                      settings.QUEUE_EMAIL_BOX_HOST,
                                      int(q.email_box_port))
-        else:
-            if not q.email_box_port:
-                q.email_box_port = 110
-            server = poplib.POP3(q.email_box_host or
-                                 settings.QUEUE_EMAIL_BOX_HOST,
-                                 int(q.email_box_port))
 
-        logger.info("Attempting POP3 server login")
+            logger.info("Attempting POP3 server login")
 
-        server.getwelcome()
-        server.user(q.email_box_user or settings.QUEUE_EMAIL_BOX_USER)
-        server.pass_(q.email_box_pass or settings.QUEUE_EMAIL_BOX_PASSWORD)
+            server.getwelcome()
+            server.user(q.email_box_user or settings.QUEUE_EMAIL_BOX_USER)
+            server.pass_(q.email_box_pass or settings.QUEUE_EMAIL_BOX_PASSWORD)
 
-        messagesInfo = server.list()[1]
+            messagesInfo = server.list()[1]
         logger.info("Received %d messages from POP3 server" % len(messagesInfo))
 
         for msg in messagesInfo:
             msgNum = msg.split(" ")[0]
             logger.info("Processing message %s" % msgNum)
 
-            full_message = encoding.force_text("\n".join(server.retr(msgNum)[1]), errors='replace')
-            ticket = ticket_from_message(message=full_message, queue=q, logger=logger)
+            with stats.timer('network'):
+                raw_message = "\n".join(server.retr(msgNum)[1])
+            stats.received(raw_message)
+            full_message = encoding.force_text(raw_message, errors='replace')
+            ticket = ticket_from_message(message=full_message, queue=q, logger=logger, stats=stats)
 
             if ticket:
-                server.dele(msgNum)
+                with stats.timer('network'):
+                    server.dele(msgNum)
                 logger.info("Successfully processed message %s, deleted from POP3 server" % msgNum)
             else:
                 logger.warn("Message %s was not successfully processed, and will be left on POP3 server" % msgNum)
 
-        server.quit()
+        with stats.timer('network'):
+            server.quit()
 
     elif email_box_type == 'imap':
-        if q.email_box_ssl or settings.QUEUE_EMAIL_BOX_SSL:
-            if not q.email_box_port:
-                q.email_box_port = 993
-            server = imaplib.IMAP4_SSL(q.email_box_host or
+        with stats.timer('network'):
+            if q.email_box_ssl or settings.QUEUE_EMAIL_BOX_SSL:
+                if not q.email_box_port:
+                    q.email_box_port = 993
+                server = imaplib.IMAP4_SSL(q.email_box_host or
+                                           settings.QUEUE_EMAIL_BOX_HOST,
+                                           int(q.email_box_port))
+            else:
+                if not q.email_box_port:
+                    q.email_box_port = 143
+                server = imaplib.IMAP4(q.email_box_host or
                                        settings.QUEUE_EMAIL_BOX_HOST,
                                        int(q.email_box_port))
-        else:
-            if not q.email_box_port:
-                q.email_box_port = 143
-            server = imaplib.IMAP4(q.email_box_host or
-                                   settings.QUEUE_EMAIL_BOX_HOST,
-                                   int(q.email_box_port))
 
-        logger.info("Attempting IMAP server login")
+            logger.info("Attempting IMAP server login")
 
-        server.login(q.email_box_user or
-                     settings.QUEUE_EMAIL_BOX_USER,
-                     q.email_box_pass or
-                     settings.QUEUE_EMAIL_BOX_PASSWORD)
-        server.select(q.email_box_imap_folder)
+            server.login(q.email_box_user or
+                         settings.QUEUE_EMAIL_BOX_USER,
+                         q.email_box_pass or
+                         settings.QUEUE_EMAIL_BOX_PASSWORD)
+            server.select(q.email_box_imap_folder)
 
-        status, data = server.search(None, 'NOT', 'DELETED')
+            status, data = server.search(None, 'NOT', 'DELETED')
         if data:
             msgnums = data[0].split()
             logger.info("Received %d messages from IMAP server" % len(msgnums))
             for num in msgnums:
                 logger.info("Processing message %s" % num)
-                status, data = server.fetch(num, '(RFC822)')
+                with stats.timer('network'):
+                    status, data = server.fetch(num, '(RFC822)')
+                stats.received(data[0][1])
                 full_message = encoding.force_text(data[0][1], errors='replace')
-                ticket = ticket_from_message(message=full_message, queue=q, logger=logger)
+                ticket = ticket_from_message(message=full_message, queue=q, logger=logger, stats=stats)
                 if ticket:
-                    server.store(num, '+FLAGS', '\\Deleted')
+                    with stats.timer('network'):
+                        server.store(num, '+FLAGS', '\\Deleted')
                     logger.info("Successfully processed message %s, deleted from IMAP server" % num)
                 else:
                     logger.warn("Message %s was not successfully processed, and will be left on IMAP server" % num)
 
-        server.expunge()
-        server.close()
-        server.logout()
+        with stats.timer('network'):
+            server.expunge()
+            server.close()
+            server.logout()
 
     elif email_box_type == 'local':
         mail_dir = q.email_box_local_dir or '/var/lib/mail/helpdesk/'
-        mail = [join(mail_dir, f) for f in listdir(mail_dir) if isfile(join(mail_dir, f))]
-        logger.info("Found %d messages in local mailbox directory" % len(mail))
+        if settings.QUEUE_EMAIL_BOX_LOCAL_WORKERS > 1:
+            process_local_dir_parallel(q, mail_dir, settings.QUEUE_EMAIL_BOX_LOCAL_WORKERS, logger, stats)
+            return
 
+        mail = [join(mail_dir, f) for f in listdir(mail_dir) if isfile(join(mail_dir, f))]
         logger.info("Found %d messages in local mailbox directory" % len(mail))
         for i, m in enumerate(mail, 1):
             logger.info("Processing message %d" % i)
-            with open(m, 'r') as f:
-                full_message = encoding.force_text(f.read(), errors='replace')
-                ticket = ticket_from_message(message=full_message, queue=q, logger=logger)
+            with stats.timer('network'):
+                raw_message = read_message_file(m, settings.QUEUE_EMAIL_BOX_LOCAL_MMAP)
+            stats.received(raw_message)
+            full_message = encoding.force_text(raw_message, errors='replace')
+            ticket = ticket_from_message(message=full_message, queue=q, logger=logger, stats=stats)
             if ticket:
                 logger.info("Successfully processed message %d, ticket/comment created." % i)
                 try:
@@ -237,6 +345,133 @@ def process_queue(q, logger):
                 logger.warn("Message %d was not successfully processed, and will be left in local directory" % i)
 
 
+def read_message_file(path, use_mmap=False):
+    """
+    Return the raw bytes of a message file, optionally mapping it into
+    memory rather than reading it through a file buffer.
+    """
+    with open(path, 'rb') as f:
+        if use_mmap:
+            try:
+                with closing(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) as mapped:
+                    return mapped[:]
+            except ValueError:
+                # empty files cannot be mapped
+                return b''
+        return f.read()
+
+
+def claim_local_message(mail_dir, filename):
+    """
+    Move a message file into the processing directory, so that no other
+    worker picks it up. Returns the new path, or None if the file was
+    claimed by someone else first. The modification time of the file is
+    set to the time it was claimed.
+    """
+    claimed = join(mail_dir, LOCAL_PROCESSING_DIR, filename)
+    try:
+        rename(join(mail_dir, filename), claimed)
+        utime(claimed, None)
+    except OSError:
+        return None
+    return claimed
+
+
+def recover_local_messages(mail_dir, timeout, logger):
+    """
+    Move the message files claimed more than `timeout` seconds ago back
+    into the mailbox directory: the worker which claimed them died before
+    processing them. Returns their names.
+    """
+    processing = join(mail_dir, LOCAL_PROCESSING_DIR)
+    stale = time() - timeout
+    recovered = []
+    for filename in listdir(processing):
+        path = join(processing, filename)
+        try:
+            if getmtime(path) >= stale:
+                continue
+            rename(path, join(mail_dir, filename))
+        except OSError:
+            # finished or recovered by another run meanwhile
+            continue
+        logger.warn("Message %s was claimed by a worker which did not finish it, and "
+                    "has been moved back to the local directory" % filename)
+        recovered.append(filename)
+    return recovered
+
+
+def process_local_message(args):
+    """
+    Worker for process_local_dir_parallel: claim, read and process a single
+    message file. Returns 'processed', 'kept', 'quarantined' or 'skipped',
+    and the IngestionStats for the message. Only messages which raised an
+    error are quarantined; others which did not make a ticket or follow-up,
+    such as ignored senders kept in the mailbox, are left in the directory.
+    """
+    queue, mail_dir, filename, use_mmap = args
+    logger = logging.getLogger('django.helpdesk.queue.' + queue.slug)
+    stats = IngestionStats()
+
+    path = claim_local_message(mail_dir, filename)
+    if path is None:
+        logger.info("Message %s was claimed by another worker, skipping" % filename)
+        return 'skipped', stats
+
+    try:
+        with stats.timer('network'):
+            raw_message = read_message_file(path, use_mmap)
+        stats.received(raw_message)
+        full_message = encoding.force_text(raw_message, errors='replace')
+        ticket = ticket_from_message(message=full_message, queue=queue, logger=logger, stats=stats)
+    except Exception:
+        logger.exception("Error while processing message %s" % filename)
+        stats.failed += 1
+        rename(path, join(mail_dir, LOCAL_QUARANTINE_DIR, filename))
+        logger.warn("Message %s was not successfully processed, and has been moved to quarantine" % filename)
+        return 'quarantined', stats
+
+    if ticket:
+        unlink(path)
+        logger.info("Successfully processed message %s, ticket/comment created." % filename)
+        return 'processed', stats
+
+    rename(path, join(mail_dir, filename))
+    logger.warn("Message %s was not successfully processed, and will be left in local directory" % filename)
+    return 'kept', stats
+
+
+def process_local_dir_parallel(q, mail_dir, workers, logger, stats):
+    for subdir in (LOCAL_PROCESSING_DIR, LOCAL_QUARANTINE_DIR):
+        if not isdir(join(mail_dir, subdir)):
+            makedirs(join(mail_dir, subdir))
+    recover_local_messages(mail_dir, settings.QUEUE_EMAIL_BOX_LOCAL_PROCESSING_TIMEOUT, logger)
+
+    mail = [f for f in listdir(mail_dir) if isfile(join(mail_dir, f))]
+    logger.info("Found %d messages in local mailbox directory, processing with %d workers" %
+                (len(mail), workers))
+    if not mail:
+        return
+
+    # forked workers must not share the parent's database connections; each
+    # one opens its own on first use.
+    connections.close_all()
+
+    tasks = ((q, mail_dir, f, settings.QUEUE_EMAIL_BOX_LOCAL_MMAP) for f in mail)
+    results = {'processed': 0, 'kept': 0, 'quarantined': 0, 'skipped': 0}
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result, message_stats in pool.imap_unordered(process_local_message, tasks, chunksize=32):
+            results[result] += 1
+            stats.merge(message_stats)
+    finally:
+        pool.close()
+        pool.join()
+
+    logger.info("Processed %(processed)d messages, left %(kept)d in the directory, quarantined "
+                "%(quarantined)d, skipped %(skipped)d claimed elsewhere" % results)
+
+
 def decodeUnknown(charset, string):
     if six.PY2:
         if not charset:
@@ -264,9 +499,11 @@ def decode_mail_headers(string):
         return u' '.join([str(msg, encoding=charset, errors='replace') if charset else str(msg) for msg, charset in decoded])
 
 
-def ticket_from_message(message, queue, logger):
-    # 'message' must be an RFC822 formatted message.
-    message = email.message_from_string(message) if six.PY3 else email.message_from_string(message.encode('utf-8'))
+def parse_message_headers(message):
+    """
+    Decode the headers of an email.message.Message which the helpdesk cares
+    about. The CC header is returned as a set of addresses, or None.
+    """
     subject = message.get('subject', _('Comment from e-mail'))
     subject = decode_mail_headers(decodeUnknown(message.get_charset(), subject))
     for affix in STRIPPED_SUBJECT_STRINGS:
@@ -288,23 +525,24 @@ def ticket_from_message(message, queue, logger):
         # use a set to ensure no duplicates
         cc = set([x.strip() for x in tempcc])
 
-    for ignore in IgnoreEmail.objects.filter(Q(queues=queue) | Q(queues__isnull=True)):
-        if ignore.test(sender_email):
-            if ignore.keep_in_mailbox:
-                # By returning 'False' the message will be kept in the mailbox,
-                # and the 'True' will cause the message to be deleted.
-                return False
-            return True
+    smtp_priority = message.get('priority', '')
+    smtp_importance = message.get('importance', '')
+    high_priority_types = {'high', 'important', '1', 'urgent'}
+    priority = 2 if high_priority_types & {smtp_priority, smtp_importance} else 3
 
-    matchobj = re.match(r".*\[" + queue.slug + "-(?P<id>\d+)\]", subject)
-    if matchobj:
-        # This is a reply or forward.
-        ticket = matchobj.group('id')
-        logger.info("Matched tracking ID %s-%s" % (queue.slug, ticket))
-    else:
-        logger.info("No tracking ID matched.")
-        ticket = None
+    return {
+        'subject': subject,
+        'sender_email': sender_email,
+        'cc': cc,
+        'priority': priority,
+    }
 
+
+def parse_message_body(message, logger):
+    """
+    Walk the MIME parts of a message, returning the plain-text body and a
+    list of uploaded files for the HTML body and any attachments.
+    """
     body = None
     counter = 0
     files = []
@@ -353,6 +591,65 @@ def ticket_from_message(message, queue, logger):
     if not body:
         body = _('No plain-text email body available. Please see attachment "email_html_body.html".')
 
+    return body, files
+
+
+def build_ticket_ccs(ticket, cc, current_cc, cc_users):
+    """
+    Return unsaved TicketCCs for the addresses in `cc` which are not in
+    `current_cc`, nor the queue, submitter or assigned user's address.
+    `cc_users` maps the addresses which belong to a User onto that User.
+    """
+    # ensure submitter, assigned user, queue email not added
+    current_cc = set(current_cc)
+    current_cc.add(ticket.queue.email_address)
+    if ticket.submitter_email:
+        current_cc.add(ticket.submitter_email)
+    if ticket.assigned_to_id:
+        current_cc.add(ticket.assigned_to.email)
+    new_ccs = []
+    # first, add any User not previously CC'd (as identified by User's email)
+    for user_email in sorted(set(cc_users).intersection(cc).difference(current_cc)):
+        new_ccs.append(TicketCC(
+            ticket=ticket,
+            user=cc_users[user_email],
+            can_view=True,
+            can_update=False
+        ))
+    # then add remaining emails alphabetically, makes testing easy
+    new_cc = cc.difference(current_cc).difference(cc_users)
+    for ccemail in sorted(new_cc):
+        new_ccs.append(TicketCC(
+            ticket=ticket,
+            email=ccemail,
+            can_view=True,
+            can_update=False
+        ))
+    return new_ccs
+
+
+def save_message(headers, body, files, queue, logger):
+    """
+    Create the ticket (or find the ticket being replied to), CCs, follow-up
+    and attachments for a parsed message.
+
+    Returns a (ticket, followup, new) tuple; ticket is None if the message
+    does not belong to an existing ticket and QUEUE_EMAIL_BOX_UPDATE_ONLY
+    is set.
+    """
+    subject = headers['subject']
+    sender_email = headers['sender_email']
+    cc = headers['cc']
+
+    matchobj = re.match(r".*\[" + queue.slug + "-(?P<id>\d+)\]", subject)
+    if matchobj:
+        # This is a reply or forward.
+        ticket = matchobj.group('id')
+        logger.info("Matched tracking ID %s-%s" % (queue.slug, ticket))
+    else:
+        logger.info("No tracking ID matched.")
+        ticket = None
+
     if ticket:
         try:
             t = Ticket.objects.get(id=ticket)
@@ -366,14 +663,9 @@ def ticket_from_message(message, queue, logger):
                 t.save()
             new = False
 
-    smtp_priority = message.get('priority', '')
-    smtp_importance = message.get('importance', '')
-    high_priority_types = {'high', 'important', '1', 'urgent'}
-    priority = 2 if high_priority_types & {smtp_priority, smtp_importance} else 3
-
     if ticket is None:
         if settings.QUEUE_EMAIL_BOX_UPDATE_ONLY:
-            return None
+            return None, None, False
         new = True
         t = Ticket.objects.create(
             title=subject,
@@ -381,47 +673,22 @@ def ticket_from_message(message, queue, logger):
             submitter_email=sender_email,
             created=timezone.now(),
             description=body,
-            priority=priority,
+            priority=headers['priority'],
         )
         logger.debug("Created new ticket %s-%s" % (t.queue.slug, t.id))
 
     if cc:
-        # get list of currently CC'd emails
-        current_cc = TicketCC.objects.filter(ticket=ticket)
-        current_cc_emails = [x.email for x in current_cc]
-        # get emails of any Users CC'd to email
-        current_cc_users = [x.user.email for x in current_cc]
-        # ensure submitter, assigned user, queue email not added
-        other_emails = [queue.email_address]
-        if t.submitter_email:
-            other_emails.append(t.submitter_email)
-        if t.assigned_to:
-            other_emails.append(t.assigned_to.email)
-        current_cc = set(current_cc_emails + current_cc_users + other_emails)
-        # first, add any User not previously CC'd (as identified by User's email)
-        all_users = User.objects.all()
-        all_user_emails = set([x.email for x in all_users])
-        users_not_currently_ccd = all_user_emails.difference(set(current_cc))
-        users_to_cc = cc.intersection(users_not_currently_ccd)
-        for user in users_to_cc:
-            tcc = TicketCC.objects.create(
-                ticket=t,
-                user=User.objects.get(email=user),
-                can_view=True,
-                can_update=False
-            )
-            tcc.save()
-        # then add remaining emails alphabetically, makes testing easy
-        new_cc = cc.difference(current_cc).difference(all_user_emails)
-        new_cc = sorted(list(new_cc))
-        for ccemail in new_cc:
-            tcc = TicketCC.objects.create(
-                ticket=t,
-                email=ccemail,
-                can_view=True,
-                can_update=False
-            )
-            tcc.save()
+        # get list of currently CC'd emails, and emails of any Users CC'd
+        current_cc = set()
+        for x in TicketCC.objects.filter(ticket=t).select_related('user'):
+            current_cc.add(x.email)
+            if x.user:
+                current_cc.add(x.user.email)
+        # resolve the CC'd addresses that belong to a User in one query
+        cc_users = {}
+        for user in User.objects.filter(email__in=cc).order_by('pk'):
+            cc_users.setdefault(user.email, user)
+        TicketCC.objects.bulk_create(build_ticket_ccs(t, cc, current_cc, cc_users))
 
     f = FollowUp(
         ticket=t,
@@ -435,7 +702,8 @@ def ticket_from_message(message, queue, logger):
         f.new_status = Ticket.REOPENED_STATUS
         f.title = _('Ticket Re-Opened by E-Mail Received from %(sender_email)s' % {'sender_email': sender_email})
 
-    f.save()
+    # a new ticket was only just saved
+    f.save(touch_ticket=not new)
     logger.debug("Created new FollowUp for Ticket")
 
     if six.PY2:
@@ -447,7 +715,14 @@ def ticket_from_message(message, queue, logger):
     for att_file in attached:
         logger.info("Attachment '%s' successfully added to ticket from email." % att_file[0])
 
-    context = safe_template_context(t)
+    return t, f, new
+
+
+def notify_message_received(ticket, followup, new, sender_email, queue):
+    """
+    Send the new ticket / updated ticket e-mails for a received message.
+    """
+    context = safe_template_context(ticket)
 
     if new:
         if sender_email:
@@ -475,12 +750,12 @@ def ticket_from_message(message, queue, logger):
                 fail_silently=True,
             )
     else:
-        context.update(comment=f.comment)
-        if t.assigned_to:
+        context.update(comment=followup.comment)
+        if ticket.assigned_to:
             send_templated_mail(
                 'updated_owner',
                 context,
-                recipients=t.assigned_to.email,
+                recipients=ticket.assigned_to.email,
                 sender=queue.from_address,
                 fail_silently=True,
             )
@@ -493,6 +768,40 @@ def ticket_from_message(message, queue, logger):
                 fail_silently=True,
             )
 
+
+def ticket_from_message(message, queue, logger, stats=None):
+    # 'message' must be an RFC822 formatted message.
+    if stats is None:
+        stats = IngestionStats()
+
+    with stats.timer('parse'):
+        message = email.message_from_string(message) if six.PY3 else email.message_from_string(message.encode('utf-8'))
+        headers = parse_message_headers(message)
+        keep_in_mailbox = IgnoreEmail.objects.matcher_for_queue(queue).match(headers['sender_email'])
+        if keep_in_mailbox is None:
+            body, files = parse_message_body(message, logger)
+
+    if keep_in_mailbox is not None:
+        stats.ignored += 1
+        # By returning 'False' the message will be kept in the mailbox,
+        # and the 'True' will cause the message to be deleted.
+        return not keep_in_mailbox
+
+    with stats.timer('db'):
+        t, f, new = save_message(headers, body, files, queue, logger)
+    if t is None:
+        # not a reply, with QUEUE_EMAIL_BOX_UPDATE_ONLY
+        stats.ignored += 1
+        return None
+
+    if new:
+        stats.tickets_created += 1
+    else:
+        stats.followups_created += 1
+
+    with stats.timer('network'):
+        notify_message_received(t, f, new, headers['sender_email'], queue)
+
     return t
 
 
@@ -0,0 +1,271 @@
+#!/usr/bin/python
+"""
+django-helpdesk - A Django powered ticket tracker for small enterprise.
+
+See LICENSE for details.
+
+import_mailbox.py - Import an mbox file or maildir directory of historical
+                    mail into a queue. Unlike get_email, no notification
+                    e-mails are sent, tickets and follow-ups keep the date
+                    of the original message, and messages are saved in
+                    batches, each inside a single transaction.
+"""
+from __future__ import unicode_literals
+
+from datetime import datetime
+import email
+import logging
+import mailbox
+from os.path import isdir
+import re
+from time import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models, transaction
+from django.db.models import F
+from django.utils import encoding, six, timezone
+from django.utils.translation import ugettext as _
+
+from helpdesk.lib import process_attachments
+from helpdesk.management.commands.get_email import (
+    IngestionStats, build_ticket_ccs, parse_message_body, parse_message_headers,
+)
+from helpdesk.models import Queue, Ticket, TicketCC, FollowUp, IgnoreEmail
+
+
+def message_date(message):
+    """
+    Return the Date header of a message as a datetime, or None if it is
+    missing or cannot be parsed.
+    """
+    parsed = email.utils.parsedate_tz(message.get('date', ''))
+    if parsed is None:
+        return None
+    try:
+        date = datetime.fromtimestamp(email.utils.mktime_tz(parsed), timezone.utc)
+    except (OverflowError, ValueError):
+        return None
+    if not settings.USE_TZ:
+        date = timezone.make_naive(date, timezone.get_default_timezone())
+    return date
+
+
+def open_mailbox(path, mailbox_format=None):
+    if mailbox_format is None:
+        mailbox_format = 'maildir' if isdir(path) else 'mbox'
+    if mailbox_format == 'maildir':
+        return mailbox.Maildir(path, factory=None, create=False)
+    return mailbox.mbox(path, create=False)
+
+
+class Command(BaseCommand):
+
+    help = _('Import the messages of an mbox file or maildir directory into a '
+             'queue, without sending any notification e-mails.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'queue',
+            help='Slug of the queue to import the messages into',
+        )
+        parser.add_argument(
+            'path',
+            help='Path of the mbox file or maildir directory',
+        )
+        parser.add_argument(
+            '--format',
+            choices=('mbox', 'maildir'),
+            dest='mailbox_format',
+            default=None,
+            help='Mailbox format; by default directories are read as maildir '
+                 'and files as mbox',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            dest='batch_size',
+            default=500,
+            help='Number of messages saved per transaction',
+        )
+        parser.add_argument(
+            '--quiet',
+            action='store_true',
+            dest='quiet',
+            default=False,
+            help='Only print the final summary',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            queue = Queue.objects.get(slug=options['queue'])
+        except Queue.DoesNotExist:
+            raise CommandError("Queue '%s' does not exist" % options['queue'])
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+
+        try:
+            box = open_mailbox(options['path'], options['mailbox_format'])
+        except (mailbox.Error, OSError, IOError) as e:
+            raise CommandError("Unable to open mailbox %s: %s" % (options['path'], e))
+
+        importer = MailboxImporter(queue, logging.getLogger('django.helpdesk.queue.' + queue.slug))
+        started = time()
+        batch = []
+        try:
+            for key in box.iterkeys():
+                with importer.stats.timer('network'):
+                    raw_message = box.get_bytes(key) if six.PY3 else box.get_string(key)
+                importer.stats.received(raw_message)
+                batch.append(raw_message)
+                if len(batch) >= options['batch_size']:
+                    importer.import_batch(batch)
+                    batch = []
+                    if not options['quiet']:
+                        self.report(importer.stats, started)
+            if batch:
+                importer.import_batch(batch)
+        finally:
+            box.close()
+
+        self.report(importer.stats, started, final=True)
+
+    def report(self, stats, started, final=False):
+        elapsed = time() - started
+        rate = stats.messages / elapsed if elapsed else 0
+        self.stdout.write("%s %d messages in %.1fs (%.1f messages/s)" % (
+            'Imported' if final else 'Read', stats.messages, elapsed, rate))
+        if final:
+            self.stdout.write(
+                "%(tickets_created)d tickets created, %(followups_created)d follow-ups appended, "
+                "%(ignored)d ignored; %(network_seconds).1fs reading, %(parse_seconds).1fs parsing, "
+                "%(db_seconds).1fs saving" % stats.as_dict())
+
+
+class MailboxImporter(object):
+    """
+    Saves batches of raw messages into a queue. Each batch is written in one
+    transaction: new tickets are inserted one at a time (their ids are needed
+    for replies further down the mailbox), while follow-ups without
+    attachments and CCs are written with bulk_create.
+    """
+
+    def __init__(self, queue, logger):
+        self.queue = queue
+        self.logger = logger
+        self.stats = IngestionStats()
+        self.matcher = IgnoreEmail.objects.matcher_for_queue(queue)
+        self.tracking_re = re.compile(r".*\[" + re.escape(queue.slug) + r"-(?P<id>\d+)\]")
+
+    def parse(self, raw_message):
+        message = encoding.force_text(raw_message, errors='replace')
+        message = email.message_from_string(message) if six.PY3 else email.message_from_string(message.encode('utf-8'))
+        headers = parse_message_headers(message)
+        if self.matcher.match(headers['sender_email']) is not None:
+            return None
+        body, files = parse_message_body(message, self.logger)
+        headers['date'] = message_date(message) or timezone.now()
+        matchobj = self.tracking_re.match(headers['subject'])
+        headers['ticket_id'] = int(matchobj.group('id')) if matchobj else None
+        return headers, body, files
+
+    def import_batch(self, raw_messages):
+        parsed = []
+        with self.stats.timer('parse'):
+            for raw_message in raw_messages:
+                message = self.parse(raw_message)
+                if message is None:
+                    self.stats.ignored += 1
+                else:
+                    parsed.append(message)
+
+        with self.stats.timer('db'):
+            with transaction.atomic():
+                self.save_batch(parsed)
+
+    def save_batch(self, parsed):
+        tickets = Ticket.objects.filter(queue=self.queue).in_bulk(
+            set(headers['ticket_id'] for headers, body, files in parsed if headers['ticket_id']))
+        new_ticket_ids = []
+        modified = {}
+        followups = []
+        ticket_ccs = []
+
+        for headers, body, files in parsed:
+            date = headers['date']
+            t = tickets.get(headers['ticket_id'])
+            if t is None:
+                t = Ticket(
+                    title=headers['subject'],
+                    queue=self.queue,
+                    submitter_email=headers['sender_email'],
+                    created=date,
+                    modified=date,
+                    description=body,
+                    priority=headers['priority'],
+                )
+                # Ticket.save() would stamp the ticket with the current time
+                models.Model.save(t)
+                tickets[t.id] = t
+                new_ticket_ids.append(t.id)
+                self.stats.tickets_created += 1
+            else:
+                if date > modified.get(t.id, t.modified):
+                    modified[t.id] = date
+                self.stats.followups_created += 1
+
+            f = FollowUp(
+                ticket=t,
+                title=_('E-Mail Received from %(sender_email)s' % {'sender_email': headers['sender_email']}),
+                date=date,
+                public=True,
+                comment=body,
+            )
+            if files:
+                # attachments need the id of their follow-up
+                models.Model.save(f)
+                process_attachments(f, files)
+            else:
+                followups.append(f)
+
+            if headers['cc']:
+                ticket_ccs.append((t, headers['cc']))
+
+        FollowUp.objects.bulk_create(followups)
+        if ticket_ccs:
+            TicketCC.objects.bulk_create(self.build_ccs(ticket_ccs))
+        if new_ticket_ids:
+            Ticket.objects.filter(pk__in=new_ticket_ids).update(modified_status=F('created'))
+        for ticket_id, date in modified.items():
+            Ticket.objects.filter(pk=ticket_id, modified__lt=date).update(modified=date)
+
+    def build_ccs(self, ticket_ccs):
+        """
+        Resolve the CC'd addresses of a whole batch with one User query and
+        one TicketCC query.
+        """
+        addresses = set()
+        for t, cc in ticket_ccs:
+            addresses.update(cc)
+        cc_users = {}
+        for user in User.objects.filter(email__in=addresses).order_by('pk'):
+            cc_users.setdefault(user.email, user)
+
+        current_cc = {}
+        existing = TicketCC.objects.filter(
+            ticket__in=set(t.id for t, cc in ticket_ccs)).select_related('user')
+        for x in existing:
+            current = current_cc.setdefault(x.ticket_id, set())
+            current.add(x.email)
+            if x.user:
+                current.add(x.user.email)
+
+        new_ccs = []
+        for t, cc in ticket_ccs:
+            current = current_cc.setdefault(t.id, set())
+            ccs = build_ticket_ccs(t, cc, current, cc_users)
+            for ticket_cc in ccs:
+                current.add(ticket_cc.user.email if ticket_cc.user else ticket_cc.email)
+            new_ccs.extend(ccs)
+        return new_ccs
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+"""
+django-helpdesk - A Django powered ticket tracker for small enterprise.
+
+(c) Copyright 2008 Jutda. All Rights Reserved. See LICENSE for details.
+
+scripts/process_bulk_jobs.py - Run the bulk actions queued from the ticket
+                               list, designed to be run from Cron or as a
+                               long-running worker.
+"""
+from __future__ import print_function
+
+import logging
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from helpdesk import settings as helpdesk_settings
+from helpdesk.lib import run_bulk_job
+from helpdesk.models import BulkActionJob
+
+logger = logging.getLogger('helpdesk')
+
+
+class Command(BaseCommand):
+
+    help = 'Run the pending bulk action jobs, oldest first, and those left running by a dead worker.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            dest='chunk_size',
+            help='Number of tickets changed per transaction '
+                 '(default: HELPDESK_BULK_JOB_CHUNK_SIZE)')
+        parser.add_argument(
+            '--loop',
+            action='store_true',
+            default=False,
+            help='Keep waiting for new jobs instead of exiting once none is pending')
+        parser.add_argument(
+            '--sleep',
+            type=int,
+            default=5,
+            help='Seconds to wait between looking for new jobs with --loop')
+
+    def handle(self, *args, **options):
+        while True:
+            processed = process_bulk_jobs(chunk_size=options['chunk_size'])
+            if options['verbosity'] > 1:
+                for job in processed:
+                    print('Job %d: %s, %d/%d tickets changed' % (
+                        job.pk, job.get_status_display(), job.changed, job.total))
+            if not options['loop']:
+                break
+            if not processed:
+                time.sleep(options['sleep'])
+
+
+def claim_next_job():
+    """
+    Return the oldest pending job, marked as running. Running jobs whose
+    progress was not saved for HELPDESK_BULK_JOB_STALE_TIMEOUT seconds were
+    left by a worker which died, and are claimed again. The status is changed
+    by a conditional UPDATE, so each job is only claimed by one of several
+    workers running at once.
+    """
+    while True:
+        stale = timezone.now() - timedelta(seconds=helpdesk_settings.HELPDESK_BULK_JOB_STALE_TIMEOUT)
+        job = BulkActionJob.objects.filter(
+            Q(status=BulkActionJob.PENDING_STATUS) |
+            Q(status=BulkActionJob.RUNNING_STATUS, updated__lt=stale)
+        ).order_by('created', 'id').first()
+        if job is None:
+            return None
+        if job.status == BulkActionJob.RUNNING_STATUS:
+            logger.warning('Bulk action job %d was not updated since %s, running it again', job.pk, job.updated)
+        now = timezone.now()
+        claimed = BulkActionJob.objects.filter(pk=job.pk, status=job.status, updated=job.updated).update(
+            status=BulkActionJob.RUNNING_STATUS, updated=now)
+        if claimed:
+            job.status = BulkActionJob.RUNNING_STATUS
+            job.updated = now
+            return job
+
+
+def process_bulk_jobs(chunk_size=None):
+    """
+    Run the pending jobs until there are none left, and return them. A job
+    which fails is marked as such with its error; setting it back to pending
+    carries on after the last chunk it finished.
+    """
+    processed = []
+    job = claim_next_job()
+    while job is not None:
+        try:
+            run_bulk_job(job, chunk_size=chunk_size)
+        except Exception as e:
+            logger.exception('Bulk action job %d failed', job.pk)
+            job.status = BulkActionJob.FAILED_STATUS
+            job.error = '%s: %s' % (e.__class__.__name__, e)
+            job.finished = timezone.now()
+            if not job.save_progress('status', 'error', 'finished'):
+                job.refresh_from_db()
+        processed.append(job)
+        job = claim_next_job()
+    return processed
+
+
+if __name__ == '__main__':
+    process_bulk_jobs()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helpdesk', '0023_auto_20170819_0536'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailIngestionRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started', models.DateTimeField(db_index=True, verbose_name='Started')),
+                ('finished', models.DateTimeField(verbose_name='Finished')),
+                ('messages', models.PositiveIntegerField(default=0, verbose_name='Messages fetched')),
+                ('bytes_received', models.BigIntegerField(default=0, verbose_name='Bytes received')),
+                ('tickets_created', models.PositiveIntegerField(default=0, verbose_name='Tickets created')),
+                ('followups_created', models.PositiveIntegerField(default=0, verbose_name='Follow-ups appended')),
+                ('ignored', models.PositiveIntegerField(default=0, help_text='Messages dropped or kept because of the e-mail ignore list.', verbose_name='Ignored')),
+                ('failed', models.PositiveIntegerField(default=0, verbose_name='Failed')),
+                ('network_seconds', models.FloatField(default=0, help_text='Seconds spent talking to the mail server or reading the local mailbox, and sending notifications.', verbose_name='Network time')),
+                ('parse_seconds', models.FloatField(default=0, verbose_name='Parsing time')),
+                ('db_seconds', models.FloatField(default=0, verbose_name='Database time')),
+                ('error', models.TextField(blank=True, help_text='The error which aborted this run, if any.', verbose_name='Error')),
+                ('queue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ingestion_runs', to='helpdesk.Queue', verbose_name='Queue')),
+            ],
+            options={
+                'ordering': ('-started',),
+                'verbose_name': 'E-Mail ingestion run',
+                'verbose_name_plural': 'E-Mail ingestion runs',
+            },
+        ),
+    ]
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations, models
+
+
+def unpickle_settings(settings_pickled):
+    """Unpickling as defined before this migration"""
+    try:
+        import pickle
+    except ImportError:
+        import cPickle as pickle
+    from helpdesk.lib import b64decode
+    settings_pickled = str(settings_pickled or '')
+    # values saved from a bytes object under Python 3 may have been stored
+    # as their repr
+    if settings_pickled.startswith("b'") and settings_pickled.endswith("'"):
+        settings_pickled = settings_pickled[2:-1]
+    try:
+        data = pickle.loads(b64decode(settings_pickled))
+    except Exception:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def pickle_settings(data):
+    """Pickling as defined before this migration"""
+    try:
+        import pickle
+    except ImportError:
+        import cPickle as pickle
+    from helpdesk.lib import b64encode
+    return b64encode(pickle.dumps(data))
+
+
+def settings_to_json(apps, schema_editor):
+    UserSettings = apps.get_model('helpdesk', 'UserSettings')
+    for s in UserSettings.objects.all().iterator():
+        data = unpickle_settings(s.settings_pickled)
+        # SavedSearch instances, or anything else JSON cannot represent, are
+        # stored by their primary key or text
+        s.settings_json = json.dumps(data, default=lambda value: getattr(value, 'pk', None) or str(value))
+        s.save(update_fields=['settings_json'])
+
+
+def settings_to_pickle(apps, schema_editor):
+    UserSettings = apps.get_model('helpdesk', 'UserSettings')
+    for s in UserSettings.objects.all().iterator():
+        try:
+            data = json.loads(s.settings_json or '{}')
+        except ValueError:
+            data = {}
+        s.settings_pickled = pickle_settings(data)
+        s.save(update_fields=['settings_pickled'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helpdesk', '0024_emailingestionrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usersettings',
+            name='settings_json',
+            field=models.TextField(blank=True, help_text='This is a JSON representation of a Python dictionary. Do not change this field via the admin.', null=True, verbose_name='Settings Dictionary'),
+        ),
+        migrations.RunPython(settings_to_json, reverse_code=settings_to_pickle),
+        migrations.RemoveField(
+            model_name='usersettings',
+            name='settings_pickled',
+        ),
+    ]
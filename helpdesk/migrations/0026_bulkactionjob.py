@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('helpdesk', '0025_usersettings_json'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BulkActionJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('assign', 'Assign/Unassign'), ('close', 'Close'), ('close_public', 'Close and e-mail'), ('delete', 'Delete')], max_length=20, verbose_name='Action')),
+                ('query', models.TextField(help_text='The ticket list filters selecting the tickets, encoded as for saved searches.', verbose_name='Search Query')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=10, verbose_name='Status')),
+                ('total', models.PositiveIntegerField(default=0, help_text='Number of tickets matching the query when the job started.', verbose_name='Total')),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='Processed')),
+                ('changed', models.PositiveIntegerField(default=0, help_text='Processed tickets which the action changed, eg which were not already closed.', verbose_name='Changed')),
+                ('last_ticket_id', models.PositiveIntegerField(default=0, help_text='The id of the last processed ticket, from which the next chunk starts.', verbose_name='Last ticket')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('started', models.DateTimeField(blank=True, null=True, verbose_name='Started')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='Finished')),
+                ('error', models.TextField(blank=True, help_text='The error which aborted this job, if any.', verbose_name='Error')),
+                ('assigned_to', models.ForeignKey(blank=True, help_text='The new owner of the tickets, for the assign action. Leave blank to unassign them.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Assign to')),
+                ('user', models.ForeignKey(help_text='The user who asked for the action. Only the tickets of the queues they can access are changed.', on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='User')),
+            ],
+            options={
+                'ordering': ('-created',),
+                'verbose_name': 'Bulk action job',
+                'verbose_name_plural': 'Bulk action jobs',
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def count_open_dependencies(apps, schema_editor):
+    Ticket = apps.get_model('helpdesk', 'Ticket')
+    TicketDependency = apps.get_model('helpdesk', 'TicketDependency')
+    # open and reopened tickets
+    counts = TicketDependency.objects.filter(depends_on__status__in=(1, 2)).order_by().values(
+        'ticket').annotate(count=models.Count('pk'))
+    for row in counts:
+        Ticket.objects.filter(pk=row['ticket']).update(open_dependency_count=row['count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helpdesk', '0026_bulkactionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='open_dependency_count',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Number of the tickets this ticket depends on which are still open - updated automatically.', verbose_name='Open dependencies'),
+        ),
+        migrations.RunPython(count_open_dependencies, reverse_code=migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_typed_values(apps, schema_editor):
+    from helpdesk.models import custom_field_typed_values
+    TicketCustomFieldValue = apps.get_model('helpdesk', 'TicketCustomFieldValue')
+    values = TicketCustomFieldValue.objects.select_related('field').exclude(value=None).exclude(value='')
+    for value in values.iterator():
+        TicketCustomFieldValue.objects.filter(pk=value.pk).update(
+            **custom_field_typed_values(value.field.data_type, value.value))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helpdesk', '0027_ticket_open_dependency_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticketcustomfieldvalue',
+            name='value_datetime',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='ticketcustomfieldvalue',
+            name='value_number',
+            field=models.DecimalField(blank=True, decimal_places=10, editable=False, max_digits=30, null=True),
+        ),
+        migrations.AddField(
+            model_name='ticketcustomfieldvalue',
+            name='value_string',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='ticketcustomfieldvalue',
+            index_together=set([('field', 'value_string'), ('field', 'value_number'), ('field', 'value_datetime')]),
+        ),
+        migrations.RunPython(fill_typed_values, reverse_code=migrations.RunPython.noop),
+    ]
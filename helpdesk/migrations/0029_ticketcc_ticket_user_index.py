@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('helpdesk', '0028_ticketcustomfieldvalue_typed_values'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='ticketcc',
+            index_together=set([('ticket', 'user')]),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def rate_items(apps, schema_editor):
+    KBItem = apps.get_model('helpdesk', 'KBItem')
+    rating = (models.F('recommendations') + 1.0) / (models.F('votes') + 2.0)
+    KBItem.objects.update(rating=models.ExpressionWrapper(rating, output_field=models.FloatField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helpdesk', '0029_ticketcc_ticket_user_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='kbitem',
+            name='rating',
+            field=models.FloatField(db_index=True, default=0.5, editable=False, help_text='Share of positive votes, counting one positive and one negative vote more so that items with few votes do not outrank well reviewed ones - updated automatically.', verbose_name='Rating'),
+        ),
+        migrations.AlterIndexTogether(
+            name='kbitem',
+            index_together=set([('category', 'rating')]),
+        ),
+        migrations.RunPython(rate_items, reverse_code=migrations.RunPython.noop),
+    ]
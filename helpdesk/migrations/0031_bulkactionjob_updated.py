@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('helpdesk', '0030_kbitem_rating'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bulkactionjob',
+            name='updated',
+            field=models.DateTimeField(default=django.utils.timezone.now, help_text='When the worker running this job last saved its progress.', verbose_name='Updated'),
+        ),
+    ]
@@ -9,18 +9,146 @@ models.py - Model (and hence database) definitions. This is the core of the
 
 from __future__ import unicode_literals
 
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal, InvalidOperation
+import json
 import re
+from uuid import uuid4
 
-from django.contrib.auth.models import Permission
+from django.contrib.auth.models import Group, Permission
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.validators import validate_comma_separated_integer_list, _lazy_re_compile, RegexValidator
-from django.db import models
+from django.db import connection, models, transaction
 from django.conf import settings
 from django.db.models import Q
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from django.utils.translation import ugettext_lazy as _, ugettext
-from django.utils.encoding import python_2_unicode_compatible
+from django.utils.encoding import force_text, python_2_unicode_compatible
+
+from helpdesk import settings as helpdesk_settings
+
+
+# The base URL of the current Site, once looked up. Emptied whenever a Site
+# changes.
+_site_base_url = {}
+
+
+def get_site_base_url():
+    """
+    Returns the base URL (eg 'http://helpdesk.example.com') used to build
+    absolute links to tickets in e-mails and feeds. The current Site is
+    looked up once per process, and again after any Site is changed.
+    """
+    if 'url' not in _site_base_url:
+        from django.contrib.sites.models import Site
+        try:
+            site = Site.objects.get_current()
+        except:
+            site = Site(domain='configure-django-sites.com')
+        _site_base_url['url'] = u'http://%s' % site.domain
+    return _site_base_url['url']
+
+
+def clear_site_base_url(sender, **kwargs):
+    _site_base_url.clear()
+
+models.signals.post_save.connect(clear_site_base_url, sender='sites.Site')
+models.signals.post_delete.connect(clear_site_base_url, sender='sites.Site')
+
+
+def cache_version(key):
+    """
+    The current version stored in the cache under key, set up if missing.
+    Per-process caches keep the version they were loaded for, and load
+    again once another process bumps it with new_cache_version().
+    """
+    version = cache.get(key)
+    if version is None:
+        version = uuid4().hex
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def new_cache_version(key):
+    cache.set(key, uuid4().hex, None)
+
+
+class QueueManager(models.Manager):
+    """
+    Resolves which queues a user may access when
+    HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION is enabled. The ids are worked
+    out once per request (they are kept on the user object) and stored in
+    the cache for other requests until a queue, group, or permission
+    assignment changes.
+    """
+
+    PERMISSION_VERSION_KEY = 'helpdesk_queue_permissions_version'
+
+    def clear_permission_cache(self):
+        """Invalidate the accessible queue ids cached for every user."""
+        new_cache_version(self.PERMISSION_VERSION_KEY)
+
+    def _permission_version(self):
+        return cache_version(self.PERMISSION_VERSION_KEY)
+
+    def limited_for_user(self, user):
+        """Is the user restricted to the queues they have a permission for?"""
+        return helpdesk_settings.HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION and not user.is_superuser
+
+    def accessible_ids(self, user):
+        """
+        Returns a frozenset of the ids of the queues the user can access.
+        """
+        if not self.limited_for_user(user):
+            return frozenset(self.values_list('pk', flat=True))
+
+        ids = getattr(user, '_helpdesk_queue_ids', None)
+        if ids is not None:
+            return ids
+
+        key = None
+        timeout = helpdesk_settings.HELPDESK_QUEUE_PERMISSION_CACHE_TIMEOUT
+        if timeout and user.pk is not None:
+            key = 'helpdesk_queue_ids_%s_%s_%d' % (self._permission_version(), user.pk, user.is_active)
+            ids = cache.get(key)
+
+        if ids is None:
+            ids = frozenset(
+                pk for pk, permission_name in self.values_list('pk', 'permission_name')
+                if permission_name and user.has_perm(permission_name))
+            if key is not None:
+                cache.set(key, ids, timeout)
+
+        user._helpdesk_queue_ids = ids
+        return ids
+
+    def for_user(self, user):
+        """Returns a queryset of the queues the user can access."""
+        if not self.limited_for_user(user):
+            return self.all()
+        return self.filter(pk__in=self.accessible_ids(user))
+
+    def user_filter(self, user, field='queue'):
+        """
+        Returns a Q object limiting a queryset to rows whose `field` is a
+        queue the user can access, eg Ticket.objects.filter(
+        Queue.objects.user_filter(user)).
+        """
+        if not self.limited_for_user(user):
+            return Q()
+        return Q(**{'%s__in' % field: self.accessible_ids(user)})
+
+    def has_access(self, user, queue):
+        """Can the user access the given queue (or queue id)?"""
+        if not self.limited_for_user(user):
+            return True
+        return getattr(queue, 'pk', queue) in self.accessible_ids(user)
 
 
 @python_2_unicode_compatible
@@ -266,6 +394,8 @@ class Queue(models.Model):
         verbose_name=_('Default owner'),
     )
 
+    objects = QueueManager()
+
     def __str__(self):
         return "%s" % self.title
 
@@ -344,6 +474,87 @@ class Queue(models.Model):
                 pass
 
 
+def clear_queue_permissions(sender, **kwargs):
+    Queue.objects.clear_permission_cache()
+
+
+def clear_queue_permissions_m2m(sender, instance, model, action, **kwargs):
+    # users joining or leaving groups, and permissions granted to or revoked
+    # from users or groups, are all many-to-many changes
+    if action in ('post_add', 'post_remove', 'post_clear') and (
+            model in (Group, Permission) or isinstance(instance, (Group, Permission))):
+        Queue.objects.clear_permission_cache()
+
+models.signals.post_save.connect(clear_queue_permissions, sender=Queue)
+models.signals.post_delete.connect(clear_queue_permissions, sender=Queue)
+models.signals.post_delete.connect(clear_queue_permissions, sender=Group)
+models.signals.post_delete.connect(clear_queue_permissions, sender=Permission)
+models.signals.m2m_changed.connect(clear_queue_permissions_m2m)
+
+
+class TicketManager(models.Manager):
+
+    def refresh_open_dependency_counts(self, tickets=None):
+        """
+        Recount the open dependencies of the tickets of the queryset (all
+        the tickets by default). The counts are read by one aggregate query
+        and written by one UPDATE per count, only to the tickets whose count
+        changed: MySQL refuses an UPDATE whose values are read from the
+        table being updated.
+        """
+        if tickets is None:
+            tickets = self.all()
+        counts = dict(TicketDependency.objects.filter(
+            ticket__in=tickets,
+            depends_on__status__in=Ticket.OPEN_STATUSES,
+        ).order_by().values_list('ticket').annotate(models.Count('pk')))
+        current = dict(tickets.filter(open_dependency_count__gt=0).values_list('pk', 'open_dependency_count'))
+
+        changed = defaultdict(list)
+        for pk in set(counts) | set(current):
+            count = counts.get(pk, 0)
+            if current.get(pk, 0) != count:
+                changed[count].append(pk)
+        updated = 0
+        for count, ids in changed.items():
+            updated += self.filter(pk__in=ids).update(open_dependency_count=count)
+        return updated
+
+    def refresh_dependents(self, ticket_ids):
+        """
+        Recount the open dependencies of the tickets which depend on the
+        given tickets, eg after their status changed.
+        """
+        return self.refresh_open_dependency_counts(self.filter(ticketdependency__depends_on__in=ticket_ids))
+
+    def dependency_ids(self, ticket_id):
+        """
+        Returns the set of the ids of the tickets the ticket depends on,
+        directly or through a chain of dependencies. This is one recursive
+        query where the database supports them, and one query per level of
+        the chain elsewhere.
+        """
+        if connection.vendor in ('postgresql', 'sqlite'):
+            table = connection.ops.quote_name(TicketDependency._meta.db_table)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    'WITH RECURSIVE dependencies(id) AS ('
+                    ' SELECT depends_on_id FROM {0} WHERE ticket_id = %s'
+                    ' UNION'
+                    ' SELECT d.depends_on_id FROM {0} d JOIN dependencies ON d.ticket_id = dependencies.id'
+                    ') SELECT id FROM dependencies'.format(table),
+                    [ticket_id])
+                return set(row[0] for row in cursor.fetchall())
+
+        found = set()
+        level = {ticket_id}
+        while level:
+            level = set(TicketDependency.objects.filter(ticket__in=level).values_list(
+                'depends_on', flat=True)) - found
+            found |= level
+        return found
+
+
 class Ticket(models.Model):
     """
     To allow a ticket to be entered as quickly as possible, only the
@@ -375,6 +586,9 @@ class Ticket(models.Model):
         (DUPLICATE_STATUS, _('Duplicate')),
     )
 
+    # statuses of the tickets which keep those depending on them open
+    OPEN_STATUSES = (OPEN_STATUS, REOPENED_STATUS)
+
     PRIORITY_CRITICAL = 1
     PRIORITY_HIGH = 2
     PRIORITY_NORMAL = 3
@@ -481,6 +695,16 @@ class Ticket(models.Model):
                     'automatically by management/commands/escalate_tickets.py.'),
     )
 
+    open_dependency_count = models.PositiveIntegerField(
+        _('Open dependencies'),
+        default=0,
+        editable=False,
+        help_text=_('Number of the tickets this ticket depends on which are '
+                    'still open - updated automatically.'),
+    )
+
+    objects = TicketManager()
+
     def _get_assigned_to(self):
         """ Custom property to allow us to easily print 'Unassigned' if a
         ticket has no owner, or the users name if it's assigned. If the user
@@ -533,42 +757,34 @@ class Ticket(models.Model):
         return u'%s%s%s' % (self.get_status_display(), held_msg, dep_msg)
     get_status = property(_get_status)
 
-    def _get_ticket_url(self):
+    def get_ticket_url(self, base_url=None):
         """
         Returns a publicly-viewable URL for this ticket, used when giving
-        a URL to the submitter of a ticket.
+        a URL to the submitter of a ticket. base_url defaults to the URL of
+        the current Site, see get_site_base_url().
         """
-        from django.contrib.sites.models import Site
         from django.core.urlresolvers import reverse
-        try:
-            site = Site.objects.get_current()
-        except:
-            site = Site(domain='configure-django-sites.com')
-        return u"http://%s%s?ticket=%s&email=%s" % (
-            site.domain,
+        return u"%s%s?ticket=%s&email=%s" % (
+            base_url or get_site_base_url(),
             reverse('helpdesk:public_view'),
             self.ticket_for_url,
             self.submitter_email
         )
-    ticket_url = property(_get_ticket_url)
+    ticket_url = property(get_ticket_url)
 
-    def _get_staff_url(self):
+    def get_staff_url(self, base_url=None):
         """
         Returns a staff-only URL for this ticket, used when giving a URL to
-        a staff member (in emails etc)
+        a staff member (in emails etc). base_url defaults to the URL of the
+        current Site, see get_site_base_url().
         """
-        from django.contrib.sites.models import Site
         from django.core.urlresolvers import reverse
-        try:
-            site = Site.objects.get_current()
-        except:
-            site = Site(domain='configure-django-sites.com')
-        return u"http://%s%s" % (
-            site.domain,
+        return u"%s%s" % (
+            base_url or get_site_base_url(),
             reverse('helpdesk:view',
                     args=[self.id])
         )
-    staff_url = property(_get_staff_url)
+    staff_url = property(get_staff_url)
 
     def _can_be_resolved(self):
         """
@@ -576,23 +792,32 @@ class Ticket(models.Model):
         True = any dependencies are resolved
         False = There are non-resolved dependencies
         """
-        OPEN_STATUSES = (Ticket.OPEN_STATUS, Ticket.REOPENED_STATUS)
-        return TicketDependency.objects.filter(ticket=self).filter(
-            depends_on__status__in=OPEN_STATUSES).count() == 0
+        return self.open_dependency_count == 0
     can_be_resolved = property(_can_be_resolved)
 
+    def get_blocking_tickets(self):
+        """
+        The open tickets which keep this one from being resolved, whether
+        it depends on them directly or through other tickets.
+        """
+        return Ticket.objects.filter(
+            id__in=Ticket.objects.dependency_ids(self.id),
+            status__in=Ticket.OPEN_STATUSES,
+        )
+
     def _get_notifications(self):
-        priorities_filter = Q(priorities__isnull=True) | Q(priorities='') | Q(
-            priorities__contains='{},'.format(self.priority))
-        statuses_filter = Q(statuses__isnull=True) | Q(statuses='') | Q(statuses__contains='{},'.format(self.status))
-        queues_filter = Q(queues=self.queue) | Q(queues__isnull=True)
-        return TicketNotification.objects.filter(priorities_filter, statuses_filter, queues_filter)
+        return TicketNotification.objects.for_ticket(self)
 
     notifications = property(_get_notifications)
 
-    def send_notifications(self, fail_silently=True):
-        for n in self.notifications:
-            n.notify(self, fail_silently=fail_silently)
+    def send_notifications(self, fail_silently=True, context=None):
+        # every notification of the event is rendered from the same context
+        notifications = list(self.notifications)
+        if notifications and context is None:
+            from helpdesk.lib import safe_template_context
+            context = safe_template_context(self)
+        for n in notifications:
+            n.notify(self, fail_silently=fail_silently, context=context)
 
     class Meta:
         get_latest_by = "created"
@@ -607,6 +832,13 @@ class Ticket(models.Model):
         return 'helpdesk:view', (self.id,)
     get_absolute_url = models.permalink(get_absolute_url)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        ticket = super(Ticket, cls).from_db(db, field_names, values)
+        # kept to tell whether save() changes the status
+        ticket._loaded_status = ticket.__dict__.get('status')
+        return ticket
+
     def save(self, *args, **kwargs):
         if not self.id:
             # This is a new ticket as no ID yet exists.
@@ -617,8 +849,25 @@ class Ticket(models.Model):
 
         self.modified = timezone.now()
 
+        update_fields = kwargs.get('update_fields')
+        status_changed = self.id and getattr(self, '_loaded_status', None) != self.status and (
+            update_fields is None or 'status' in update_fields)
+
+        if not self._state.adding and not kwargs.get('force_insert'):
+            # open_dependency_count is only written by its own UPDATEs, the
+            # value loaded with this instance may be out of date
+            if update_fields is None:
+                deferred = self.get_deferred_fields()
+                update_fields = [f.name for f in self._meta.concrete_fields
+                                 if not f.primary_key and f.attname not in deferred]
+            kwargs['update_fields'] = [f for f in update_fields if f != 'open_dependency_count']
+
         super(Ticket, self).save(*args, **kwargs)
 
+        self._loaded_status = self.status
+        if status_changed:
+            Ticket.objects.refresh_dependents([self.id])
+
     @staticmethod
     def queue_and_id_from_query(query):
         # Apply the opposite logic here compared to self._get_ticket_for_url
@@ -737,10 +986,17 @@ class FollowUp(models.Model):
         return u"%s#followup%s" % (self.ticket.get_absolute_url(), self.id)
 
     def save(self, *args, **kwargs):
-        t = self.ticket
-        t.modified = timezone.now()
-        t.save()
+        """
+        Saving a follow-up marks its ticket as modified, with an UPDATE of
+        that column only. Pass touch_ticket=False when the ticket is saved
+        afterwards anyway, so it is written once.
+        """
+        touch_ticket = kwargs.pop('touch_ticket', True)
         super(FollowUp, self).save(*args, **kwargs)
+        if touch_ticket:
+            t = self.ticket
+            t.modified = timezone.now()
+            Ticket.objects.filter(pk=t.pk).update(modified=t.modified)
 
 
 @python_2_unicode_compatible
@@ -889,6 +1145,91 @@ class PreSetReply(models.Model):
         return '%s' % self.name
 
 
+class BusinessCalendar(object):
+    """
+    The dates on which escalation should not happen, kept as one sorted list
+    per queue (each including the exclusions that apply to every queue), so
+    that counting the business days between two dates is a pair of binary
+    searches rather than one query per day.
+
+    All arguments are datetime.date instances; queue may be a Queue, a queue
+    id or None for the exclusions that apply to every queue.
+    """
+
+    def __init__(self, exclusions=()):
+        # exclusions is an iterable of (date, queue id) pairs, with a queue
+        # id of None for the exclusions that apply to every queue
+        global_dates = set()
+        queue_dates = {}
+        for day, queue_id in exclusions:
+            if queue_id is None:
+                global_dates.add(day)
+            else:
+                queue_dates.setdefault(queue_id, set()).add(day)
+
+        self.dates = sorted(global_dates)
+        self.queue_dates = dict(
+            (queue_id, sorted(global_dates | dates)) for queue_id, dates in queue_dates.items())
+
+    def excluded_dates(self, queue=None):
+        queue_id = getattr(queue, 'pk', queue)
+        return self.queue_dates.get(queue_id, self.dates)
+
+    def excluded_between(self, start, end, queue=None):
+        """
+        Number of excluded dates d with start <= d < end.
+        """
+        dates = self.excluded_dates(queue)
+        return max(bisect_left(dates, end) - bisect_left(dates, start), 0)
+
+    def is_business_day(self, day, queue=None):
+        return self.excluded_between(day, day + timedelta(days=1), queue) == 0
+
+    def business_days_between(self, start, end, queue=None):
+        """
+        Number of business days d with start <= d < end.
+        """
+        if end <= start:
+            return 0
+        return (end - start).days - self.excluded_between(start, end, queue)
+
+    def add_business_days(self, start, days, queue=None):
+        """
+        The date which is `days` business days after `start`, eg to compute
+        a due date.
+        """
+        one_day = timedelta(days=1)
+        end = start + timedelta(days=days)
+        # every excluded date passed over pushes the end back by a day
+        pending = self.excluded_between(start + one_day, end + one_day, queue)
+        while pending:
+            new_end = end + timedelta(days=pending)
+            pending = self.excluded_between(end + one_day, new_end + one_day, queue)
+            end = new_end
+        return end
+
+
+# The BusinessCalendar of all escalation exclusions, once loaded. Emptied
+# whenever an EscalationExclusion changes.
+_business_calendar = {}
+
+
+class EscalationExclusionManager(models.Manager):
+
+    def clear_calendar_cache(self):
+        _business_calendar.clear()
+
+    def calendar(self):
+        """
+        Returns the BusinessCalendar of every exclusion. The exclusions are
+        loaded with a single query the first time this is called, and kept
+        until an EscalationExclusion is changed.
+        """
+        if 'calendar' not in _business_calendar:
+            _business_calendar['calendar'] = BusinessCalendar(self.values_list('date', 'queues'))
+        return _business_calendar['calendar']
+
+
 @python_2_unicode_compatible
 class EscalationExclusion(models.Model):
     """
@@ -918,6 +1259,8 @@ class EscalationExclusion(models.Model):
         help_text=_('Date on which escalation should not happen'),
     )
 
+    objects = EscalationExclusionManager()
+
     def __str__(self):
         return '%s' % self.name
 
@@ -926,6 +1269,14 @@ class EscalationExclusion(models.Model):
         verbose_name_plural = _('Escalation exclusions')
 
 
+def clear_business_calendar(sender, **kwargs):
+    EscalationExclusion.objects.clear_calendar_cache()
+
+models.signals.post_save.connect(clear_business_calendar, sender=EscalationExclusion)
+models.signals.post_delete.connect(clear_business_calendar, sender=EscalationExclusion)
+models.signals.m2m_changed.connect(clear_business_calendar, sender=EscalationExclusion.queues.through)
+
+
 @python_2_unicode_compatible
 class EmailTemplate(models.Model):
     """
@@ -1048,6 +1399,48 @@ class KBCategory(models.Model):
     get_absolute_url = models.permalink(get_absolute_url)
 
 
+class KBItemManager(models.Manager):
+
+    def cache_key(self, category_id):
+        return 'helpdesk_kb_top_items_%s' % (category_id or 'all')
+
+    def clear_top_items(self, *category_ids):
+        cache.delete_many([self.cache_key(c) for c in set(category_ids)] + [self.cache_key(None)])
+
+    def vote(self, item, recommended):
+        """
+        Counts a vote for the item with UPDATEs of the counters, so
+        concurrent votes are not lost and the rest of the row is not written
+        again.
+        """
+        items = self.filter(pk=item.pk)
+        rating = (models.F('recommendations') + 1.0) / (models.F('votes') + 2.0)
+        with transaction.atomic():
+            items.update(votes=models.F('votes') + 1,
+                         recommendations=models.F('recommendations') + (1 if recommended else 0))
+            # separately, as MySQL would use the new counts in the first
+            # UPDATE and other databases the old ones
+            items.update(rating=models.ExpressionWrapper(rating, output_field=models.FloatField()))
+        self.clear_top_items(item.category_id)
+
+    def top_items(self, category=None):
+        """
+        The HELPDESK_KB_TOP_ITEMS best rated items which have been voted on,
+        of a category or of the whole knowledgebase. They are kept in the
+        cache until an item of the category changes.
+        """
+        category_id = getattr(category, 'pk', category)
+        key = self.cache_key(category_id)
+        items = cache.get(key)
+        if items is None:
+            items = self.filter(votes__gt=0).order_by('-rating', '-votes', 'title')
+            if category_id:
+                items = items.filter(category=category_id)
+            items = list(items[:helpdesk_settings.HELPDESK_KB_TOP_ITEMS])
+            cache.set(key, items, helpdesk_settings.HELPDESK_KB_TOP_ITEMS_CACHE_TIMEOUT)
+        return items
+
+
 @python_2_unicode_compatible
 class KBItem(models.Model):
     """
@@ -1090,10 +1483,30 @@ class KBItem(models.Model):
         blank=True,
     )
 
+    rating = models.FloatField(
+        _('Rating'),
+        help_text=_('Share of positive votes, counting one positive and one negative vote more so that items '
+                    'with few votes do not outrank well reviewed ones - updated automatically.'),
+        default=0.5,
+        db_index=True,
+        editable=False,
+    )
+
+    objects = KBItemManager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        item = super(KBItem, cls).from_db(db, field_names, values)
+        # kept to clear the top items of the category an item is moved from
+        item._loaded_category_id = item.__dict__.get('category_id')
+        return item
+
     def save(self, *args, **kwargs):
         if not self.last_updated:
             self.last_updated = timezone.now()
-        return super(KBItem, self).save(*args, **kwargs)
+        self.rating = (self.recommendations + 1.0) / (self.votes + 2.0)
+        super(KBItem, self).save(*args, **kwargs)
+        self._loaded_category_id = self.category_id
 
     def _score(self):
         if self.votes > 0:
@@ -1107,6 +1520,7 @@ class KBItem(models.Model):
 
     class Meta:
         ordering = ('title',)
+        index_together = (('category', 'rating'),)
         verbose_name = _('Knowledge base item')
         verbose_name_plural = _('Knowledge base items')
 
@@ -1115,6 +1529,14 @@ class KBItem(models.Model):
     get_absolute_url = models.permalink(get_absolute_url)
 
 
+def clear_kb_top_items(sender, instance, **kwargs):
+    KBItem.objects.clear_top_items(instance.category_id,
+                                   getattr(instance, '_loaded_category_id', instance.category_id))
+
+models.signals.post_save.connect(clear_kb_top_items, sender=KBItem)
+models.signals.post_delete.connect(clear_kb_top_items, sender=KBItem)
+
+
 @python_2_unicode_compatible
 class SavedSearch(models.Model):
     """
@@ -1161,6 +1583,39 @@ class SavedSearch(models.Model):
         verbose_name_plural = _('Saved searches')
 
 
+class UserSettingsManager(models.Manager):
+
+    def cache_key(self, user_id):
+        return 'helpdesk_user_settings_%s' % user_id
+
+    def clear_cache(self, user_id):
+        cache.delete(self.cache_key(user_id))
+
+    def settings_for(self, user):
+        """
+        Returns the settings dictionary of a user. It is decoded at most once
+        per request (the result is kept on the user object), and stored in
+        the cache for later requests until the user's settings are saved.
+
+        Raises UserSettings.DoesNotExist if the user has no settings.
+        """
+        data = getattr(user, '_helpdesk_settings', None)
+        if data is not None:
+            return data
+
+        key = self.cache_key(user.pk)
+        timeout = helpdesk_settings.HELPDESK_USER_SETTINGS_CACHE_TIMEOUT
+        if timeout:
+            data = cache.get(key)
+        if data is None:
+            data = user.usersettings_helpdesk.settings
+            if timeout:
+                cache.set(key, data, timeout)
+
+        user._helpdesk_settings = data
+        return data
+
+
 @python_2_unicode_compatible
 class UserSettings(models.Model):
     """
@@ -1168,44 +1623,42 @@ class UserSettings(models.Model):
     as notification preferences and other things that should probably be
     configurable.
 
-    We should always refer to user.usersettings_helpdesk.settings['setting_name'].
+    We should always refer to UserSettings.objects.settings_for(user)['setting_name'],
+    or to user.usersettings_helpdesk.settings['setting_name'] to change them.
     """
 
     user = models.OneToOneField(
         settings.AUTH_USER_MODEL,
         related_name="usersettings_helpdesk")
 
-    settings_pickled = models.TextField(
+    settings_json = models.TextField(
         _('Settings Dictionary'),
-        help_text=_('This is a base64-encoded representation of a pickled Python dictionary. '
+        help_text=_('This is a JSON representation of a Python dictionary. '
                     'Do not change this field via the admin.'),
         blank=True,
         null=True,
     )
 
+    objects = UserSettingsManager()
+
     def _set_settings(self, data):
         # data should always be a Python dictionary.
-        try:
-            import pickle
-        except ImportError:
-            import cPickle as pickle
-        from helpdesk.lib import b64encode
-        self.settings_pickled = b64encode(pickle.dumps(data))
+        self.settings_json = json.dumps(data)
+        self._settings = json.loads(self.settings_json)
 
     def _get_settings(self):
-        # return a python dictionary representing the pickled data.
-        try:
-            import pickle
-        except ImportError:
-            import cPickle as pickle
-        from helpdesk.lib import b64decode
-        try:
-            return pickle.loads(b64decode(str(self.settings_pickled)))
-        except pickle.UnpicklingError:
-            return {}
+        # return a python dictionary representing the JSON data, decoded
+        # only the first time it is needed.
+        if self.__dict__.get('_settings') is None:
+            try:
+                data = json.loads(self.settings_json or '{}')
+            except ValueError:
+                data = {}
+            self._settings = data if isinstance(data, dict) else {}
+        return self._settings
 
     def update_setting(self, data, commit=True):
-        settings = self.settings
+        settings = dict(self.settings)
         settings.update(data)
         self.settings = settings
         if commit:
@@ -1214,6 +1667,11 @@ class UserSettings(models.Model):
 
     settings = property(_get_settings, _set_settings)
 
+    def save(self, *args, **kwargs):
+        super(UserSettings, self).save(*args, **kwargs)
+        # forget the copy kept for the current request
+        self.user.__dict__.pop('_helpdesk_settings', None)
+
     def __str__(self):
         return 'Preferences for %s' % self.user
 
@@ -1222,6 +1680,13 @@ class UserSettings(models.Model):
         verbose_name_plural = _('User Settings')
 
 
+def clear_usersettings_cache(sender, instance, **kwargs):
+    UserSettings.objects.clear_cache(instance.user_id)
+
+models.signals.post_save.connect(clear_usersettings_cache, sender=UserSettings)
+models.signals.post_delete.connect(clear_usersettings_cache, sender=UserSettings)
+
+
 def create_usersettings(sender, instance, created, **kwargs):
     """
     Helper function to create UserSettings instances as
@@ -1238,6 +1703,102 @@ def create_usersettings(sender, instance, created, **kwargs):
 models.signals.post_save.connect(create_usersettings, sender=settings.AUTH_USER_MODEL)
 
 
+class IgnoreEmailMatcher(object):
+    """
+    A compiled form of a set of IgnoreEmail rules, so that checking a sender
+    costs a handful of dictionary lookups rather than one IgnoreEmail.test()
+    call per rule. The rules are indexed by exact address, by domain (for
+    '*@domain.com' rules), by local part (for 'postmaster@*' rules) plus a
+    single global wildcard ('*@*').
+
+    If several rules match, the one that was created first wins, which is
+    the same rule the old queryset loop would have stopped at.
+    """
+
+    def __init__(self, rules=()):
+        self.exact = {}
+        self.domains = {}
+        self.local_parts = {}
+        self.wildcard = None
+        for rule in rules:
+            self.add(*rule)
+
+    @staticmethod
+    def _first(current, candidate):
+        if current is None or candidate[0] < current[0]:
+            return candidate
+        return current
+
+    def add(self, pk, email_address, keep_in_mailbox):
+        entry = (pk, keep_in_mailbox)
+        self.exact[email_address] = self._first(self.exact.get(email_address), entry)
+
+        own_parts = email_address.split("@")
+        if len(own_parts) < 2:
+            return
+        if own_parts[0] == "*" and own_parts[1] == "*":
+            self.wildcard = self._first(self.wildcard, entry)
+        if own_parts[0] == "*":
+            self.domains[own_parts[1]] = self._first(self.domains.get(own_parts[1]), entry)
+        if own_parts[1] == "*":
+            self.local_parts[own_parts[0]] = self._first(self.local_parts.get(own_parts[0]), entry)
+
+    def match(self, email):
+        """
+        Returns None if the e-mail address is not ignored, otherwise the
+        'keep_in_mailbox' flag of the matching rule.
+        """
+        email_parts = email.split("@")
+        candidates = [
+            self.exact.get(email),
+            self.local_parts.get(email_parts[0]),
+            self.wildcard,
+        ]
+        if len(email_parts) > 1:
+            candidates.append(self.domains.get(email_parts[1]))
+
+        found = None
+        for candidate in candidates:
+            if candidate is not None:
+                found = self._first(found, candidate)
+        return None if found is None else found[1]
+
+
+# Compiled IgnoreEmail rules, keyed by queue id (None holds the rules that
+# apply to every queue). Emptied whenever an IgnoreEmail changes.
+_ignore_email_matchers = {}
+
+
+class IgnoreEmailManager(models.Manager):
+
+    def clear_matcher_cache(self):
+        _ignore_email_matchers.clear()
+
+    def _compile_matchers(self):
+        global_rules = []
+        queue_rules = {}
+        rows = self.order_by('pk').values_list('pk', 'email_address', 'keep_in_mailbox', 'queues')
+        for pk, email_address, keep_in_mailbox, queue_id in rows:
+            if queue_id is None:
+                global_rules.append((pk, email_address, keep_in_mailbox))
+            else:
+                queue_rules.setdefault(queue_id, []).append((pk, email_address, keep_in_mailbox))
+
+        _ignore_email_matchers[None] = IgnoreEmailMatcher(global_rules)
+        for queue_id, rules in queue_rules.items():
+            _ignore_email_matchers[queue_id] = IgnoreEmailMatcher(global_rules + rules)
+
+    def matcher_for_queue(self, queue):
+        """
+        Returns an IgnoreEmailMatcher holding every rule that applies to
+        the given queue. All rules are loaded with a single query the first
+        time this is called, and kept until an IgnoreEmail is changed.
+        """
+        if not _ignore_email_matchers:
+            self._compile_matchers()
+        return _ignore_email_matchers.get(queue.pk, _ignore_email_matchers[None])
+
+
 @python_2_unicode_compatible
 class IgnoreEmail(models.Model):
     """
@@ -1249,6 +1810,8 @@ class IgnoreEmail(models.Model):
         verbose_name = _('Ignored e-mail address')
         verbose_name_plural = _('Ignored e-mail addresses')
 
+    objects = IgnoreEmailManager()
+
     queues = models.ManyToManyField(
         Queue,
         blank=True,
@@ -1325,6 +1888,14 @@ class IgnoreEmail(models.Model):
             return False
 
 
+def clear_ignore_email_matchers(sender, **kwargs):
+    IgnoreEmail.objects.clear_matcher_cache()
+
+models.signals.post_save.connect(clear_ignore_email_matchers, sender=IgnoreEmail)
+models.signals.post_delete.connect(clear_ignore_email_matchers, sender=IgnoreEmail)
+models.signals.m2m_changed.connect(clear_ignore_email_matchers, sender=IgnoreEmail.queues.through)
+
+
 @python_2_unicode_compatible
 class TicketCC(models.Model):
     """
@@ -1387,12 +1958,48 @@ class TicketCC(models.Model):
     def __str__(self):
         return '%s for %s' % (self.display, self.ticket.title)
 
+    class Meta:
+        index_together = (('ticket', 'user'),)
+
+
+# the CustomFields, in order, loaded by CustomField.objects.cached(), with the
+# version of the fields they were loaded for
+_custom_fields = {}
+
 
 class CustomFieldManager(models.Manager):
 
+    FIELDS_VERSION_KEY = 'helpdesk_custom_fields_version'
+
     def get_queryset(self):
         return super(CustomFieldManager, self).get_queryset().order_by('ordering')
 
+    def clear_field_cache(self):
+        """Makes every process load the fields again."""
+        new_cache_version(self.FIELDS_VERSION_KEY)
+        _custom_fields.clear()
+
+    def cached(self):
+        """
+        Returns the list of all the CustomFields, in order. They are loaded
+        with a single query the first time this is called, and kept until a
+        CustomField is changed in any process. The instances are shared, do
+        not change them.
+        """
+        version = cache_version(self.FIELDS_VERSION_KEY)
+        if _custom_fields.get('version') != version:
+            fields = list(self.all())
+            for field in fields:
+                # parse the list values once
+                field.choices_as_array
+            _custom_fields['all'] = fields
+            _custom_fields['version'] = version
+        return list(_custom_fields['all'])
+
+    def by_name(self):
+        """The cached CustomFields, keyed by name."""
+        return dict((field.name, field) for field in self.cached())
+
 
 @python_2_unicode_compatible
 class CustomField(models.Model):
@@ -1478,11 +2085,16 @@ class CustomField(models.Model):
     )
 
     def _choices_as_array(self):
-        from django.utils.six import StringIO
-        valuebuffer = StringIO(self.list_values)
-        choices = [[item.strip(), item.strip()] for item in valuebuffer.readlines()]
-        valuebuffer.close()
-        return choices
+        """
+        The list values as a list of [value, label] choices. They are parsed
+        once per instance; each call returns a new list, which callers may
+        change.
+        """
+        choices = self.__dict__.get('_choices')
+        if choices is None or choices[0] != self.list_values:
+            items = [item.strip() for item in (self.list_values or '').splitlines()]
+            choices = self._choices = (self.list_values, items)
+        return [[item, item] for item in choices[1]]
     choices_as_array = property(_choices_as_array)
 
     required = models.BooleanField(
@@ -1500,6 +2112,20 @@ class CustomField(models.Model):
 
     objects = CustomFieldManager()
 
+    def _get_value_column(self):
+        """
+        The indexed TicketCustomFieldValue column holding the values of this
+        field. Multi-line text is only kept in the unindexed `value` column.
+        """
+        if self.data_type in ('integer', 'decimal'):
+            return 'value_number'
+        if self.data_type in ('date', 'datetime'):
+            return 'value_datetime'
+        if self.data_type == 'text':
+            return 'value'
+        return 'value_string'
+    value_column = property(_get_value_column)
+
     def __str__(self):
         return '%s' % self.name
 
@@ -1508,6 +2134,62 @@ class CustomField(models.Model):
         verbose_name_plural = _('Custom fields')
 
 
+def clear_custom_fields(sender, **kwargs):
+    CustomField.objects.clear_field_cache()
+
+models.signals.post_save.connect(clear_custom_fields, sender=CustomField)
+models.signals.post_delete.connect(clear_custom_fields, sender=CustomField)
+
+
+def custom_field_typed_values(data_type, value):
+    """
+    The typed columns of a TicketCustomFieldValue holding `value` for a field
+    of the given data type. Columns which do not apply, or which the value
+    cannot be converted for, are None.
+    """
+    values = dict((column, None) for column in TicketCustomFieldValue.TYPED_COLUMNS)
+    if value is None or value == '':
+        return values
+
+    if data_type in ('integer', 'decimal'):
+        try:
+            number = Decimal(force_text(value).strip())
+        except InvalidOperation:
+            return values
+        if number.is_finite() and abs(number) < 10 ** 20:
+            values['value_number'] = number
+    elif data_type in ('date', 'datetime'):
+        if isinstance(value, datetime):
+            moment = value
+        elif isinstance(value, date):
+            moment = datetime.combine(value, time())
+        else:
+            text = force_text(value).strip()
+            try:
+                moment = parse_datetime(text)
+                if moment is None:
+                    day = parse_date(text)
+                    moment = day and datetime.combine(day, time())
+            except ValueError:
+                moment = None
+        if moment is not None and settings.USE_TZ and timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+        values['value_datetime'] = moment
+    elif data_type != 'text':
+        text = force_text(value)
+        if len(text) <= 255:
+            values['value_string'] = text
+    return values
+
+
+class TicketCustomFieldValueManager(models.Manager):
+
+    def bulk_create(self, objs, *args, **kwargs):
+        for obj in objs:
+            obj.set_typed_values()
+        return super(TicketCustomFieldValueManager, self).bulk_create(objs, *args, **kwargs)
+
+
 @python_2_unicode_compatible
 class TicketCustomFieldValue(models.Model):
     ticket = models.ForeignKey(
@@ -1522,11 +2204,34 @@ class TicketCustomFieldValue(models.Model):
 
     value = models.TextField(blank=True, null=True)
 
+    # The value converted for its field's data type, so tickets can be
+    # filtered and sorted on custom fields through the indexes below rather
+    # than by comparing text. Kept up to date by save() and bulk_create().
+    value_string = models.CharField(max_length=255, blank=True, null=True, editable=False)
+    value_number = models.DecimalField(max_digits=30, decimal_places=10, blank=True, null=True, editable=False)
+    value_datetime = models.DateTimeField(blank=True, null=True, editable=False)
+
+    TYPED_COLUMNS = ('value_string', 'value_number', 'value_datetime')
+
+    objects = TicketCustomFieldValueManager()
+
     def __str__(self):
         return '%s / %s' % (self.ticket, self.field)
 
+    def set_typed_values(self):
+        for column, value in custom_field_typed_values(self.field.data_type, self.value).items():
+            setattr(self, column, value)
+
+    def save(self, *args, **kwargs):
+        self.set_typed_values()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'value' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | set(self.TYPED_COLUMNS)
+        super(TicketCustomFieldValue, self).save(*args, **kwargs)
+
     class Meta:
         unique_together = (('ticket', 'field'),)
+        index_together = (('field', 'value_string'), ('field', 'value_number'), ('field', 'value_datetime'))
         verbose_name = _('Ticket custom field value')
         verbose_name_plural = _('Ticket custom field values')
 
@@ -1559,6 +2264,13 @@ class TicketDependency(models.Model):
         return '%s / %s' % (self.ticket, self.depends_on)
 
 
+def update_open_dependency_count(sender, instance, **kwargs):
+    Ticket.objects.refresh_open_dependency_counts(Ticket.objects.filter(pk=instance.ticket_id))
+
+models.signals.post_save.connect(update_open_dependency_count, sender=TicketDependency)
+models.signals.post_delete.connect(update_open_dependency_count, sender=TicketDependency)
+
+
 @python_2_unicode_compatible
 class TicketTimeTrack(models.Model):
     """
@@ -1617,6 +2329,80 @@ validate_comma_separated_integer_list2 = int_list_validator2(
 )
 
 
+def parse_int_list(value):
+    """
+    Returns the integers of a comma-separated list such as '1,3,' as a
+    frozenset, ignoring anything which is not a number.
+    """
+    values = set()
+    for item in (value or '').split(','):
+        try:
+            values.add(int(item))
+        except ValueError:
+            pass
+    return frozenset(values)
+
+
+class TicketNotificationRules(object):
+    """
+    A compiled form of the TicketNotification rules. Each rule is filed
+    under every (queue, status, priority) combination it applies to, with
+    None standing for 'any', so finding the rules for a ticket takes eight
+    dictionary lookups however many rules exist.
+    """
+
+    def __init__(self, rows=()):
+        # rows are (pk, statuses, priorities, queue id) tuples, with one row
+        # per queue of a rule, or a single row with a queue id of None for
+        # rules which apply to every queue.
+        self.table = {}
+        for pk, statuses, priorities, queue_id in rows:
+            for status in parse_int_list(statuses) or (None,):
+                for priority in parse_int_list(priorities) or (None,):
+                    self.table.setdefault((queue_id, status, priority), set()).add(pk)
+
+    def match(self, queue_id, status, priority):
+        """Returns the sorted ids of the rules matching a ticket."""
+        ids = set()
+        for q in (queue_id, None):
+            for s in (status, None):
+                for p in (priority, None):
+                    ids.update(self.table.get((q, s, p), ()))
+        return sorted(ids)
+
+
+# The compiled TicketNotificationRules and the notifications they refer to,
+# once loaded, with the version of the rules they were loaded for.
+_ticket_notification_rules = {}
+
+
+class TicketNotificationManager(models.Manager):
+
+    RULES_VERSION_KEY = 'helpdesk_ticket_notification_rules_version'
+
+    def clear_rule_cache(self):
+        """Makes every process load the rules again."""
+        new_cache_version(self.RULES_VERSION_KEY)
+        _ticket_notification_rules.clear()
+
+    def for_ticket(self, ticket):
+        """
+        Returns the list of notifications to send when the given ticket is
+        created or updated. The rules are loaded the first time this is
+        called, and kept until a TicketNotification is changed in any
+        process.
+        """
+        version = cache_version(self.RULES_VERSION_KEY)
+        if _ticket_notification_rules.get('version') != version:
+            rules = TicketNotificationRules(self.values_list('pk', 'statuses', 'priorities', 'queues'))
+            _ticket_notification_rules['notifications'] = self.in_bulk()
+            _ticket_notification_rules['rules'] = rules
+            _ticket_notification_rules['version'] = version
+        notifications = _ticket_notification_rules['notifications']
+        ids = _ticket_notification_rules['rules'].match(ticket.queue_id, int(ticket.status), int(ticket.priority))
+        return [notifications[pk] for pk in ids if pk in notifications]
+
+
 @python_2_unicode_compatible
 class TicketNotification(models.Model):
     """
@@ -1646,6 +2432,8 @@ class TicketNotification(models.Model):
         Queue, blank=True,
         help_text=_('Leave blank to be ignored on all queues, or select those queues you wish to be notified.'))
 
+    objects = TicketNotificationManager()
+
     @property
     def priorities_display(self):
         if not self.priorities:
@@ -1672,9 +2460,10 @@ class TicketNotification(models.Model):
 
         return ' | '.join([q.title for q in queues])
 
-    def notify(self, ticket, fail_silently=True):
+    def notify(self, ticket, fail_silently=True, context=None):
         from .lib import send_templated_sms, send_templated_mail, safe_template_context
-        context = safe_template_context(ticket)
+        if context is None:
+            context = safe_template_context(ticket)
         if self.notify_type == self.NOTIFY_TYPE_SMS:
             return send_templated_sms('ticket_notification', context, recipients=[self.to], fail_silently=fail_silently)
         if self.notify_type == self.NOTIFY_TYPE_EMAIL:
@@ -1683,3 +2472,268 @@ class TicketNotification(models.Model):
 
     def __str__(self):
         return '%s' % self.to
+
+
+def clear_ticket_notification_rules(sender, **kwargs):
+    TicketNotification.objects.clear_rule_cache()
+
+models.signals.post_save.connect(clear_ticket_notification_rules, sender=TicketNotification)
+models.signals.post_delete.connect(clear_ticket_notification_rules, sender=TicketNotification)
+models.signals.m2m_changed.connect(clear_ticket_notification_rules, sender=TicketNotification.queues.through)
+
+
+@python_2_unicode_compatible
+class EmailIngestionRun(models.Model):
+    """
+    Counters and timings recorded by the get_email command each time it
+    processes the mailbox of a queue.
+    """
+    class Meta:
+        ordering = ('-started',)
+        verbose_name = _('E-Mail ingestion run')
+        verbose_name_plural = _('E-Mail ingestion runs')
+
+    queue = models.ForeignKey(
+        Queue,
+        verbose_name=_('Queue'),
+        related_name='ingestion_runs',
+        on_delete=models.CASCADE,
+    )
+
+    started = models.DateTimeField(
+        _('Started'),
+        db_index=True,
+    )
+
+    finished = models.DateTimeField(
+        _('Finished'),
+    )
+
+    messages = models.PositiveIntegerField(
+        _('Messages fetched'),
+        default=0,
+    )
+
+    bytes_received = models.BigIntegerField(
+        _('Bytes received'),
+        default=0,
+    )
+
+    tickets_created = models.PositiveIntegerField(
+        _('Tickets created'),
+        default=0,
+    )
+
+    followups_created = models.PositiveIntegerField(
+        _('Follow-ups appended'),
+        default=0,
+    )
+
+    ignored = models.PositiveIntegerField(
+        _('Ignored'),
+        default=0,
+        help_text=_('Messages dropped or kept because of the e-mail ignore list.'),
+    )
+
+    failed = models.PositiveIntegerField(
+        _('Failed'),
+        default=0,
+    )
+
+    network_seconds = models.FloatField(
+        _('Network time'),
+        default=0,
+        help_text=_('Seconds spent talking to the mail server or reading '
+                    'the local mailbox, and sending notifications.'),
+    )
+
+    parse_seconds = models.FloatField(
+        _('Parsing time'),
+        default=0,
+    )
+
+    db_seconds = models.FloatField(
+        _('Database time'),
+        default=0,
+    )
+
+    error = models.TextField(
+        _('Error'),
+        blank=True,
+        help_text=_('The error which aborted this run, if any.'),
+    )
+
+    def __str__(self):
+        return '%s @ %s' % (self.queue, self.started)
+
+
+@python_2_unicode_compatible
+class BulkActionJob(models.Model):
+    """
+    A bulk action on every ticket matching a ticket list query, too large to
+    be done while the user waits. The job is queued by the web views and
+    done in chunks by the process_bulk_jobs command, which records its
+    progress here.
+    """
+    ACTION_ASSIGN = 'assign'
+    ACTION_CLOSE = 'close'
+    ACTION_CLOSE_PUBLIC = 'close_public'
+    ACTION_DELETE = 'delete'
+
+    ACTION_CHOICES = (
+        (ACTION_ASSIGN, _('Assign/Unassign')),
+        (ACTION_CLOSE, _('Close')),
+        (ACTION_CLOSE_PUBLIC, _('Close and e-mail')),
+        (ACTION_DELETE, _('Delete')),
+    )
+
+    PENDING_STATUS = 'pending'
+    RUNNING_STATUS = 'running'
+    DONE_STATUS = 'done'
+    FAILED_STATUS = 'failed'
+
+    STATUS_CHOICES = (
+        (PENDING_STATUS, _('Pending')),
+        (RUNNING_STATUS, _('Running')),
+        (DONE_STATUS, _('Done')),
+        (FAILED_STATUS, _('Failed')),
+    )
+
+    class Meta:
+        ordering = ('-created',)
+        verbose_name = _('Bulk action job')
+        verbose_name_plural = _('Bulk action jobs')
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        verbose_name=_('User'),
+        on_delete=models.CASCADE,
+        help_text=_('The user who asked for the action. Only the tickets '
+                    'of the queues they can access are changed.'),
+    )
+
+    action = models.CharField(
+        _('Action'),
+        max_length=20,
+        choices=ACTION_CHOICES,
+    )
+
+    assigned_to = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        related_name='+',
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+        verbose_name=_('Assign to'),
+        help_text=_('The new owner of the tickets, for the assign action. '
+                    'Leave blank to unassign them.'),
+    )
+
+    query = models.TextField(
+        _('Search Query'),
+        help_text=_('The ticket list filters selecting the tickets, encoded '
+                    'as for saved searches.'),
+    )
+
+    status = models.CharField(
+        _('Status'),
+        max_length=10,
+        choices=STATUS_CHOICES,
+        default=PENDING_STATUS,
+        db_index=True,
+    )
+
+    total = models.PositiveIntegerField(
+        _('Total'),
+        default=0,
+        help_text=_('Number of tickets matching the query when the job started.'),
+    )
+
+    processed = models.PositiveIntegerField(
+        _('Processed'),
+        default=0,
+    )
+
+    changed = models.PositiveIntegerField(
+        _('Changed'),
+        default=0,
+        help_text=_('Processed tickets which the action changed, eg which '
+                    'were not already closed.'),
+    )
+
+    last_ticket_id = models.PositiveIntegerField(
+        _('Last ticket'),
+        default=0,
+        help_text=_('The id of the last processed ticket, from which the '
+                    'next chunk starts.'),
+    )
+
+    created = models.DateTimeField(
+        _('Created'),
+        auto_now_add=True,
+    )
+
+    started = models.DateTimeField(
+        _('Started'),
+        blank=True,
+        null=True,
+    )
+
+    finished = models.DateTimeField(
+        _('Finished'),
+        blank=True,
+        null=True,
+    )
+
+    updated = models.DateTimeField(
+        _('Updated'),
+        default=timezone.now,
+        help_text=_('When the worker running this job last saved its '
+                    'progress.'),
+    )
+
+    error = models.TextField(
+        _('Error'),
+        blank=True,
+        help_text=_('The error which aborted this job, if any.'),
+    )
+
+    def __str__(self):
+        return '%s (%s)' % (self.get_action_display(), self.get_status_display())
+
+    def save_progress(self, *fields):
+        """
+        Save the given fields with a new updated time, unless another worker
+        claimed the job since this one last saved it. Returns whether the job
+        was saved.
+        """
+        now = timezone.now()
+        values = dict((f, getattr(self, f)) for f in fields)
+        saved = BulkActionJob.objects.filter(pk=self.pk, updated=self.updated).update(updated=now, **values)
+        if saved:
+            self.updated = now
+        return bool(saved)
+
+    def _get_progress(self):
+        """Percentage of the tickets processed so far."""
+        if self.status == self.DONE_STATUS:
+            return 100
+        if not self.total:
+            return 0
+        return min(100, self.processed * 100 // self.total)
+    progress = property(_get_progress)
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'action': self.action,
+            'status': self.status,
+            'total': self.total,
+            'processed': self.processed,
+            'changed': self.changed,
+            'progress': self.progress,
+            'created': self.created.isoformat(),
+            'started': self.started.isoformat() if self.started else None,
+            'finished': self.finished.isoformat() if self.finished else None,
+            'error': self.error,
+        }
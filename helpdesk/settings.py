@@ -37,6 +37,16 @@ HELPDESK_REDIRECT_TO_LOGIN_BY_DEFAULT = getattr(settings,
 # show knowledgebase links?
 HELPDESK_KB_ENABLED = getattr(settings, 'HELPDESK_KB_ENABLED', True)
 
+# number of the best rated knowledgebase items shown on the knowledgebase
+# pages, and the number of seconds they are kept in the cache. they are
+# invalidated whenever an item of the category changes.
+HELPDESK_KB_TOP_ITEMS = getattr(settings, 'HELPDESK_KB_TOP_ITEMS', 5)
+HELPDESK_KB_TOP_ITEMS_CACHE_TIMEOUT = getattr(settings, 'HELPDESK_KB_TOP_ITEMS_CACHE_TIMEOUT', 3600)
+
+# number of seconds before the same user, or visitor from the same address,
+# can vote on a knowledgebase item again. 0 counts every vote.
+HELPDESK_KB_VOTE_THROTTLE = getattr(settings, 'HELPDESK_KB_VOTE_THROTTLE', 3600)
+
 # show extended navigation by default, to all users, irrespective of staff status?
 HELPDESK_NAVIGATION_ENABLED = getattr(settings, 'HELPDESK_NAVIGATION_ENABLED', False)
 
@@ -139,9 +149,51 @@ QUEUE_EMAIL_BOX_USER = getattr(settings, 'QUEUE_EMAIL_BOX_USER', None)
 QUEUE_EMAIL_BOX_PASSWORD = getattr(settings, 'QUEUE_EMAIL_BOX_PASSWORD', None)
 QUEUE_EMAIL_BOX_UPDATE_ONLY = getattr(settings, 'QUEUE_EMAIL_BOX_UPDATE_ONLY', False)
 
+# number of worker processes used to read 'local' mailbox directories. with
+# more than one worker, each message file is claimed by renaming it into a
+# 'processing' sub-directory, and messages which could not be processed are
+# moved to a 'quarantine' sub-directory rather than retried on every run.
+QUEUE_EMAIL_BOX_LOCAL_WORKERS = getattr(settings, 'QUEUE_EMAIL_BOX_LOCAL_WORKERS', 1)
+
+# read local message files through mmap rather than a plain read()?
+QUEUE_EMAIL_BOX_LOCAL_MMAP = getattr(settings, 'QUEUE_EMAIL_BOX_LOCAL_MMAP', False)
+
+# number of seconds after which a message file left in the 'processing'
+# sub-directory by a worker which died is moved back to be read again.
+QUEUE_EMAIL_BOX_LOCAL_PROCESSING_TIMEOUT = getattr(settings, 'QUEUE_EMAIL_BOX_LOCAL_PROCESSING_TIMEOUT', 3600)
+
 # only allow users to access queues that they are members of?
 HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION = getattr(
     settings, 'HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION', False)
 
+# number of seconds the ids of the queues a user can access are kept in the
+# cache. they are invalidated whenever queues, groups or permission
+# assignments change, which only reaches the other processes through a
+# shared cache backend. 0 (the default) works them out again on every request.
+HELPDESK_QUEUE_PERMISSION_CACHE_TIMEOUT = getattr(
+    settings, 'HELPDESK_QUEUE_PERMISSION_CACHE_TIMEOUT', 0)
+
+# number of seconds each user's helpdesk settings are kept in the cache. they
+# are invalidated whenever the settings are saved. 0 loads them from the
+# database on every request.
+HELPDESK_USER_SETTINGS_CACHE_TIMEOUT = getattr(
+    settings, 'HELPDESK_USER_SETTINGS_CACHE_TIMEOUT', 3600)
+
+# number of tickets changed by each transaction of a bulk action job.
+HELPDESK_BULK_JOB_CHUNK_SIZE = getattr(
+    settings, 'HELPDESK_BULK_JOB_CHUNK_SIZE', 500)
+
+# number of seconds after which a running bulk action job whose progress was
+# not saved is taken to belong to a dead worker, and is run again.
+HELPDESK_BULK_JOB_STALE_TIMEOUT = getattr(
+    settings, 'HELPDESK_BULK_JOB_STALE_TIMEOUT', 900)
+
+# most recent tickets listed in each of the RSS feeds of tickets.
+HELPDESK_FEED_MAX_ITEMS = getattr(settings, 'HELPDESK_FEED_MAX_ITEMS', 50)
+
+# number of seconds a rendered RSS feed is kept in the cache. a feed is
+# rendered again as soon as its tickets or follow-ups change. 0 disables it.
+HELPDESK_FEED_CACHE_TIMEOUT = getattr(settings, 'HELPDESK_FEED_CACHE_TIMEOUT', 60)
+
 SMS_DEFAULT_FROM_PHONE = getattr(settings, 'SMS_DEFAULT_FROM_PHONE', None)
 HELPDESK_SMS_FALLBACK_LOCALE = getattr(settings, 'HELPDESK_SMS_FALLBACK_LOCALE', 'en')
@@ -15,32 +15,69 @@ import re
 
 from django import template
 from django.core.urlresolvers import reverse
+from django.utils.encoding import force_text
 from django.utils.safestring import mark_safe
 
 from helpdesk.models import Ticket
 
+TICKET_NUMBER_RE = re.compile(r"(?:[^&]|\b|^)#(\d+)\b")
 
-def num_to_link(text):
+
+def ticket_statuses(ids, statuses=None):
+    """
+    Add the status of the tickets with the given ids to the `statuses` dict
+    (keyed by id, None for tickets which do not exist) and return it. Only
+    the ids which are not in the dict yet are looked up, with one query.
+    """
+    if statuses is None:
+        statuses = {}
+    missing = set(ids).difference(statuses)
+    if missing:
+        status_names = dict(Ticket.STATUS_CHOICES)
+        for pk, status in Ticket.objects.filter(id__in=missing).values_list('id', 'status'):
+            statuses[pk] = force_text(status_names.get(status, status))
+        for pk in missing:
+            statuses.setdefault(pk, None)
+    return statuses
+
+
+def ticket_link_statuses(followups):
+    """
+    Look up the status of all the tickets referenced in the comments of the
+    follow-ups at once, for num_to_link to use, eg:
+
+        {% ticket_link_statuses ticket.followup_set.all as link_statuses %}
+        {{ followup.comment|num_to_link:link_statuses }}
+    """
+    ids = set()
+    for followup in followups:
+        ids.update(int(number) for number in TICKET_NUMBER_RE.findall(followup.comment or ''))
+    return ticket_statuses(ids)
+
+
+def num_to_link(text, statuses=None):
     if text == '':
         return text
 
-    matches = []
-    for match in re.finditer(r"(?:[^&]|\b|^)#(\d+)\b", text):
-        matches.append(match)
+    matches = list(TICKET_NUMBER_RE.finditer(text))
+    if not matches:
+        return mark_safe(text)
+    statuses = ticket_statuses([int(match.group(1)) for match in matches], statuses)
 
-    for match in reversed(matches):
-        number = match.groups()[0]
+    parts = []
+    end = 0
+    for match in matches:
+        number = match.group(1)
+        style = statuses[int(number)]
+        if style is None:
+            continue
         url = reverse('helpdesk:view', args=[number])
-        try:
-            ticket = Ticket.objects.get(id=number)
-        except Ticket.DoesNotExist:
-            ticket = None
-
-        if ticket:
-            style = ticket.get_status_display()
-            text = "%s <a href='%s' class='ticket_link_status ticket_link_status_%s'>#%s</a>%s" % (
-                text[:match.start()], url, style, match.groups()[0], text[match.end():])
-    return mark_safe(text)
+        parts.append(text[end:match.start()])
+        parts.append(" <a href='%s' class='ticket_link_status ticket_link_status_%s'>#%s</a>" % (url, style, number))
+        end = match.end()
+    parts.append(text[end:])
+    return mark_safe(''.join(parts))
 
 register = template.Library()
 register.filter(num_to_link)
+register.simple_tag(ticket_link_statuses)
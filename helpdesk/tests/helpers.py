@@ -1,10 +1,44 @@
 # -*- coding: utf-8 -*-
 import sys
 from django.contrib.auth import get_user_model
+from django.contrib.sites.models import Site
+from django.core.cache import cache
 
 User = get_user_model()
 
 
+def clear_helpdesk_caches():
+    """
+    Empty the caches which helpdesk keeps in the process and in Django's
+    cache. The rollback at the end of each test leaves them filled.
+    """
+    from helpdesk.models import (
+        CustomField, EscalationExclusion, IgnoreEmail, TicketNotification, clear_site_base_url,
+    )
+    cache.clear()
+    Site.objects.clear_cache()
+    clear_site_base_url(sender=Site)
+    EscalationExclusion.objects.clear_calendar_cache()
+    IgnoreEmail.objects.clear_matcher_cache()
+    CustomField.objects.clear_field_cache()
+    TicketNotification.objects.clear_rule_cache()
+
+
+class ClearCachesMixin(object):
+    """
+    Mix into a TestCase whose tests must not see, or leave, the helpdesk
+    caches filled by other tests.
+    """
+
+    def _pre_setup(self):
+        super(ClearCachesMixin, self)._pre_setup()
+        clear_helpdesk_caches()
+
+    def _post_teardown(self):
+        clear_helpdesk_caches()
+        super(ClearCachesMixin, self)._post_teardown()
+
+
 def get_staff_user(username='helpdesk.staff', password='password'):
     try:
         user = User.objects.get(username=username)
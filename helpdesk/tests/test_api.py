@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from helpdesk.models import Queue, Ticket
+from helpdesk.tests.helpers import ClearCachesMixin, get_staff_user
+
+
+class TicketAPITestCase(ClearCachesMixin, TestCase):
+
+    def setUp(self):
+        self.staff = get_staff_user()
+        self.queue = Queue.objects.create(title='Queue', slug='q')
+        self.tickets = [
+            Ticket.objects.create(title='Ticket %d' % i, queue=self.queue, priority=1 if i % 2 else 3)
+            for i in range(5)
+        ]
+        self.client.login(username=self.staff.username, password='password')
+
+    def get(self, url, **params):
+        response = self.client.get(url, params)
+        return response, json.loads(response.content.decode())
+
+    def test_list(self):
+        url = reverse('helpdesk:api-tickets')
+        self.get(url)
+        with self.assertNumQueries(3):
+            # session, user, tickets
+            response, data = self.get(url, page_size=2, fields='id,status')
+        self.assertEqual(data['tickets'], [{'id': self.tickets[4].pk, 'status': Ticket.OPEN_STATUS},
+                                           {'id': self.tickets[3].pk, 'status': Ticket.OPEN_STATUS}])
+
+        # keyset pagination carries on from the last ticket
+        response, data = self.get(data['next'])
+        self.assertEqual([t['id'] for t in data['tickets']], [self.tickets[2].pk, self.tickets[1].pk])
+        response, data = self.get(data['next'])
+        self.assertEqual(([t['id'] for t in data['tickets']], data['next']), ([self.tickets[0].pk], None))
+
+        response, data = self.get(url, priority='1', fields='title')
+        self.assertEqual(data['tickets'], [{'title': 'Ticket 3'}, {'title': 'Ticket 1'}])
+
+        self.assertEqual(self.client.get(url, {'fields': 'title,password'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'priority': 'urgent'}).status_code, 400)
+
+    def test_detail(self):
+        ticket = self.tickets[0]
+        url = reverse('helpdesk:api-ticket', args=[ticket.pk])
+        response, data = self.get(url)
+        self.assertEqual((data['ticket']['title'], data['ticket']['queue']), ('Ticket 0', self.queue.pk))
+        response, data = self.get(url, fields='description')
+        self.assertEqual(data, {'ticket': {'description': None}})
+        self.assertEqual(self.client.get(reverse('helpdesk:api-ticket', args=[self.tickets[-1].pk + 1])).status_code,
+                         404)
+
+    def test_etag(self):
+        url = reverse('helpdesk:api-ticket', args=[self.tickets[0].pk])
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.tickets[0].title = 'Renamed'
+        self.tickets[0].save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
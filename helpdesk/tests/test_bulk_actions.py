@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.contrib.auth.models import Permission
+from django.core import mail
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from helpdesk import settings as helpdesk_settings
+from helpdesk.models import Queue, Ticket, FollowUp, TicketCC
+from helpdesk.tests.helpers import get_staff_user, User
+
+
+class BulkActionsTestCase(TestCase):
+
+    fixtures = ['emailtemplate.json']
+
+    def setUp(self):
+        self.staff = get_staff_user()
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'password', is_staff=True)
+        self.queue = Queue.objects.create(title='Queue', slug='q', updated_ticket_cc='queue.cc@example.com')
+        self.tickets = [
+            Ticket.objects.create(title='Ticket %d' % i, queue=self.queue, submitter_email='submitter%d@example.com' % i)
+            for i in range(3)
+        ]
+        self.client.login(username=self.staff.username, password='password')
+
+    def bulk_url(self, name, tickets):
+        return reverse(name, kwargs={'pk': ','.join(str(t.pk) for t in tickets)})
+
+    def test_bulk_assign(self):
+        Ticket.objects.filter(pk=self.tickets[0].pk).update(assigned_to=self.owner)
+        self.client.post(self.bulk_url('helpdesk:tickets-bulk-assign', self.tickets), {'assigned_to': self.owner.pk})
+
+        self.assertEqual(Ticket.objects.filter(assigned_to=self.owner).count(), 3)
+        followups = FollowUp.objects.order_by('ticket')
+        self.assertEqual([f.ticket_id for f in followups], [t.pk for t in self.tickets[1:]])
+        for f in followups:
+            self.assertEqual(f.title, 'Assigned to [owner] in bulk update')
+            self.assertTrue(f.public)
+            self.assertEqual(f.user, self.staff)
+
+        self.client.post(self.bulk_url('helpdesk:tickets-bulk-assign', self.tickets[:1]), {'assigned_to': ''})
+        self.assertIsNone(Ticket.objects.get(pk=self.tickets[0].pk).assigned_to)
+        self.assertEqual(FollowUp.objects.latest('id').title, 'Unassigned in bulk update')
+
+    def test_bulk_assign_queries(self):
+        # the number of queries does not grow with the number of tickets
+        url = self.bulk_url('helpdesk:tickets-bulk-assign', self.tickets[:1])
+        with CaptureQueriesContext(connection) as one:
+            self.client.post(url, {'assigned_to': self.owner.pk})
+        url = self.bulk_url('helpdesk:tickets-bulk-assign', self.tickets[1:])
+        with CaptureQueriesContext(connection) as two:
+            self.client.post(url, {'assigned_to': self.owner.pk})
+        self.assertEqual(len(one), len(two))
+        self.assertEqual(Ticket.objects.filter(assigned_to=self.owner).count(), 3)
+
+    def test_bulk_close(self):
+        closed = self.tickets[2]
+        closed.status = Ticket.CLOSED_STATUS
+        closed.save()
+        TicketCC.objects.create(ticket=self.tickets[0], email='cc@example.com')
+
+        self.client.post(self.bulk_url('helpdesk:tickets-bulk-close', self.tickets), {'send_mail': 'true'})
+
+        self.assertEqual(Ticket.objects.filter(status=Ticket.CLOSED_STATUS).count(), 3)
+        followups = FollowUp.objects.order_by('ticket')
+        self.assertEqual([f.ticket_id for f in followups], [t.pk for t in self.tickets[:2]])
+        self.assertEqual(set((f.title, f.public, f.new_status) for f in followups),
+                         {('Closed in bulk update', True, Ticket.CLOSED_STATUS)})
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), [
+            'cc@example.com', 'queue.cc@example.com', 'queue.cc@example.com',
+            'submitter0@example.com', 'submitter1@example.com',
+        ])
+
+    def test_bulk_delete_without_access(self):
+        other_queue = Queue.objects.create(title='Other', slug='other')
+        other = Ticket.objects.create(title='Other', queue=other_queue)
+        self.staff.user_permissions.add(Permission.objects.get(codename=self.queue.permission_name[9:]))
+
+        enabled = helpdesk_settings.HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION
+        helpdesk_settings.HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION = True
+        try:
+            self.client.post(self.bulk_url('helpdesk:tickets-bulk-delete', self.tickets[:2] + [other]))
+        finally:
+            helpdesk_settings.HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION = enabled
+
+        self.assertEqual(set(Ticket.objects.values_list('pk', flat=True)), {self.tickets[2].pk, other.pk})
+
+    def test_mass_update(self):
+        ids = [t.pk for t in self.tickets]
+        self.client.post(reverse('helpdesk:mass_update'), {'ticket_id': ids, 'action': 'take'})
+        self.assertEqual(Ticket.objects.filter(assigned_to=self.staff).count(), 3)
+        self.assertEqual(FollowUp.objects.filter(title='Assigned to helpdesk.staff in bulk update').count(), 3)
+
+        self.client.post(reverse('helpdesk:mass_update'), {'ticket_id': ids[:2], 'action': 'close'})
+        self.assertEqual(Ticket.objects.filter(status=Ticket.CLOSED_STATUS).count(), 2)
+        self.assertEqual(FollowUp.objects.filter(new_status=Ticket.CLOSED_STATUS, public=False).count(), 2)
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.client.post(reverse('helpdesk:mass_update'), {'ticket_id': ids, 'action': 'close_public'})
+        self.assertEqual(Ticket.objects.filter(status=Ticket.CLOSED_STATUS).count(), 3)
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox), ['queue.cc@example.com', 'submitter2@example.com'])
+
+        self.client.post(reverse('helpdesk:mass_update'), {'ticket_id': ids[:1], 'action': 'delete'})
+        self.assertEqual(Ticket.objects.count(), 2)
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+from datetime import timedelta
+
+from django.contrib.auth.models import Permission
+from django.core import mail
+from django.core.urlresolvers import reverse
+from django.template.loader import render_to_string
+from django.test import TestCase
+from django.utils import timezone
+
+try:
+    # Python >= 3.3
+    from unittest import mock
+except ImportError:
+    # Python < 3.3
+    import mock
+
+from helpdesk import lib, settings as helpdesk_settings
+from helpdesk.forms import BulkActionJobForm
+from helpdesk.lib import b64encode
+from helpdesk.management.commands.process_bulk_jobs import process_bulk_jobs
+from helpdesk.models import Queue, Ticket, FollowUp, SavedSearch, BulkActionJob
+from helpdesk.tests.helpers import get_staff_user, User
+
+
+def encode_query(**filters):
+    return b64encode(json.dumps(filters).encode('UTF-8')).decode()
+
+
+class BulkActionJobTestCase(TestCase):
+
+    fixtures = ['emailtemplate.json']
+
+    def setUp(self):
+        self.staff = get_staff_user()
+        self.queue = Queue.objects.create(title='Queue', slug='q', updated_ticket_cc='queue.cc@example.com')
+        self.other_queue = Queue.objects.create(title='Other', slug='other')
+        self.tickets = [
+            Ticket.objects.create(title='Ticket %d' % i, queue=self.queue, submitter_email='submitter%d@example.com' % i)
+            for i in range(5)
+        ]
+        self.other = Ticket.objects.create(title='Other', queue=self.other_queue)
+        self.client.login(username=self.staff.username, password='password')
+
+    def add_job(self, **data):
+        response = self.client.post(reverse('helpdesk:tickets-bulk-job-add'), data,
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        return response
+
+    def test_queue_job(self):
+        response = self.add_job(action='close', query=encode_query(queue=[str(self.queue.pk)]))
+        self.assertEqual(response.status_code, 202)
+        data = json.loads(response.content.decode())
+        self.assertEqual(data['status'], BulkActionJob.PENDING_STATUS)
+        progress_url = data['progress_url']
+        job = BulkActionJob.objects.get(pk=data['id'])
+        self.assertEqual(job.user, self.staff)
+
+        # nothing is changed before the worker runs the job
+        self.assertEqual(Ticket.objects.filter(status=Ticket.CLOSED_STATUS).count(), 0)
+        self.assertEqual(process_bulk_jobs(chunk_size=2), [job])
+        self.assertEqual(process_bulk_jobs(), [])
+
+        data = json.loads(self.client.get(progress_url).content.decode())
+        self.assertEqual((data['status'], data['total'], data['processed'], data['changed'], data['progress']),
+                         (BulkActionJob.DONE_STATUS, 5, 5, 5, 100))
+        self.assertEqual(set(Ticket.objects.filter(status=Ticket.CLOSED_STATUS)), set(self.tickets))
+        self.assertEqual(FollowUp.objects.filter(title='Closed in bulk update', public=False).count(), 5)
+        self.assertEqual(len(mail.outbox), 0)
+
+        # other users do not see the job
+        User.objects.create_user('other', 'other@example.com', 'password', is_staff=True)
+        self.client.login(username='other', password='password')
+        self.assertEqual(self.client.get(progress_url).status_code, 404)
+
+    def test_ticket_list_form(self):
+        # the form of the ticket list posts the query of the list
+        query = encode_query(queue=[str(self.queue.pk)])
+        form = BulkActionJobForm(user=self.staff, initial={'query': query})
+        html = render_to_string('helpdesk/partials/bulk_job_modal.html', {'form': form})
+        self.assertIn(reverse('helpdesk:tickets-bulk-job-add'), html)
+        self.assertIn('value="%s"' % query, html)
+
+        response = self.add_job(action='close', query=query, saved_query='')
+        self.assertEqual(response.status_code, 202)
+        job = process_bulk_jobs()[0]
+        self.assertEqual((job.total, job.changed), (5, 5))
+        self.assertNotEqual(Ticket.objects.get(pk=self.other.pk).status, Ticket.CLOSED_STATUS)
+
+    def test_saved_search_job(self):
+        owner = User.objects.create_user('owner', 'owner@example.com', 'password', is_staff=True)
+        saved_search = SavedSearch.objects.create(user=self.staff, title='Ticket 3',
+                                                  query=encode_query(keywords='Ticket 3'))
+        self.add_job(action='assign', assigned_to=owner.pk, saved_query=saved_search.pk)
+        job = process_bulk_jobs()[0]
+        self.assertEqual((job.total, job.changed), (1, 1))
+        self.assertEqual(list(Ticket.objects.filter(assigned_to=owner)), [self.tickets[3]])
+
+    def test_invalid_query(self):
+        response = self.add_job(action='delete', query='not a query')
+        self.assertEqual(response.status_code, 400)
+        response = self.add_job(action='delete')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(BulkActionJob.objects.exists())
+
+    def test_close_public_with_access(self):
+        self.staff.user_permissions.add(Permission.objects.get(codename=self.queue.permission_name[9:]))
+        job = BulkActionJob.objects.create(user=self.staff, action=BulkActionJob.ACTION_CLOSE_PUBLIC,
+                                           query=encode_query())
+        enabled = helpdesk_settings.HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION
+        helpdesk_settings.HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION = True
+        try:
+            process_bulk_jobs(chunk_size=3)
+        finally:
+            helpdesk_settings.HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION = enabled
+
+        job.refresh_from_db()
+        self.assertEqual((job.total, job.changed), (5, 5))
+        self.assertNotEqual(Ticket.objects.get(pk=self.other.pk).status, Ticket.CLOSED_STATUS)
+        self.assertEqual(len([m for m in mail.outbox if m.to[0].startswith('submitter')]), 5)
+
+    def test_resume_job(self):
+        # a job interrupted after its first chunk carries on after it
+        job = BulkActionJob.objects.create(user=self.staff, action=BulkActionJob.ACTION_DELETE,
+                                           query=encode_query(queue=[str(self.queue.pk)]),
+                                           status=BulkActionJob.PENDING_STATUS, started=self.tickets[0].created,
+                                           total=5, processed=2, changed=2, last_ticket_id=self.tickets[1].pk)
+        process_bulk_jobs(chunk_size=2)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed, job.changed), (BulkActionJob.DONE_STATUS, 5, 5))
+        self.assertEqual(set(Ticket.objects.all()), set(self.tickets[:2] + [self.other]))
+
+    def test_reclaim_stale_job(self):
+        # a job left running by a dead worker is only run again once its
+        # progress is older than HELPDESK_BULK_JOB_STALE_TIMEOUT
+        job = BulkActionJob.objects.create(user=self.staff, action=BulkActionJob.ACTION_CLOSE,
+                                           query=encode_query(queue=[str(self.queue.pk)]),
+                                           status=BulkActionJob.RUNNING_STATUS, started=timezone.now(),
+                                           total=5, processed=2, changed=2, last_ticket_id=self.tickets[1].pk)
+        self.assertEqual(process_bulk_jobs(), [])
+
+        timeout = helpdesk_settings.HELPDESK_BULK_JOB_STALE_TIMEOUT
+        BulkActionJob.objects.filter(pk=job.pk).update(updated=timezone.now() - timedelta(seconds=timeout + 1))
+        self.assertEqual(process_bulk_jobs(), [job])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed, job.changed), (BulkActionJob.DONE_STATUS, 5, 5))
+        self.assertEqual(Ticket.objects.filter(status=Ticket.CLOSED_STATUS).count(), 3)
+
+    def test_job_claimed_by_other_worker(self):
+        # a worker which lost its job while running a chunk rolls the chunk
+        # back and leaves the job to the worker which claimed it
+        job = BulkActionJob.objects.create(user=self.staff, action=BulkActionJob.ACTION_CLOSE,
+                                           query=encode_query(queue=[str(self.queue.pk)]))
+        bulk_update_tickets = lib.bulk_update_tickets
+
+        def reclaim(*args, **kwargs):
+            BulkActionJob.objects.filter(pk=job.pk).update(updated=timezone.now() + timedelta(seconds=1))
+            return bulk_update_tickets(*args, **kwargs)
+
+        with mock.patch.object(lib, 'bulk_update_tickets', side_effect=reclaim):
+            self.assertEqual(process_bulk_jobs(chunk_size=2), [job])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed, job.changed, job.last_ticket_id),
+                         (BulkActionJob.RUNNING_STATUS, 0, 0, 0))
+        self.assertEqual(Ticket.objects.filter(status=Ticket.CLOSED_STATUS).count(), 0)
+        self.assertFalse(FollowUp.objects.exists())
+
+    def test_failed_job(self):
+        job = BulkActionJob.objects.create(user=self.staff, action=BulkActionJob.ACTION_CLOSE, query='garbage')
+        process_bulk_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, BulkActionJob.FAILED_STATUS)
+        self.assertTrue(job.error)
+        self.assertEqual(Ticket.objects.filter(status=Ticket.CLOSED_STATUS).count(), 0)
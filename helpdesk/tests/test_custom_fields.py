@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import datetime
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from helpdesk.filters import TicketsFilter
+from helpdesk.forms import TicketForm, EditTicketForm
+from helpdesk.models import Queue, Ticket, CustomField, TicketCustomFieldValue
+from helpdesk.tests.helpers import ClearCachesMixin
+
+
+class CustomFieldFormsTestCase(ClearCachesMixin, TestCase):
+
+    def setUp(self):
+        self.queue = Queue.objects.create(title='Queue', slug='q')
+        self.text = CustomField.objects.create(name='text', label='Text', data_type='varchar', max_length=20,
+                                               ordering=1)
+        self.choice = CustomField.objects.create(name='choice', label='Choice', data_type='list', ordering=2,
+                                                 list_values='One\nTwo\n', empty_selection_list=True)
+
+    def test_definitions_cached(self):
+        TicketForm()
+        with self.assertNumQueries(0):
+            form = TicketForm()
+            TicketForm()
+        self.assertEqual(list(form.fields['custom_choice'].choices),
+                         [('', '---------'), ['One', 'One'], ['Two', 'Two']])
+
+        self.text.label = 'Renamed'
+        self.text.save()
+        self.assertEqual(TicketForm().fields['custom_text'].label, 'Renamed')
+        self.choice.delete()
+        self.assertNotIn('custom_choice', TicketForm().fields)
+
+    def test_changed_in_other_process(self):
+        self.assertEqual(TicketForm().fields['custom_choice'].label, 'Choice')
+        # another process changes a field: its signal only clears its own
+        # copy of the fields, and bumps the version in the shared cache
+        CustomField.objects.filter(pk=self.choice.pk).update(label='Renamed')
+        cache.set(CustomField.objects.FIELDS_VERSION_KEY, 'changed elsewhere', None)
+        self.assertEqual(TicketForm().fields['custom_choice'].label, 'Renamed')
+
+    def test_values_saved_in_bulk(self):
+        form = TicketForm({'queue': self.queue.pk, 'title': 'Ticket', 'body': 'Body', 'priority': 3,
+                           'custom_text': 'Some text', 'custom_choice': 'Two'})
+        self.assertTrue(form.is_valid(), form.errors)
+        ticket = Ticket.objects.create(title='Ticket', queue=self.queue)
+        with self.assertNumQueries(1):
+            form._create_custom_fields(ticket)
+        self.assertEqual(dict(ticket.ticketcustomfieldvalue_set.values_list('field__name', 'value')),
+                         {'text': 'Some text', 'choice': 'Two'})
+
+        # editing the ticket only writes the changed values
+        TicketCustomFieldValue.objects.filter(ticket=ticket, field=self.choice).delete()
+        form = EditTicketForm({'title': 'Ticket', 'queue': self.queue.pk, 'priority': 3,
+                               'custom_text': 'Some text', 'custom_choice': 'One'}, instance=ticket)
+        self.assertEqual(form.fields['custom_text'].initial, 'Some text')
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        self.assertEqual(dict(ticket.ticketcustomfieldvalue_set.values_list('field__name', 'value')),
+                         {'text': 'Some text', 'choice': 'One'})
+
+
+class CustomFieldFilterTestCase(ClearCachesMixin, TestCase):
+
+    def setUp(self):
+        self.queue = Queue.objects.create(title='Queue', slug='q')
+        self.size = CustomField.objects.create(name='size', label='Size', data_type='integer')
+        self.due = CustomField.objects.create(name='due', label='Due', data_type='date')
+        self.notes = CustomField.objects.create(name='notes', label='Notes', data_type='text')
+        self.tickets = []
+        for size, due, notes in (('10', '2018-03-01', 'Red'), ('9', '2018-01-15', 'Blue'), ('100', 'soon', '')):
+            ticket = Ticket.objects.create(title='Ticket %s' % size, queue=self.queue)
+            TicketCustomFieldValue.objects.bulk_create([
+                TicketCustomFieldValue(ticket=ticket, field=self.size, value=size),
+                TicketCustomFieldValue(ticket=ticket, field=self.due, value=due),
+            ])
+            TicketCustomFieldValue.objects.create(ticket=ticket, field=self.notes, value=notes)
+            self.tickets.append(ticket)
+
+    def filter(self, **data):
+        return list(TicketsFilter(data, queryset=Ticket.objects.all()).qs)
+
+    def test_typed_values(self):
+        value = TicketCustomFieldValue.objects.get(ticket=self.tickets[0], field=self.size)
+        self.assertEqual((value.value_number, value.value_string, value.value_datetime), (Decimal(10), None, None))
+        value = TicketCustomFieldValue.objects.get(ticket=self.tickets[0], field=self.due)
+        self.assertEqual(value.value_datetime, datetime(2018, 3, 1))
+        self.assertIsNone(TicketCustomFieldValue.objects.get(ticket=self.tickets[2], field=self.due).value_datetime)
+
+        value.value = '2018-04-02'
+        value.save(update_fields=['value'])
+        value.refresh_from_db()
+        self.assertEqual(value.value_datetime, datetime(2018, 4, 2))
+
+    def test_filter(self):
+        ticket_10, ticket_9, ticket_100 = self.tickets
+        # compared as numbers, not text
+        self.assertEqual(self.filter(cf_size_min='10'), [ticket_10, ticket_100])
+        self.assertEqual(self.filter(cf_size='9'), [ticket_9])
+        self.assertEqual(self.filter(cf_due_max='2018-02-01'), [ticket_9])
+        self.assertEqual(self.filter(cf_notes='re'), [ticket_10])
+        self.assertEqual(self.filter(cf_size='many'), [])
+
+    def test_order_by(self):
+        ticket_10, ticket_9, ticket_100 = self.tickets
+        self.assertEqual(self.filter(order_by='cf_size'), [ticket_9, ticket_10, ticket_100])
+        self.assertEqual(self.filter(order_by='-cf_size'), [ticket_100, ticket_10, ticket_9])
+        self.assertEqual(self.filter(order_by='cf_due,id')[1:], [ticket_9, ticket_10])
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from helpdesk.lib import bulk_update_tickets
+from helpdesk.models import Queue, Ticket, TicketDependency
+from helpdesk.tests.helpers import get_staff_user
+
+
+class TicketDependencyTestCase(TestCase):
+
+    def setUp(self):
+        self.queue = Queue.objects.create(title='Queue', slug='q')
+        self.ticket, self.one, self.two, self.three = [
+            Ticket.objects.create(title='Ticket %d' % i, queue=self.queue) for i in range(4)
+        ]
+
+    def open_dependency_count(self, ticket):
+        return Ticket.objects.get(pk=ticket.pk).open_dependency_count
+
+    def test_open_dependency_count(self):
+        TicketDependency.objects.create(ticket=self.ticket, depends_on=self.one)
+        dependency = TicketDependency.objects.create(ticket=self.ticket, depends_on=self.two)
+        self.assertEqual(self.open_dependency_count(self.ticket), 2)
+
+        self.one.status = Ticket.RESOLVED_STATUS
+        self.one.save()
+        self.assertEqual(self.open_dependency_count(self.ticket), 1)
+
+        one = Ticket.objects.get(pk=self.one.pk)
+        one.status = Ticket.REOPENED_STATUS
+        one.save()
+        self.assertEqual(self.open_dependency_count(self.ticket), 2)
+
+        bulk_update_tickets(Ticket.objects.filter(pk__in=[self.one.pk, self.two.pk]), get_staff_user(),
+                            'Closed in bulk update', new_status=Ticket.CLOSED_STATUS)
+        self.assertEqual(self.open_dependency_count(self.ticket), 0)
+
+        Ticket.objects.filter(pk=self.two.pk).update(status=Ticket.OPEN_STATUS)
+        Ticket.objects.refresh_open_dependency_counts()
+        self.assertEqual(self.open_dependency_count(self.ticket), 1)
+        dependency.delete()
+        self.assertEqual(self.open_dependency_count(self.ticket), 0)
+
+    def test_recount_without_self_reads(self):
+        # MySQL refuses an UPDATE of helpdesk_ticket whose values are read
+        # from helpdesk_ticket, so the counts are written as plain values
+        TicketDependency.objects.create(ticket=self.ticket, depends_on=self.one)
+        TicketDependency.objects.create(ticket=self.ticket, depends_on=self.two)
+        TicketDependency.objects.create(ticket=self.three, depends_on=self.one)
+        Ticket.objects.filter(pk__in=[self.ticket.pk, self.three.pk]).update(open_dependency_count=5)
+        Ticket.objects.filter(pk=self.two.pk).update(open_dependency_count=3)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(Ticket.objects.refresh_open_dependency_counts(), 3)
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 3)
+        for sql in updates:
+            self.assertNotIn('SELECT', sql.split(' WHERE ')[0])
+        self.assertEqual([self.open_dependency_count(t) for t in (self.ticket, self.one, self.two, self.three)],
+                         [2, 0, 0, 1])
+
+        # nothing is written when the counts are right
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(Ticket.objects.refresh_open_dependency_counts(), 0)
+        self.assertFalse([q for q in queries.captured_queries if q['sql'].startswith('UPDATE')])
+
+    def test_stale_instance(self):
+        # saving a ticket loaded before a dependency was added keeps the count
+        TicketDependency.objects.create(ticket=self.ticket, depends_on=self.one)
+        self.assertEqual(self.ticket.open_dependency_count, 0)
+        self.ticket.title = 'Renamed'
+        self.ticket.save()
+        ticket = Ticket.objects.get(pk=self.ticket.pk)
+        self.assertEqual((ticket.title, ticket.open_dependency_count), ('Renamed', 1))
+        self.assertFalse(ticket.can_be_resolved)
+
+    def test_can_be_resolved(self):
+        TicketDependency.objects.create(ticket=self.ticket, depends_on=self.one)
+        tickets = list(Ticket.objects.order_by('id'))
+        with self.assertNumQueries(0):
+            self.assertEqual([t.can_be_resolved for t in tickets], [False, True, True, True])
+            self.assertEqual(tickets[0].get_status, 'Open - Open dependencies')
+
+    def test_blocking_tickets(self):
+        # ticket -> one -> two -> three -> one
+        TicketDependency.objects.create(ticket=self.ticket, depends_on=self.one)
+        TicketDependency.objects.create(ticket=self.one, depends_on=self.two)
+        TicketDependency.objects.create(ticket=self.two, depends_on=self.three)
+        TicketDependency.objects.create(ticket=self.three, depends_on=self.one)
+        self.one.status = Ticket.CLOSED_STATUS
+        self.one.save()
+
+        self.assertEqual(Ticket.objects.dependency_ids(self.ticket.pk), {self.one.pk, self.two.pk, self.three.pk})
+        self.assertEqual(set(self.ticket.get_blocking_tickets()), {self.two, self.three})
+        self.assertEqual(set(self.three.get_blocking_tickets()), {self.two, self.three})
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import date, timedelta
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command, CommandError
+from django.test import TestCase
+from django.utils import six, timezone
+
+from helpdesk.lib import MailBatch, safe_template_context
+from helpdesk.management.commands.escalate_tickets import escalate_chunk, eligible_tickets
+from helpdesk.models import Queue, Ticket, FollowUp, TicketChange, EscalationExclusion, BusinessCalendar
+
+
+class EscalationTestCase(TestCase):
+
+    fixtures = ['emailtemplate.json']
+
+    def setUp(self):
+        self.owner = User.objects.create_user('owner', 'owner@example.com', 'password')
+        self.queue = Queue.objects.create(title='Escalating', slug='esc', escalate_days=3,
+                                          updated_ticket_cc='cc@example.com')
+        self.quiet_queue = Queue.objects.create(title='Not Escalating', slug='quiet')
+
+        self.old = self.create_ticket('Old', days=4, assigned_to=self.owner)
+        self.recent = self.create_ticket('Recent', days=1)
+        self.critical = self.create_ticket('Critical', days=4, priority=1)
+        self.held = self.create_ticket('Held', days=4, on_hold=True)
+        self.closed = self.create_ticket('Closed', days=4, status=Ticket.CLOSED_STATUS)
+        self.other_queue = self.create_ticket('Other queue', days=4, queue=self.quiet_queue)
+
+    def create_ticket(self, title, days, **kwargs):
+        kwargs.setdefault('queue', self.queue)
+        ticket = Ticket.objects.create(title=title, submitter_email='submitter@example.com', **kwargs)
+        # Ticket.save() always stamps new tickets with the current time
+        Ticket.objects.filter(pk=ticket.pk).update(created=timezone.now() - timedelta(days=days))
+        return ticket
+
+    def priorities(self):
+        return dict(Ticket.objects.values_list('title', 'priority'))
+
+    def test_escalation(self):
+        call_command('escalate_tickets')
+
+        self.assertEqual(self.priorities(), {
+            'Old': 2,
+            'Recent': 3,
+            'Critical': 1,
+            'Held': 3,
+            'Closed': 3,
+            'Other queue': 3,
+        })
+        old = Ticket.objects.get(pk=self.old.pk)
+        self.assertIsNotNone(old.last_escalation)
+
+        followup = FollowUp.objects.get()
+        self.assertEqual(followup.ticket, old)
+        self.assertEqual(followup.title, 'Ticket Escalated')
+        change = TicketChange.objects.get()
+        self.assertEqual(change.followup, followup)
+        self.assertEqual((change.old_value, change.new_value), ('3', '2'))
+
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         ['cc@example.com', 'owner@example.com', 'submitter@example.com'])
+
+        # a second run does not escalate the same ticket again
+        call_command('escalate_tickets')
+        self.assertEqual(self.priorities()['Old'], 2)
+
+    def test_exclusions(self):
+        # with two of the last three days excluded, a ticket needs to be older
+        # than one day to be escalated
+        for offset in (1, 2):
+            EscalationExclusion.objects.create(name='Holiday', date=date.today() - timedelta(days=offset))
+        call_command('escalate_tickets', queues='esc')
+        self.assertEqual(self.priorities()['Recent'], 3)
+
+        Ticket.objects.filter(pk=self.recent.pk).update(created=timezone.now() - timedelta(days=2))
+        call_command('escalate_tickets', queues='esc')
+        self.assertEqual(self.priorities()['Recent'], 2)
+
+    def test_queue_exclusions(self):
+        # exclusions for another queue do not delay this one
+        exclusion = EscalationExclusion.objects.create(name='Holiday', date=date.today() - timedelta(days=1))
+        exclusion.queues.add(self.quiet_queue)
+        Ticket.objects.filter(pk=self.recent.pk).update(created=timezone.now() - timedelta(days=3))
+        call_command('escalate_tickets', queues='esc')
+        self.assertEqual(self.priorities()['Recent'], 3)
+
+        exclusion.queues.add(self.queue)
+        call_command('escalate_tickets', queues='esc')
+        self.assertEqual(self.priorities()['Recent'], 2)
+
+    def test_dry_run(self):
+        out = six.StringIO()
+        call_command('escalate_tickets', dry_run=True, stdout=out)
+        self.assertEqual(out.getvalue(), 'esc: 1 tickets would be escalated\n')
+        self.assertEqual(self.priorities()['Old'], 3)
+        self.assertFalse(FollowUp.objects.exists())
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_shards(self):
+        self.create_ticket('Old 2', days=4)
+        self.create_ticket('Old 3', days=5)
+        escalated = set()
+        for shard in ('1/2', '2/2'):
+            before = self.priorities()
+            call_command('escalate_tickets', shard=shard)
+            after = self.priorities()
+            new = set(title for title in after if after[title] != before[title])
+            self.assertFalse(new & escalated)
+            escalated |= new
+        self.assertEqual(escalated, {'Old', 'Old 2', 'Old 3'})
+
+        with self.assertRaises(CommandError):
+            call_command('escalate_tickets', shard='3/2')
+        with self.assertRaises(CommandError):
+            call_command('escalate_tickets', shard='half')
+
+    def test_concurrent_escalation(self):
+        # a run which selected the ticket before another run escalated it
+        # leaves it alone
+        eligible = eligible_tickets(self.queue, date.today() - timedelta(days=3))
+        stale = list(eligible)
+        self.assertEqual(len(escalate_chunk(self.queue, stale, eligible)), 1)
+        self.assertEqual(escalate_chunk(self.queue, stale, eligible), [])
+        self.assertEqual(self.priorities()['Old'], 2)
+        self.assertEqual(FollowUp.objects.count(), 1)
+
+
+class BusinessCalendarTestCase(TestCase):
+
+    def setUp(self):
+        self.monday = date(2017, 1, 2)
+        saturday, sunday = self.monday + timedelta(days=5), self.monday + timedelta(days=6)
+        self.calendar = BusinessCalendar([
+            (saturday, None),
+            (sunday, None),
+            (self.monday, 7),
+        ])
+
+    def test_business_days_between(self):
+        next_monday = self.monday + timedelta(days=7)
+        self.assertEqual(self.calendar.business_days_between(self.monday, next_monday), 5)
+        self.assertEqual(self.calendar.business_days_between(self.monday, next_monday, queue=7), 4)
+        self.assertEqual(self.calendar.business_days_between(next_monday, self.monday), 0)
+        self.assertTrue(self.calendar.is_business_day(self.monday))
+        self.assertFalse(self.calendar.is_business_day(self.monday, queue=7))
+
+    def test_add_business_days(self):
+        friday = self.monday + timedelta(days=4)
+        next_monday = self.monday + timedelta(days=7)
+        self.assertEqual(self.calendar.add_business_days(friday, 0), friday)
+        self.assertEqual(self.calendar.add_business_days(friday, 1), next_monday)
+        self.assertEqual(self.calendar.add_business_days(self.monday - timedelta(days=1), 1, queue=7),
+                         self.monday + timedelta(days=1))
+        self.assertEqual(self.calendar.add_business_days(self.monday, 10), self.monday + timedelta(days=12))
+
+    def test_cached_calendar(self):
+        EscalationExclusion.objects.create(name='Holiday', date=self.monday)
+        with self.assertNumQueries(1):
+            EscalationExclusion.objects.calendar()
+            self.assertFalse(EscalationExclusion.objects.calendar().is_business_day(self.monday))
+        EscalationExclusion.objects.all().delete()
+        self.assertTrue(EscalationExclusion.objects.calendar().is_business_day(self.monday))
+
+    def test_create_exclusions(self):
+        queue = Queue.objects.create(title='Weekdays', slug='weekdays')
+        call_command('create_escalation_exclusions', days='saturday,sunday', occurrences=2, queues='weekdays')
+        call_command('create_escalation_exclusions', days='saturday', occurrences=3)
+        exclusions = EscalationExclusion.objects.order_by('date')
+        self.assertEqual(len(exclusions), 5)
+        self.assertEqual(set(e.date.weekday() for e in exclusions), {5, 6})
+        self.assertEqual(sum(1 for e in exclusions if list(e.queues.all()) == [queue]), 4)
+
+
+class MailBatchTestCase(TestCase):
+
+    fixtures = ['emailtemplate.json']
+
+    def test_batch(self):
+        queue = Queue.objects.create(title='Batch', slug='batch')
+        ticket = Ticket.objects.create(title='Ticket', queue=queue)
+        context = safe_template_context(ticket)
+        # the ticket status is looked up by the first template that uses it
+        str(context['ticket']['get_status'])
+
+        with MailBatch(size=2) as batch:
+            with self.assertNumQueries(1):
+                batch.add('escalated_owner', context, recipients='one@example.com')
+                batch.add('escalated_owner', context, recipients='two@example.com')
+            self.assertEqual(len(mail.outbox), 2)
+            batch.add('escalated_owner', context, recipients='three@example.com')
+            batch.add('does_not_exist', context, recipients='four@example.com')
+            self.assertEqual(len(mail.outbox), 2)
+
+        self.assertEqual([m.to for m in mail.outbox],
+                         [['one@example.com'], ['two@example.com'], ['three@example.com']])
+        self.assertEqual(batch.sent, 3)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.contrib.sites.models import Site
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from helpdesk import settings as helpdesk_settings
+from helpdesk.models import Queue, Ticket, FollowUp
+from helpdesk.tests.helpers import ClearCachesMixin, get_staff_user
+
+
+class FeedTestCase(ClearCachesMixin, TestCase):
+
+    def setUp(self):
+        # the feeds link to the site of the request
+        Site.objects.create(domain='testserver', name='testserver')
+        self.staff = get_staff_user()
+        self.queue = Queue.objects.create(title='Queue', slug='q')
+        self.tickets = [
+            Ticket.objects.create(title='Ticket %d' % i, queue=self.queue, assigned_to=self.staff if i % 2 else None)
+            for i in range(6)
+        ]
+        self.client.login(username=self.staff.username, password='password')
+
+    def test_bounded_feed(self):
+        url = reverse('helpdesk:rss_queue', args=[self.queue.slug])
+        max_items = helpdesk_settings.HELPDESK_FEED_MAX_ITEMS
+        helpdesk_settings.HELPDESK_FEED_MAX_ITEMS = 4
+        try:
+            response = self.client.get(url)
+        finally:
+            helpdesk_settings.HELPDESK_FEED_MAX_ITEMS = max_items
+        self.assertEqual(response.content.decode().count('<item>'), 4)
+        self.assertContains(response, 'Ticket 5')
+        self.assertNotContains(response, 'Ticket 1<')
+
+        # the owners and queues of the tickets are loaded with them
+        response = self.client.get(reverse('helpdesk:rss_user', args=[self.staff.username]))
+        self.assertContains(response, '>%s</dc:creator>' % self.staff.username, count=3)
+        FollowUp.objects.create(ticket=self.tickets[0], title='Comment', user=self.staff)
+        self.assertContains(self.client.get(reverse('helpdesk:rss_activity')), 'Comment by')
+
+    def test_conditional_get(self):
+        url = reverse('helpdesk:rss_unassigned')
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT').status_code, 200)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # served from the cache while nothing changes
+        self.client.get(url)
+        Ticket.objects.filter(pk=self.tickets[0].pk).update(title='Renamed')
+        self.assertNotContains(self.client.get(url), 'Renamed')
+
+        ticket = self.tickets[2]
+        ticket.assigned_to = self.staff
+        ticket.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, 'Renamed')
+        self.assertNotContains(response, 'Ticket 2')
+
+    def test_deleted_followup(self):
+        url = reverse('helpdesk:rss_activity')
+        followups = [FollowUp.objects.create(ticket=self.tickets[0], title='Comment %d' % i) for i in range(2)]
+        etag = self.client.get(url)['ETag']
+        followups[1].delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, 'Comment 1')
@@ -2,17 +2,27 @@
 
 from __future__ import unicode_literals
 
-from helpdesk.models import Queue, Ticket, TicketCC, FollowUp, Attachment
+from helpdesk.management.commands.get_email import (
+    ticket_from_message, claim_local_message, process_local_message, recover_local_messages,
+)
+from helpdesk import settings as helpdesk_settings
+from helpdesk.models import Queue, Ticket, TicketCC, FollowUp, Attachment, IgnoreEmail
+from helpdesk.tests.helpers import ClearCachesMixin
 from django.test import TestCase
 from django.core.management import call_command
+from django.core.urlresolvers import reverse
 from django.utils import six
 from django.shortcuts import get_object_or_404
 from django.contrib.auth.models import User
 from django.contrib.auth.hashers import make_password
 import itertools
+import json
+import logging
+import os
 from shutil import rmtree
 import sys
 from tempfile import mkdtemp
+import time
 
 try:  # python 3
     from urllib.parse import urlparse
@@ -489,6 +499,203 @@ class GetEmailCCHandling(TestCase):
         self.assertEqual(cc4.email, test_email_cc_four)
 
 
+class GetEmailIgnoreHandling(TestCase):
+    """TestCase that checks senders on the ignore list are skipped."""
+
+    def setUp(self):
+        self.queue = Queue.objects.create(title='Ignore Queue', slug='IG')
+        self.other_queue = Queue.objects.create(title='Other Queue', slug='OT')
+        IgnoreEmail.objects.create(name='Postmaster', email_address='postmaster@*')
+        IgnoreEmail.objects.create(name='Spammer', email_address='*@spam.example.com', keep_in_mailbox=True)
+        queue_only = IgnoreEmail.objects.create(name='Queue only', email_address='bot@example.com')
+        queue_only.queues.add(self.queue)
+
+    def test_matcher(self):
+        matcher = IgnoreEmail.objects.matcher_for_queue(self.queue)
+        self.assertIs(matcher.match('postmaster@example.com'), False)
+        self.assertIs(matcher.match('anyone@spam.example.com'), True)
+        self.assertIs(matcher.match('bot@example.com'), False)
+        self.assertIsNone(matcher.match('customer@example.com'))
+        self.assertIsNone(matcher.match(''))
+
+        other = IgnoreEmail.objects.matcher_for_queue(self.other_queue)
+        self.assertIsNone(other.match('bot@example.com'))
+        self.assertIs(other.match('postmaster@example.com'), False)
+
+    def test_matcher_agrees_with_test(self):
+        addresses = ['postmaster@example.com', 'anyone@spam.example.com', 'bot@example.com',
+                     'customer@example.com', 'postmaster@spam.example.com']
+        matcher = IgnoreEmail.objects.matcher_for_queue(self.queue)
+        for address in addresses:
+            first = None
+            for ignore in IgnoreEmail.objects.order_by('pk'):
+                if ignore.test(address):
+                    first = ignore.keep_in_mailbox
+                    break
+            self.assertEqual(matcher.match(address), first, address)
+
+    def test_matcher_rebuilt_on_change(self):
+        self.assertIsNone(IgnoreEmail.objects.matcher_for_queue(self.queue).match('x@x'))
+        IgnoreEmail.objects.create(name='Everything', email_address='*@*')
+        self.assertIs(IgnoreEmail.objects.matcher_for_queue(self.queue).match('x@x'), False)
+
+        bot = IgnoreEmail.objects.get(name='Queue only')
+        bot.queues.remove(self.queue)
+        bot.queues.add(self.other_queue)
+        matcher = IgnoreEmail.objects.matcher_for_queue(self.other_queue)
+        self.assertEqual(matcher.exact['bot@example.com'][0], bot.pk)
+
+    def test_ignored_message(self):
+        message = "To: queue@example.com\nFrom: postmaster@example.com\nSubject: Bounce\n\nUndeliverable"
+        logger = logging.getLogger('helpdesk.tests.ignore')
+        self.assertIs(ticket_from_message(message, self.queue, logger), True)
+        message = message.replace('postmaster@example.com', 'someone@spam.example.com')
+        self.assertIs(ticket_from_message(message, self.queue, logger), False)
+        self.assertEqual(Ticket.objects.count(), 0)
+
+
+class GetEmailLocalWorkerHandling(ClearCachesMixin, TestCase):
+    """TestCase that checks the claim-by-rename worker used for local directories."""
+
+    def setUp(self):
+        self.mail_dir = mkdtemp()
+        for subdir in ('processing', 'quarantine'):
+            os.mkdir(os.path.join(self.mail_dir, subdir))
+        self.queue = Queue.objects.create(title='Local Queue', slug='LQ', email_box_type='local',
+                                          email_box_local_dir=self.mail_dir)
+
+    def tearDown(self):
+        rmtree(self.mail_dir)
+
+    def write_message(self, filename, subject):
+        message = "To: queue@example.com\nFrom: sender@example.com\nSubject: %s\n\nBody" % subject
+        with open(os.path.join(self.mail_dir, filename), 'wb') as f:
+            f.write(message.encode('utf-8'))
+
+    def test_processed_message_is_removed(self):
+        self.write_message('plain.eml', 'Plain read')
+        self.write_message('mapped.eml', 'Mapped read')
+        self.assertEqual(process_local_message((self.queue, self.mail_dir, 'plain.eml', False))[0], 'processed')
+        self.assertEqual(process_local_message((self.queue, self.mail_dir, 'mapped.eml', True))[0], 'processed')
+        self.assertEqual(
+            sorted(Ticket.objects.values_list('title', flat=True)), ['Mapped read', 'Plain read'])
+        self.assertEqual(sorted(os.listdir(self.mail_dir)), ['processing', 'quarantine'])
+        self.assertEqual(os.listdir(os.path.join(self.mail_dir, 'processing')), [])
+
+    def test_failed_message_is_quarantined(self):
+        self.write_message('bad.eml', 'Bad message')
+        with mock.patch('helpdesk.management.commands.get_email.ticket_from_message') as mocked:
+            mocked.side_effect = ValueError('broken message')
+            result, stats = process_local_message((self.queue, self.mail_dir, 'bad.eml', False))
+        self.assertEqual(result, 'quarantined')
+        self.assertEqual(stats.failed, 1)
+        self.assertEqual(os.listdir(os.path.join(self.mail_dir, 'quarantine')), ['bad.eml'])
+        self.assertFalse(os.path.exists(os.path.join(self.mail_dir, 'bad.eml')))
+
+    def test_unprocessed_message_is_kept(self):
+        # e.g. a sender ignored with keep_in_mailbox, or not a reply under
+        # QUEUE_EMAIL_BOX_UPDATE_ONLY
+        self.write_message('kept.eml', 'Kept message')
+        with mock.patch('helpdesk.management.commands.get_email.ticket_from_message') as mocked:
+            mocked.return_value = False
+            result, stats = process_local_message((self.queue, self.mail_dir, 'kept.eml', False))
+        self.assertEqual((result, stats.failed), ('kept', 0))
+        self.assertTrue(os.path.exists(os.path.join(self.mail_dir, 'kept.eml')))
+        self.assertEqual(os.listdir(os.path.join(self.mail_dir, 'quarantine')), [])
+
+    def test_abandoned_message_is_recovered(self):
+        # a worker which died left its claimed messages in processing/
+        for filename in ('abandoned.eml', 'running.eml'):
+            self.write_message(filename, filename)
+            os.rename(os.path.join(self.mail_dir, filename), os.path.join(self.mail_dir, 'processing', filename))
+        claimed = time.time() - 7200
+        os.utime(os.path.join(self.mail_dir, 'processing', 'abandoned.eml'), (claimed, claimed))
+        logger = logging.getLogger('helpdesk.tests.recover')
+        self.assertEqual(recover_local_messages(self.mail_dir, 3600, logger), ['abandoned.eml'])
+        self.assertTrue(os.path.exists(os.path.join(self.mail_dir, 'abandoned.eml')))
+        self.assertEqual(os.listdir(os.path.join(self.mail_dir, 'processing')), ['running.eml'])
+
+        # an old message which is claimed again is not taken as abandoned
+        path = claim_local_message(self.mail_dir, 'abandoned.eml')
+        self.assertGreater(os.path.getmtime(path), claimed)
+        self.assertEqual(recover_local_messages(self.mail_dir, 3600, logger), [])
+
+    def test_claimed_message_is_skipped(self):
+        # the file has already been renamed away by another worker
+        result, stats = process_local_message((self.queue, self.mail_dir, 'gone.eml', False))
+        self.assertEqual(result, 'skipped')
+        self.assertEqual(stats.messages, 0)
+
+
+class GetEmailIngestionRunTests(TestCase):
+    """TestCase that checks the counters recorded for each queue run."""
+
+    def setUp(self):
+        self.mail_dir = mkdtemp()
+        self.temp_logdir = mkdtemp()
+        self.queue = Queue.objects.create(title='Metrics Queue', slug='MQ', email_box_type='local',
+                                          email_box_local_dir=self.mail_dir, allow_email_submission=True,
+                                          logging_dir=self.temp_logdir, logging_type='info')
+        IgnoreEmail.objects.create(name='Postmaster', email_address='postmaster@*')
+        messages = [
+            ('one.eml', 'customer@example.com', 'First ticket'),
+            ('two.eml', 'customer@example.com', 'Re: [MQ-%s] Reply'),
+            ('three.eml', 'postmaster@example.com', 'Undeliverable'),
+        ]
+        self.existing = Ticket.objects.create(title='Existing', queue=self.queue)
+        for filename, sender, subject in messages:
+            if '%s' in subject:
+                subject = subject % self.existing.pk
+            with open(os.path.join(self.mail_dir, filename), 'wb') as f:
+                f.write(("From: %s\nSubject: %s\n\nBody" % (sender, subject)).encode('utf-8'))
+
+    def tearDown(self):
+        rmtree(self.mail_dir)
+        rmtree(self.temp_logdir)
+
+    def test_run_is_recorded(self):
+        call_command('get_email', quiet=True)
+
+        run = self.queue.ingestion_runs.get()
+        self.assertEqual(run.messages, 3)
+        self.assertEqual(run.tickets_created, 1)
+        self.assertEqual(run.followups_created, 1)
+        self.assertEqual(run.ignored, 1)
+        self.assertEqual(run.failed, 0)
+        self.assertGreater(run.bytes_received, 0)
+        self.assertEqual(run.error, '')
+
+        # the log handler is closed and removed at the end of each run
+        self.assertEqual(logging.getLogger('django.helpdesk.queue.MQ').handlers, [])
+        with open(os.path.join(self.temp_logdir, 'MQ_get_email.log')) as f:
+            summary = json.loads(f.read().strip().splitlines()[-1])
+        self.assertEqual(summary['queue'], 'MQ')
+        self.assertEqual(summary['tickets_created'], 1)
+
+    def test_metrics_view(self):
+        call_command('get_email', quiet=True)
+        staff = User.objects.create_user('staff', 'staff@example.com', 'password', is_staff=True)
+        self.client.login(username=staff.username, password='password')
+        response = self.client.get(reverse('helpdesk:email-metrics'))
+        queues = json.loads(response.content.decode('utf-8'))['queues']
+        self.assertEqual(len(queues), 1)
+        self.assertEqual(queues[0]['queue'], 'MQ')
+        self.assertEqual(queues[0]['runs'], 1)
+        self.assertEqual(queues[0]['aborted_runs'], 0)
+        self.assertEqual(queues[0]['messages'], 3)
+
+        for days in ('x', '-1', '99999999999'):
+            response = self.client.get(reverse('helpdesk:email-metrics'), {'days': days})
+            self.assertEqual(response.status_code, 400)
+
+    def test_update_only(self):
+        # a message which is not a reply is ignored, not failed
+        with mock.patch.object(helpdesk_settings, 'QUEUE_EMAIL_BOX_UPDATE_ONLY', True):
+            call_command('get_email', quiet=True)
+        run = self.queue.ingestion_runs.get()
+        self.assertEqual((run.tickets_created, run.followups_created, run.ignored, run.failed), (0, 1, 2, 0))
+
+
 # build matrix of test cases
 case_methods = [c[0] for c in Queue._meta.get_field('email_box_type').choices]
 case_socks = [False] + [c[0] for c in Queue._meta.get_field('socks_proxy_type').choices]
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import datetime
+import mailbox
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command, CommandError
+from django.test import TestCase
+from django.utils import six, timezone
+
+from helpdesk.models import Queue, Ticket, FollowUp, IgnoreEmail
+from helpdesk.tests.helpers import ClearCachesMixin
+
+
+class ImportMailboxTestCase(ClearCachesMixin, TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.queue = Queue.objects.create(title='Archive', slug='AR', email_address='archive@example.com',
+                                          new_ticket_cc='new@example.com')
+        self.existing = Ticket.objects.create(title='Existing', queue=self.queue)
+        self.user = User.objects.create_user('cc_user', 'cc_user@example.com', 'password')
+        IgnoreEmail.objects.create(name='Postmaster', email_address='postmaster@*')
+
+        self.messages = [
+            "From: customer@example.com\nDate: Mon, 02 Jan 2012 10:00:00 +0000\n"
+            "Subject: Printer broken\nCc: cc_user@example.com, other@example.com\n\nIt does not print.",
+            "From: customer@example.com\nDate: Tue, 03 Jan 2012 10:00:00 +0000\n"
+            "Subject: Re: [AR-%d] Existing\nCc: other@example.com\n\nAny news?" % self.existing.pk,
+            "From: postmaster@example.com\nDate: Tue, 03 Jan 2012 11:00:00 +0000\n"
+            "Subject: Undeliverable\n\nBounce",
+            "From: another@example.com\nDate: Wed, 04 Jan 2012 10:00:00 +0000\n"
+            "Subject: Second request\n\nHello",
+        ]
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def import_mailbox(self, box_path, **options):
+        out = six.StringIO()
+        call_command('import_mailbox', 'AR', box_path, stdout=out, **options)
+        return out.getvalue()
+
+    def check_import(self):
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(Ticket.objects.count(), 3)
+        self.assertEqual(FollowUp.objects.count(), 3)
+
+        ticket = Ticket.objects.get(title='Printer broken')
+        date = datetime(2012, 1, 2, 10, 0, tzinfo=timezone.utc)
+        if not settings.USE_TZ:
+            date = timezone.make_naive(date, timezone.get_default_timezone())
+        self.assertEqual(ticket.created, date)
+        self.assertEqual(ticket.modified, date)
+        self.assertEqual(ticket.submitter_email, 'customer@example.com')
+        self.assertEqual(ticket.followup_set.get().date, date)
+        self.assertEqual(
+            list(ticket.ticketcc_set.order_by('id').values_list('user', 'email')),
+            [(self.user.pk, None), (None, 'other@example.com')])
+
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.followup_set.get().comment, 'Any news?')
+        self.assertEqual(list(self.existing.ticketcc_set.values_list('email', flat=True)), ['other@example.com'])
+
+    def test_import_mbox(self):
+        box_path = os.path.join(self.temp_dir, 'archive.mbox')
+        box = mailbox.mbox(box_path)
+        for message in self.messages:
+            box.add(message)
+        box.close()
+
+        output = self.import_mailbox(box_path, batch_size=2)
+        self.check_import()
+        self.assertIn('Imported 4 messages', output)
+        self.assertIn('2 tickets created, 1 follow-ups appended, 1 ignored', output)
+
+    def test_import_maildir(self):
+        box_path = os.path.join(self.temp_dir, 'archive')
+        box = mailbox.Maildir(box_path)
+        for message in self.messages:
+            box.add(message)
+
+        self.import_mailbox(box_path, quiet=True)
+        self.check_import()
+
+    def test_import_errors(self):
+        with self.assertRaises(CommandError):
+            call_command('import_mailbox', 'missing', self.temp_dir)
+        with self.assertRaises(CommandError):
+            call_command('import_mailbox', 'AR', os.path.join(self.temp_dir, 'missing'), mailbox_format='maildir')
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from helpdesk.models import KBCategory, KBItem
+from helpdesk.tests.helpers import ClearCachesMixin
+
+
+class KBTestCase(ClearCachesMixin, TestCase):
+
+    def setUp(self):
+        self.printers = KBCategory.objects.create(title='Printers', slug='printers', description='Printers')
+        self.email = KBCategory.objects.create(title='E-mail', slug='email', description='E-mail')
+        self.jam = KBItem.objects.create(category=self.printers, title='Paper jam', question='The paper is stuck',
+                                         answer='Open the tray', votes=10, recommendations=9)
+        self.toner = KBItem.objects.create(category=self.printers, title='Toner', question='Prints are faint',
+                                           answer='Replace the toner cartridge', votes=1, recommendations=1)
+        self.spam = KBItem.objects.create(category=self.email, title='Spam', question='Too much e-mail',
+                                          answer='Use the spam filter', votes=4, recommendations=1)
+        KBItem.objects.create(category=self.email, title='Unrated', question='Nobody voted', answer='Yet')
+
+    def test_rating(self):
+        self.assertAlmostEqual(KBItem.objects.get(pk=self.jam.pk).rating, 10 / 12.0)
+        self.client.get(reverse('helpdesk:kb_vote', args=[self.spam.pk]), {'vote': 'down'})
+        self.assertAlmostEqual(KBItem.objects.get(pk=self.spam.pk).rating, 2 / 7.0)
+
+    def test_vote(self):
+        url = reverse('helpdesk:kb_vote', args=[self.jam.pk])
+        KBItem.objects.filter(pk=self.jam.pk).update(answer='Changed meanwhile')
+        # the id and category of the item, then two UPDATEs in a savepoint
+        with self.assertNumQueries(5):
+            self.client.get(url, {'vote': 'up'})
+        item = KBItem.objects.get(pk=self.jam.pk)
+        self.assertEqual((item.votes, item.recommendations, item.answer), (11, 10, 'Changed meanwhile'))
+        self.assertAlmostEqual(item.rating, 11 / 13.0)
+
+        # a second vote from the same client is ignored for a while
+        self.client.get(url, {'vote': 'down'})
+        self.client.get(url, {'vote': 'down'}, REMOTE_ADDR='10.0.0.1')
+        item = KBItem.objects.get(pk=self.jam.pk)
+        self.assertEqual((item.votes, item.recommendations), (12, 10))
+
+    def test_top_items(self):
+        self.assertEqual(KBItem.objects.top_items(), [self.jam, self.toner, self.spam])
+        with self.assertNumQueries(0):
+            self.assertEqual(KBItem.objects.top_items(), [self.jam, self.toner, self.spam])
+        self.assertEqual(KBItem.objects.top_items(self.email), [self.spam])
+
+        # a vote changes the ranking straight away
+        for i in range(7):
+            self.client.get(reverse('helpdesk:kb_vote', args=[self.spam.pk]), {'vote': 'up'},
+                            REMOTE_ADDR='10.0.0.%d' % i)
+        self.assertEqual(KBItem.objects.top_items(), [self.jam, self.spam, self.toner])
+        response = self.client.get(reverse('helpdesk:kb_index'))
+        self.assertEqual(list(response.context['top_items']), [self.jam, self.spam, self.toner])
+
+    def test_move_item(self):
+        # an item moved to another category leaves the top items of both
+        self.assertEqual(KBItem.objects.top_items(self.printers), [self.jam, self.toner])
+        self.assertEqual(KBItem.objects.top_items(self.email), [self.spam])
+        toner = KBItem.objects.get(pk=self.toner.pk)
+        toner.category = self.email
+        toner.save()
+        self.assertEqual(KBItem.objects.top_items(self.printers), [self.jam])
+        self.assertEqual(KBItem.objects.top_items(self.email), [self.toner, self.spam])
+
+    def test_search(self):
+        url = reverse('helpdesk:kb_search')
+        response = self.client.get(url, {'q': 'toner cartridge'})
+        self.assertEqual(list(response.context['items']), [self.toner])
+        response = self.client.get(url, {'q': 'the'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual([item['title'] for item in json.loads(response.content.decode())['items']],
+                         ['Paper jam', 'Toner', 'Spam'])
+        self.assertContains(self.client.get(url, {'q': 'scanner'}), 'No articles match')
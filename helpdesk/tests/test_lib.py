@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.template import engines
+from django.test import TestCase
+from django.test.utils import override_settings, CaptureQueriesContext
+
+from helpdesk.lib import safe_template_context
+from helpdesk.models import Queue, Ticket, TicketDependency, TicketNotification, get_site_base_url
+from helpdesk.tests.helpers import ClearCachesMixin
+
+
+class SafeTemplateContextTestCase(ClearCachesMixin, TestCase):
+
+    def setUp(self):
+        self.queue = Queue.objects.create(title='Queue', slug='q')
+        self.ticket = Ticket.objects.create(title='Ticket', queue=self.queue, submitter_email='me@example.com')
+
+    def test_ticket_urls(self):
+        context = safe_template_context(self.ticket, base_url='https://helpdesk.example.com')
+        self.assertEqual(context['ticket']['staff_url'],
+                         'https://helpdesk.example.com' + reverse('helpdesk:view', args=[self.ticket.pk]))
+        self.assertEqual(context['ticket']['ticket_url'],
+                         'https://helpdesk.example.com%s?ticket=q-%d&email=me@example.com' % (
+                             reverse('helpdesk:public_view'), self.ticket.pk))
+        self.assertEqual(context['ticket']['queue']['slug'], 'q')
+
+    @override_settings(SITE_ID=1)
+    def test_site_base_url_cached(self):
+        site = Site.objects.get(pk=1)
+        site.domain = 'support.example.com'
+        site.save()
+        self.assertEqual(get_site_base_url(), 'http://support.example.com')
+        with self.assertNumQueries(0):
+            self.assertTrue(self.ticket.staff_url.startswith('http://support.example.com/'))
+            self.assertTrue(self.ticket.ticket_url.startswith('http://support.example.com/'))
+
+        site.domain = 'helpdesk.example.com'
+        site.save()
+        self.assertTrue(self.ticket.staff_url.startswith('http://helpdesk.example.com/'))
+
+    def test_context_memoized(self):
+        context = safe_template_context(self.ticket)
+        context['comment'] = 'Only in this copy'
+        with self.assertNumQueries(0):
+            again = safe_template_context(self.ticket)
+        self.assertNotIn('comment', again)
+        self.assertIs(again['ticket'], context['ticket'])
+
+        self.ticket.status = Ticket.RESOLVED_STATUS
+        resolved = safe_template_context(self.ticket)
+        self.assertIsNot(resolved['ticket'], context['ticket'])
+        self.assertEqual(resolved['ticket']['status'], Ticket.RESOLVED_STATUS)
+
+    def test_lazy_values(self):
+        other = Ticket.objects.create(title='Other', queue=self.queue)
+        TicketDependency.objects.create(ticket=self.ticket, depends_on=other)
+        self.ticket.refresh_from_db()
+        with self.assertNumQueries(0):
+            context = safe_template_context(self.ticket)
+
+        template = engines['django'].from_string('{{ ticket.get_status }} / {{ ticket.assigned_to }}')
+        with self.assertNumQueries(0):
+            self.assertEqual(template.render(context), 'Open - Open dependencies / Unassigned')
+            self.assertEqual(template.render(context), 'Open - Open dependencies / Unassigned')
+
+    def test_notifications_share_context(self):
+        for address in ('one@example.com', 'two@example.com', 'three@example.com'):
+            TicketNotification.objects.create(to=address, notify_type=TicketNotification.NOTIFY_TYPE_EMAIL)
+        ticket = Ticket.objects.get(pk=self.ticket.pk)
+        with CaptureQueriesContext(connection) as queries:
+            ticket.send_notifications()
+        self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                         ['one@example.com', 'three@example.com', 'two@example.com'])
+        # the context, with the queue of the ticket, is built once
+        self.assertEqual(sum(q['sql'].startswith('SELECT "helpdesk_queue"') for q in queries.captured_queries), 1)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from helpdesk.models import Queue, Ticket, TicketNotification, TicketNotificationRules
+from helpdesk.tests.helpers import ClearCachesMixin
+
+
+class TicketNotificationRulesTestCase(ClearCachesMixin, TestCase):
+
+    def setUp(self):
+        self.queue = Queue.objects.create(title='Queue', slug='q')
+        self.other_queue = Queue.objects.create(title='Other', slug='other')
+
+    def notification(self, to, statuses='', priorities='', queues=()):
+        notification = TicketNotification.objects.create(
+            to=to, notify_type=TicketNotification.NOTIFY_TYPE_EMAIL, statuses=statuses, priorities=priorities)
+        notification.queues.add(*queues)
+        return notification
+
+    def test_rule_table(self):
+        rules = TicketNotificationRules([
+            (1, '', '', None),
+            (2, '1,', '', None),
+            (3, '11,', '1,3,', 7),
+        ])
+        self.assertEqual(rules.match(7, 1, 3), [1, 2])
+        self.assertEqual(rules.match(7, 11, 3), [1, 3])
+        self.assertEqual(rules.match(8, 11, 3), [1])
+        self.assertEqual(rules.match(7, 11, 2), [1])
+
+    def test_for_ticket(self):
+        everything = self.notification('all@example.com')
+        resolved = self.notification('resolved@example.com', statuses='%d,' % Ticket.RESOLVED_STATUS)
+        critical = self.notification('critical@example.com', priorities='1,2,', queues=[self.queue])
+
+        ticket = Ticket.objects.create(title='Ticket', queue=self.queue, priority=2)
+        self.assertEqual(ticket.notifications, [everything, critical])
+        with self.assertNumQueries(0):
+            ticket.status = Ticket.RESOLVED_STATUS
+            self.assertEqual(ticket.notifications, [everything, resolved, critical])
+            ticket.queue = self.other_queue
+            self.assertEqual(ticket.notifications, [everything, resolved])
+
+        critical.queues.add(self.other_queue)
+        self.assertEqual(ticket.notifications, [everything, resolved, critical])
+        resolved.delete()
+        self.assertEqual(ticket.notifications, [everything, critical])
+
+    def test_changed_in_other_process(self):
+        everything = self.notification('all@example.com')
+        ticket = Ticket.objects.create(title='Ticket', queue=self.queue)
+        self.assertEqual(ticket.notifications, [everything])
+
+        # another process changes a rule: its signal only clears its own
+        # copy of the rules, and bumps the version in the shared cache
+        TicketNotification.objects.filter(pk=everything.pk).update(statuses='%d,' % Ticket.CLOSED_STATUS)
+        cache.set(TicketNotification.objects.RULES_VERSION_KEY, 'changed elsewhere', None)
+        self.assertEqual(ticket.notifications, [])
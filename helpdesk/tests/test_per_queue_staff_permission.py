@@ -1,5 +1,5 @@
 from django.contrib.auth import get_user_model
-from django.contrib.auth.models import Permission
+from django.contrib.auth.models import Group, Permission
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.test.client import Client
@@ -65,6 +65,45 @@ class PerQueueStaffMembershipTestCase(TestCase):
         """
         settings.HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION = self.HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION
 
+    def test_accessible_queue_ids(self):
+        """
+        Check that the queues a user can access are resolved once, kept in the
+        cache for later requests, and worked out again once the user's
+        permissions or groups change.
+        """
+        User = get_user_model()
+        self.assertEqual(Queue.objects.accessible_ids(self.user_1), {self.queue_1.pk})
+        with self.assertNumQueries(0):
+            Queue.objects.accessible_ids(self.user_1)
+
+        # each request loads a new user object, whose queues are only kept
+        # in the cache when HELPDESK_QUEUE_PERMISSION_CACHE_TIMEOUT is set
+        user = User.objects.get(pk=self.user_1.pk)
+        self.assertEqual(settings.HELPDESK_QUEUE_PERMISSION_CACHE_TIMEOUT, 0)
+        with self.assertNumQueries(3):
+            self.assertEqual(Queue.objects.accessible_ids(user), {self.queue_1.pk})
+
+        settings.HELPDESK_QUEUE_PERMISSION_CACHE_TIMEOUT = 3600
+        self.addCleanup(setattr, settings, 'HELPDESK_QUEUE_PERMISSION_CACHE_TIMEOUT', 0)
+        Queue.objects.accessible_ids(User.objects.get(pk=self.user_1.pk))
+        user = User.objects.get(pk=self.user_1.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(Queue.objects.has_access(user, self.queue_1))
+            self.assertFalse(Queue.objects.has_access(user, self.queue_2.pk))
+
+        self.user_1.user_permissions.clear()
+        self.assertEqual(Queue.objects.accessible_ids(User.objects.get(pk=self.user_1.pk)), frozenset())
+
+        group = Group.objects.create(name='Queue 2')
+        group.permissions.add(Permission.objects.get(codename=self.queue_2.permission_name[9:]))
+        self.user_1.groups.add(group)
+        user = User.objects.get(pk=self.user_1.pk)
+        self.assertEqual(Queue.objects.accessible_ids(user), {self.queue_2.pk})
+        self.assertEqual(list(Queue.objects.for_user(user)), [self.queue_2])
+        self.assertEqual(Ticket.objects.filter(Queue.objects.user_filter(user)).count(), 4)
+
+        self.assertEqual(Queue.objects.accessible_ids(self.superuser), {self.queue_1.pk, self.queue_2.pk})
+
     def test_dashboard_ticket_counts(self):
         """
         Check that the regular users' dashboard only shows 1 of the 2 queues,
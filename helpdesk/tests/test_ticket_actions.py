@@ -1,9 +1,13 @@
 from django.contrib.auth import get_user_model
 from django.core import mail
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.test import TestCase
 from django.test.client import Client
-from helpdesk.models import CustomField, Queue, Ticket
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from helpdesk.models import CustomField, Queue, Ticket, FollowUp, TicketCC
+from helpdesk.views.staff import show_subscribe, ticketcc_string
 
 try:  # python 3
     from urllib.parse import urlparse
@@ -122,6 +126,66 @@ class TicketActionsTestCase(TestCase):
         response = self.client.post(reverse('helpdesk:update', kwargs={'ticket_id': ticket_id}), post_data, follow=True)
         self.assertContains(response, 'Changed Status from Open to Closed')
 
+    def assertTicketWrites(self, queries, ticket, count):
+        writes = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE "helpdesk_ticket"') and
+                  q['sql'].endswith('WHERE "helpdesk_ticket"."id" = %d' % ticket.id)]
+        self.assertEqual(len(writes), count, writes)
+        return writes
+
+    def test_ticket_writes(self):
+        """Each action writes the ticket row once"""
+        self.loginUser()
+        ticket = Ticket.objects.create(queue=self.queue_public, **self.ticket_data)
+
+        with CaptureQueriesContext(connection) as queries:
+            FollowUp(ticket=ticket, title='Comment', date=timezone.now()).save()
+        writes = self.assertTicketWrites(queries, ticket, 1)
+        self.assertNotIn('"title"', writes[0])
+
+        post_data = {'new_status': Ticket.CLOSED_STATUS, 'comment': 'Closing', 'public': True}
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('helpdesk:update', kwargs={'ticket_id': ticket.id}), post_data)
+        self.assertTicketWrites(queries, ticket, 1)
+        self.assertEqual(Ticket.objects.get(pk=ticket.pk).status, Ticket.CLOSED_STATUS)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('helpdesk:hold', kwargs={'ticket_id': ticket.id}))
+        self.assertTicketWrites(queries, ticket, 1)
+        self.assertTrue(Ticket.objects.get(pk=ticket.pk).on_hold)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(reverse('helpdesk:ticket-hold', kwargs={'pk': ticket.id}))
+        self.assertTicketWrites(queries, ticket, 1)
+        self.assertEqual(Ticket.objects.get(pk=ticket.pk).assigned_to, self.user)
+        self.assertEqual(FollowUp.objects.filter(ticket=ticket).count(), 4)
+
+    def test_subscribe(self):
+        self.loginUser()
+        self.user.email = 'user_1@example.com'
+        self.user.save()
+        User = get_user_model()
+        ticket = Ticket.objects.create(queue=self.queue_public, **self.ticket_data)
+        for i in range(3):
+            TicketCC.objects.create(ticket=ticket, user=User.objects.create(username='cc%d' % i))
+        TicketCC.objects.create(ticket=ticket, email='cc@example.com')
+
+        with self.assertNumQueries(1):
+            self.assertEqual(ticketcc_string(ticket), 'cc0, cc1, cc2, cc@example.com')
+        with self.assertNumQueries(1):
+            self.assertTrue(show_subscribe(self.user, ticket))
+
+        self.client.get(reverse('helpdesk:view', args=[ticket.id]) + '?subscribe')
+        self.assertTrue(TicketCC.objects.filter(ticket=ticket, user=self.user).exists())
+        self.assertFalse(show_subscribe(self.user, ticket))
+
+        # following by e-mail address, or owning the ticket, counts too
+        TicketCC.objects.filter(user=self.user).update(user=None, email='USER_1@example.com')
+        self.assertFalse(show_subscribe(self.user, ticket))
+        TicketCC.objects.filter(email='USER_1@example.com').delete()
+        ticket.assigned_to = self.user
+        with self.assertNumQueries(0):
+            self.assertFalse(show_subscribe(self.user, ticket))
+
     def test_create_ticket_getform(self):
         self.loginUser()
         response = self.client.get(reverse('helpdesk:submit'), follow=True)
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+
+from helpdesk.models import Queue, Ticket, FollowUp
+from helpdesk.templatetags.ticket_to_link import num_to_link, ticket_link_statuses
+
+
+class TicketToLinkTestCase(TestCase):
+
+    def setUp(self):
+        self.queue = Queue.objects.create(title='Queue', slug='q')
+        self.open = Ticket.objects.create(title='Open', queue=self.queue)
+        self.closed = Ticket.objects.create(title='Closed', queue=self.queue, status=Ticket.CLOSED_STATUS)
+
+    def link(self, ticket, style):
+        return " <a href='%s' class='ticket_link_status ticket_link_status_%s'>#%s</a>" % (
+            reverse('helpdesk:view', args=[ticket.pk]), style, ticket.pk)
+
+    def test_links(self):
+        text = 'See #%d and #%d, not #999 or &#39;' % (self.open.pk, self.closed.pk)
+        with self.assertNumQueries(1):
+            html = num_to_link(text)
+        self.assertEqual(html, 'See' + self.link(self.open, 'Open') + ' and' + self.link(self.closed, 'Closed') +
+                         ', not #999 or &#39;')
+        self.assertEqual(num_to_link('No links'), 'No links')
+
+    def test_timeline_statuses(self):
+        followups = [
+            FollowUp(ticket=self.open, title='One', comment='Duplicate of #%d' % self.closed.pk),
+            FollowUp(ticket=self.open, title='Two', comment='Also #%d and #%d' % (self.closed.pk, self.open.pk)),
+            FollowUp(ticket=self.open, title='Three'),
+        ]
+        with self.assertNumQueries(1):
+            statuses = ticket_link_statuses(followups)
+        with self.assertNumQueries(0):
+            for f in followups:
+                num_to_link(f.comment or '', statuses)
+        self.assertEqual(num_to_link(followups[0].comment, statuses),
+                         'Duplicate of' + self.link(self.closed, 'Closed'))
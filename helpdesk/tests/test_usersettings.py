@@ -1,15 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from importlib import import_module
+import pickle
+
 from django.contrib.auth import get_user_model
 from django.core import mail
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from django.test.client import Client
-from helpdesk.models import CustomField, Queue, Ticket
+from helpdesk.lib import b64encode
+from helpdesk.models import CustomField, Queue, Ticket, UserSettings
+from helpdesk.settings import DEFAULT_USER_SETTINGS
 
 try:  # python 3
     from urllib.parse import urlparse
 except ImportError:  # python 2
     from urlparse import urlparse
 
+User = get_user_model()
+
 
 class TicketActionsTestCase(TestCase):
     fixtures = ['emailtemplate.json']
@@ -28,3 +38,40 @@ class TicketActionsTestCase(TestCase):
 
         response = self.client.get(reverse('helpdesk:user_settings'), follow=True)
         self.assertContains(response, "Use the following options")
+
+
+class UserSettingsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('staff', 'staff@example.com', 'password')
+        UserSettings.objects.clear_cache(self.user.pk)
+
+    def test_default_settings(self):
+        usersettings = UserSettings.objects.get(user=self.user)
+        self.assertEqual(usersettings.settings, DEFAULT_USER_SETTINGS)
+        self.assertEqual(UserSettings.objects.settings_for(self.user), DEFAULT_USER_SETTINGS)
+
+    def test_settings_cached(self):
+        UserSettings.objects.settings_for(self.user)
+        # later requests load a new user object
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            UserSettings.objects.settings_for(user)
+            self.assertEqual(UserSettings.objects.settings_for(user)['tickets_per_page'], 25)
+
+    def test_update_setting(self):
+        self.assertTrue(UserSettings.objects.settings_for(self.user)['login_view_ticketlist'])
+        self.user.usersettings_helpdesk.update_setting({'login_view_ticketlist': False})
+        self.assertFalse(UserSettings.objects.settings_for(self.user)['login_view_ticketlist'])
+
+        user = User.objects.get(pk=self.user.pk)
+        self.assertFalse(UserSettings.objects.settings_for(user)['login_view_ticketlist'])
+        self.assertEqual(UserSettings.objects.settings_for(user)['tickets_per_page'], 25)
+
+    def test_migrate_pickled_settings(self):
+        migration = import_module('helpdesk.migrations.0025_usersettings_json')
+        data = {'tickets_per_page': 50, 'login_view_ticketlist': False}
+        self.assertEqual(migration.unpickle_settings(b64encode(pickle.dumps(data)).decode()), data)
+        self.assertEqual(migration.unpickle_settings(str(b64encode(pickle.dumps(data)))), data)
+        self.assertEqual(migration.unpickle_settings('not pickled'), {})
+        self.assertEqual(migration.unpickle_settings(None), {})
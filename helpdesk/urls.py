@@ -13,7 +13,7 @@ from django.contrib.auth import views as auth_views
 from django.views.generic import TemplateView
 
 from helpdesk import settings as helpdesk_settings
-from helpdesk.views import feeds, staff, public, kb
+from helpdesk.views import api, feeds, staff, public, kb
 from helpdesk.views import staff2
 
 
@@ -180,6 +180,8 @@ urlpatterns += [
     url(r'^ticket/close/bulk/(?P<pk>((\d+),?)+)/$', staff2.TicketsBulkCloseView.as_view(), name='tickets-bulk-close'),
     url(r'^ticket/assign/bulk/(?P<pk>((\d+),?)+)/$', staff2.TicketsBulkAssignView.as_view(),
         name='tickets-bulk-assign'),
+    url(r'^ticket/bulk/jobs/add/$', staff2.BulkActionJobAddView.as_view(), name='tickets-bulk-job-add'),
+    url(r'^ticket/bulk/jobs/(?P<pk>\d+)/$', staff2.BulkActionJobProgressView.as_view(), name='tickets-bulk-job'),
     url(r'^saved_search/list/$', staff2.SavedSearchListView.as_view(), name='saved_search-list'),
     url(r'^saved_search/add/$', staff2.SavedSearchAddView.as_view(), name='saved_search-add'),
     url(r'^saved_search/delete/(?P<pk>\d+)/$', staff2.SavedSearchDeleteView.as_view(), name='saved_search-delete'),
@@ -187,6 +189,9 @@ urlpatterns += [
         name='saved_search-switch-shared'),
     url(r'^saved_search/default/(?P<pk>\d+)/$', staff2.SavedSearchSetDefaultView.as_view(),
         name='saved_search-set-default'),
+    url(r'^metrics/email/$', staff2.EmailIngestionMetricsView.as_view(), name='email-metrics'),
+    url(r'^api/tickets/$', api.TicketListAPIView.as_view(), name='api-tickets'),
+    url(r'^api/tickets/(?P<pk>\d+)/$', api.TicketAPIView.as_view(), name='api-ticket'),
 ]
 
 urlpatterns += [
@@ -244,6 +249,10 @@ if helpdesk_settings.HELPDESK_KB_ENABLED:
             kb.index,
             name='kb_index'),
 
+        url(r'^kb/search/$',
+            kb.search,
+            name='kb_search'),
+
         url(r'^kb/(?P<item>[0-9]+)/$',
             kb.item,
             name='kb_item'),
@@ -1,14 +1,18 @@
+import django
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import redirect_to_login
 from django.http import JsonResponse, QueryDict
 from django.core.urlresolvers import reverse
 from django.utils import six
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from django.utils.safestring import mark_safe
 from django_filters import OrderingFilter
 from django_filters.filters import EMPTY_VALUES
 
 from helpdesk import settings as helpdesk_settings
+from helpdesk.models import UserSettings
 
 
 class StaffLoginRequiredMixin(LoginRequiredMixin):
@@ -73,7 +77,7 @@ def get_current_page_size(request):
     PAGINATION_DEFAULT_PAGINATION = helpdesk_settings.HELPDESK_PAGINATION_DEFAULT_PAGINATION
     PAGINATION_MAX_SIZE = helpdesk_settings.HELPDESK_PAGINATION_MAX_SIZE
     try:
-        user_default_page_size = int(request.user.usersettings_helpdesk.settings.get('tickets_per_page')) or None
+        user_default_page_size = int(UserSettings.objects.settings_for(request.user).get('tickets_per_page')) or None
     except ValueError:
         user_default_page_size = None
     page_size = user_default_page_size or PAGINATION_DEFAULT_PAGINATION
@@ -127,3 +131,13 @@ def to_query_dict(d):
             value = [value]
         qdict.setlist(key, value)
     return qdict
+
+
+def conditional_response(request, etag, response=None):
+    """
+    get_conditional_response() for an unquoted etag: Django < 1.11 compares
+    the ETags of the request unquoted, later versions quoted.
+    """
+    if django.VERSION >= (1, 11):
+        etag = quote_etag(etag)
+    return get_conditional_response(request, etag=etag, response=response)
@@ -0,0 +1,103 @@
+"""
+django-helpdesk - A Django powered ticket tracker for small enterprise.
+
+views/api.py - A read-only JSON API over the tickets, for dashboards and
+               scripts which poll the helpdesk.
+"""
+from hashlib import md5
+
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils.http import quote_etag
+from django.views.generic import View
+
+from helpdesk.filters import TicketsFilter
+from helpdesk.models import Ticket, Queue
+from helpdesk.utils import StaffLoginRequiredMixin, conditional_response, get_current_page_size
+
+
+class TicketAPIMixin(StaffLoginRequiredMixin):
+    """
+    Renders tickets as the columns named by the `fields` parameter, read with
+    values(), and answers requests whose If-None-Match matches the ETag of the
+    response with 304.
+    """
+    FIELDS = ('id', 'title', 'queue', 'status', 'priority', 'assigned_to', 'submitter_email', 'created',
+              'modified', 'modified_status', 'due_date', 'on_hold', 'open_dependency_count', 'description',
+              'resolution')
+    default_fields = FIELDS
+
+    def get_fields(self):
+        """The requested fields, or None when some of them are unknown."""
+        fields = [f for f in self.request.GET.get('fields', '').split(',') if f]
+        if not fields:
+            return self.default_fields
+        if not set(fields).issubset(self.FIELDS):
+            return None
+        return fields
+
+    def get_queryset(self):
+        return Ticket.objects.filter(queue__in=Queue.objects.for_user(self.request.user))
+
+    def render_result(self, data):
+        response = JsonResponse(data)
+        etag = md5(response.content).hexdigest()
+        response['ETag'] = quote_etag(etag)
+        return conditional_response(self.request, etag, response=response)
+
+    def invalid_fields(self):
+        return JsonResponse({'errors': {'fields': ['Choose from %s.' % ', '.join(self.FIELDS)]}}, status=400)
+
+
+class TicketListAPIView(TicketAPIMixin, View):
+    """
+    The tickets matching the TicketsFilter parameters, newest first. Pages of
+    `page_size` tickets are walked with `after`, the id of the last ticket of
+    the previous page, given in the `next` URL of each page.
+    """
+    default_fields = ('id', 'title', 'queue', 'status', 'priority', 'assigned_to', 'created', 'modified')
+
+    def get(self, request, *args, **kwargs):
+        fields = self.get_fields()
+        if fields is None:
+            return self.invalid_fields()
+
+        data = request.GET.copy()
+        for param in ('fields', 'after', 'order_by', 'page', 'page_size'):
+            data.pop(param, None)
+        tickets = TicketsFilter(data, queryset=self.get_queryset())
+        if not tickets.form.is_valid():
+            return JsonResponse({'errors': tickets.form.errors}, status=400)
+
+        tickets = tickets.qs
+        after = request.GET.get('after')
+        if after:
+            try:
+                tickets = tickets.filter(id__lt=int(after))
+            except ValueError:
+                return JsonResponse({'errors': {'after': ['Enter a ticket id.']}}, status=400)
+
+        # the id is always read, for the cursor
+        columns = ['id'] + [f for f in fields if f != 'id']
+        page_size = get_current_page_size(request)
+        rows = list(tickets.order_by('-id').values(*columns)[:page_size + 1])
+        next_url = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            params = request.GET.copy()
+            params['after'] = rows[-1]['id']
+            next_url = '%s?%s' % (request.path, params.urlencode())
+        if 'id' not in fields:
+            for row in rows:
+                del row['id']
+        return self.render_result({'tickets': rows, 'next': next_url})
+
+
+class TicketAPIView(TicketAPIMixin, View):
+
+    def get(self, request, *args, **kwargs):
+        fields = self.get_fields()
+        if fields is None:
+            return self.invalid_fields()
+        ticket = get_object_or_404(self.get_queryset().values(*fields), pk=kwargs['pk'])
+        return self.render_result({'ticket': ticket})
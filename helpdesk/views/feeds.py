@@ -7,19 +7,99 @@ views/feeds.py - A handful of staff-only RSS feeds to provide ticket details
                  to feed readers or similar software.
 """
 
+from hashlib import md5
+
 from django.contrib.auth import get_user_model
 from django.contrib.syndication.views import Feed
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
 from django.core.urlresolvers import reverse
-from django.db.models import Q
-from django.utils.translation import ugettext as _
+from django.db.models import Count, Max
+from django.http import Http404, HttpResponse
+from django.utils.http import quote_etag
+from django.utils.translation import get_language, ugettext as _
 from django.shortcuts import get_object_or_404
 
+from helpdesk import settings as helpdesk_settings
 from helpdesk.models import Ticket, FollowUp, Queue
+from helpdesk.utils import conditional_response
 
 User = get_user_model()
 
 
-class OpenTicketsByUser(Feed):
+class CachedFeed(Feed):
+    """
+    A feed with an ETag worked out from the state of its items, which
+    answers conditional GETs and keeps the rendered feed in the cache until
+    that state changes or HELPDESK_FEED_CACHE_TIMEOUT passes.
+
+    There is no Last-Modified header: the latest change to the items still
+    in a feed goes back in time when an item leaves it.
+    """
+
+    def get_state(self, obj):
+        """
+        A value which changes whenever the feed does. By default the ids of
+        its items, which loads them; feeds can give a cheaper value.
+        """
+        return [item.pk for item in self._get_dynamic_attr('items', obj)]
+
+    def __call__(self, request, *args, **kwargs):
+        try:
+            obj = self.get_object(request, *args, **kwargs)
+        except ObjectDoesNotExist:
+            raise Http404('Feed object does not exist.')
+
+        state = self.get_state(obj)
+        etag = md5(('%s:%s' % (self.__class__.__name__, state)).encode('utf-8')).hexdigest()
+        response = conditional_response(request, etag)
+        if response is not None:
+            return response
+
+        key = 'helpdesk_feed_%s' % md5(('%s:%s:%s' % (
+            request.build_absolute_uri(), get_language(), etag)).encode('utf-8')).hexdigest()
+        rendered = cache.get(key)
+        if rendered is None:
+            feedgen = self.get_feed(obj, request)
+            rendered = (feedgen.content_type, feedgen.writeString('utf-8'))
+            if helpdesk_settings.HELPDESK_FEED_CACHE_TIMEOUT:
+                cache.set(key, rendered, helpdesk_settings.HELPDESK_FEED_CACHE_TIMEOUT)
+
+        response = HttpResponse(rendered[1], content_type=rendered[0])
+        response['ETag'] = quote_etag(etag)
+        return response
+
+
+class TicketFeed(CachedFeed):
+    """
+    A feed of the most recently created of some open tickets, loaded along
+    with their queues and owners.
+    """
+    title_template = 'helpdesk/rss/ticket_title.html'
+    description_template = 'helpdesk/rss/ticket_description.html'
+
+    def get_queryset(self, obj):
+        return Ticket.objects.filter(status__in=(Ticket.OPEN_STATUS, Ticket.REOPENED_STATUS))
+
+    def get_state(self, obj):
+        state = self.get_queryset(obj).aggregate(latest=Max('modified'), count=Count('id'))
+        return state['latest'], state['count']
+
+    def items(self, obj):
+        tickets = self.get_queryset(obj).select_related('queue', 'assigned_to')
+        return tickets.order_by('-created', '-id')[:helpdesk_settings.HELPDESK_FEED_MAX_ITEMS]
+
+    def item_pubdate(self, item):
+        return item.created
+
+    def item_author_name(self, item):
+        if item.assigned_to:
+            return item.assigned_to.get_username()
+        else:
+            return _('Unassigned')
+
+
+class OpenTicketsByUser(TicketFeed):
     title_template = 'helpdesk/rss/ticket_title.html'
     description_template = 'helpdesk/rss/ticket_description.html'
 
@@ -67,58 +147,23 @@ class OpenTicketsByUser(Feed):
                 obj['user'].id,
             )
 
-    def items(self, obj):
+    def get_queryset(self, obj):
+        tickets = super(OpenTicketsByUser, self).get_queryset(obj).filter(assigned_to=obj['user'])
         if obj['queue']:
-            return Ticket.objects.filter(
-                assigned_to=obj['user']
-            ).filter(
-                queue=obj['queue']
-            ).filter(
-                Q(status=Ticket.OPEN_STATUS) | Q(status=Ticket.REOPENED_STATUS)
-            )
-        else:
-            return Ticket.objects.filter(
-                assigned_to=obj['user']
-            ).filter(
-                Q(status=Ticket.OPEN_STATUS) | Q(status=Ticket.REOPENED_STATUS)
-            )
+            tickets = tickets.filter(queue=obj['queue'])
+        return tickets
 
-    def item_pubdate(self, item):
-        return item.created
-
-    def item_author_name(self, item):
-        if item.assigned_to:
-            return item.assigned_to.get_username()
-        else:
-            return _('Unassigned')
-
-
-class UnassignedTickets(Feed):
-    title_template = 'helpdesk/rss/ticket_title.html'
-    description_template = 'helpdesk/rss/ticket_description.html'
 
+class UnassignedTickets(TicketFeed):
     title = _('Helpdesk: Unassigned Tickets')
     description = _('Unassigned Open and Reopened tickets')
     link = ''  # '%s?assigned_to=' % reverse('helpdesk:list')
 
-    def items(self, obj):
-        return Ticket.objects.filter(
-            assigned_to__isnull=True
-        ).filter(
-            Q(status=Ticket.OPEN_STATUS) | Q(status=Ticket.REOPENED_STATUS)
-        )
-
-    def item_pubdate(self, item):
-        return item.created
-
-    def item_author_name(self, item):
-        if item.assigned_to:
-            return item.assigned_to.get_username()
-        else:
-            return _('Unassigned')
+    def get_queryset(self, obj):
+        return super(UnassignedTickets, self).get_queryset(obj).filter(assigned_to__isnull=True)
 
 
-class RecentFollowUps(Feed):
+class RecentFollowUps(CachedFeed):
     title_template = 'helpdesk/rss/recent_activity_title.html'
     description_template = 'helpdesk/rss/recent_activity_description.html'
 
@@ -126,13 +171,15 @@ class RecentFollowUps(Feed):
     description = _('Recent FollowUps, such as e-mail replies, comments, attachments and resolutions')
     link = '/tickets/'  # reverse('helpdesk:list')
 
+    def get_state(self, obj):
+        # edited follow-ups are saved again as new ones
+        return list(FollowUp.objects.order_by('-date').values_list('id', flat=True)[:20])
+
     def items(self):
-        return FollowUp.objects.order_by('-date')[:20]
+        return FollowUp.objects.select_related('user', 'ticket__queue').order_by('-date')[:20]
 
 
-class OpenTicketsByQueue(Feed):
-    title_template = 'helpdesk/rss/ticket_title.html'
-    description_template = 'helpdesk/rss/ticket_description.html'
+class OpenTicketsByQueue(TicketFeed):
 
     def get_object(self, request, queue_slug):
         return get_object_or_404(Queue, slug=queue_slug)
@@ -153,18 +200,5 @@ class OpenTicketsByQueue(Feed):
             obj.id,
         )
 
-    def items(self, obj):
-        return Ticket.objects.filter(
-            queue=obj
-        ).filter(
-            Q(status=Ticket.OPEN_STATUS) | Q(status=Ticket.REOPENED_STATUS)
-        )
-
-    def item_pubdate(self, item):
-        return item.created
-
-    def item_author_name(self, item):
-        if item.assigned_to:
-            return item.assigned_to.get_username()
-        else:
-            return _('Unassigned')
+    def get_queryset(self, obj):
+        return super(OpenTicketsByQueue, self).get_queryset(obj).filter(queue=obj)
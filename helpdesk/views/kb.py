@@ -8,18 +8,24 @@ views/kb.py - Public-facing knowledgebase views. The knowledgebase is a
               resolutions to common problems.
 """
 
-from django.http import HttpResponseRedirect
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Q
+from django.http import HttpResponseRedirect, JsonResponse
 from django.shortcuts import render, get_object_or_404
 
 from helpdesk import settings as helpdesk_settings
 from helpdesk.models import KBCategory, KBItem
 
+# most items returned by a search
+SEARCH_RESULTS = 20
+
 
 def index(request):
     category_list = KBCategory.objects.all()
-    # TODO: It'd be great to have a list of most popular items here.
     return render(request, 'helpdesk/kb_index.html', {
         'kb_categories': category_list,
+        'top_items': KBItem.objects.top_items(),
         'helpdesk_settings': helpdesk_settings,
     })
 
@@ -30,6 +36,44 @@ def category(request, slug):
     return render(request, 'helpdesk/kb_category.html', {
         'category': category,
         'items': items,
+        'top_items': KBItem.objects.top_items(category),
+        'helpdesk_settings': helpdesk_settings,
+    })
+
+
+def search_items(query):
+    """
+    The items matching the words of the query, best matches first. PostgreSQL
+    ranks them with its full text search; other databases look for items
+    containing every word, best rated first.
+    """
+    items = KBItem.objects.select_related('category')
+    if connection.vendor == 'postgresql':
+        from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+        vector = SearchVector('title', weight='A') + SearchVector('question', weight='B') + \
+            SearchVector('answer', weight='C')
+        search = SearchQuery(query)
+        items = items.annotate(rank=SearchRank(vector, search)).filter(rank__gt=0).order_by('-rank', '-rating')
+    else:
+        for word in query.split():
+            items = items.filter(Q(title__icontains=word) | Q(question__icontains=word) | Q(answer__icontains=word))
+        items = items.order_by('-rating', 'title')
+    return items[:SEARCH_RESULTS]
+
+
+def search(request):
+    query = request.GET.get('q', '').strip()
+    items = search_items(query) if query else []
+    if request.is_ajax():
+        return JsonResponse({'items': [{
+            'title': item.title,
+            'question': item.question,
+            'category': item.category.title,
+            'url': item.get_absolute_url(),
+        } for item in items]})
+    return render(request, 'helpdesk/kb_search.html', {
+        'query': query,
+        'items': items,
         'helpdesk_settings': helpdesk_settings,
     })
 
@@ -43,12 +87,16 @@ def item(request, item):
 
 
 def vote(request, item):
-    item = get_object_or_404(KBItem, pk=item)
+    item = get_object_or_404(KBItem.objects.only('id', 'category'), pk=item)
     vote = request.GET.get('vote', None)
     if vote in ('up', 'down'):
-        item.votes += 1
-        if vote == 'up':
-            item.recommendations += 1
-        item.save()
+        # each client votes once per item every HELPDESK_KB_VOTE_THROTTLE
+        timeout = helpdesk_settings.HELPDESK_KB_VOTE_THROTTLE
+        if request.user.is_authenticated():
+            client = 'user_%s' % request.user.pk
+        else:
+            client = request.META.get('REMOTE_ADDR', '')
+        if not timeout or cache.add('helpdesk_kb_vote_%s_%s' % (item.pk, client), True, timeout):
+            KBItem.objects.vote(item, vote == 'up')
 
     return HttpResponseRedirect(item.get_absolute_url())
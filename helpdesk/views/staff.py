@@ -37,12 +37,12 @@ from helpdesk.forms import (
     TicketTimeTrackForm, TicketMoneyTrackForm)
 from helpdesk.lib import (
     send_templated_mail, query_to_dict, apply_query, safe_template_context,
-    process_attachments,
+    process_attachments, bulk_update_tickets, queue_closed_mail, MailBatch,
 )
 from helpdesk.models import (
     Ticket, Queue, FollowUp, TicketChange, PreSetReply, Attachment, SavedSearch,
     IgnoreEmail, TicketCC, TicketDependency,
-    TicketTimeTrack, TicketMoneyTrack)
+    TicketTimeTrack, TicketMoneyTrack, UserSettings)
 from helpdesk import settings as helpdesk_settings
 
 User = get_user_model()
@@ -62,33 +62,22 @@ superuser_required = user_passes_test(
 
 
 def _get_user_queues(user):
-    """Return the list of Queues the user can access.
+    """Return the Queues the user can access.
 
     :param user: The User (the class should have the has_perm method)
-    :return: A Python list of Queues
+    :return: A QuerySet of Queues
     """
-    all_queues = Queue.objects.all()
-    limit_queues_by_user = \
-        helpdesk_settings.HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION \
-        and not user.is_superuser
-    if limit_queues_by_user:
-        id_list = [q.pk for q in all_queues if user.has_perm(q.permission_name)]
-        return all_queues.filter(pk__in=id_list)
-    else:
-        return all_queues
+    return Queue.objects.for_user(user)
 
 
 def _has_access_to_queue(user, queue):
     """Check if a certain user can access a certain queue.
 
     :param user: The User (the class should have the has_perm method)
-    :param queue: The django-helpdesk Queue instance
+    :param queue: The django-helpdesk Queue instance, or its id
     :return: True if the user has permission (either by default or explicitly), false otherwise
     """
-    if user.is_superuser or not helpdesk_settings.HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION:
-        return True
-    else:
-        return user.has_perm(queue.permission_name)
+    return Queue.objects.has_access(user, queue)
 
 
 def dashboard(request):
@@ -138,7 +127,7 @@ def dashboard(request):
     # Queue 1    10     4
     # Queue 2     4    12
 
-    queues = _get_user_queues(request.user).values_list('id', flat=True)
+    queues = sorted(Queue.objects.accessible_ids(request.user))
 
     from_clause = """FROM    helpdesk_ticket t,
                     helpdesk_queue q"""
@@ -203,14 +192,11 @@ def followup_edit(request, ticket_id, followup_id):
             'new_status': followup.new_status,
         })
 
-        ticketcc_string, show_subscribe = \
-            return_ticketccstring_and_show_subscribe(request.user, ticket)
-
         return render(request, 'helpdesk/followup_edit.html', {
             'followup': followup,
             'ticket': ticket,
             'form': form,
-            'ticketcc_string': ticketcc_string,
+            'ticketcc_string': ticketcc_string(ticket),
         })
     elif request.method == 'POST':
         form = EditFollowUpForm(request.POST)
@@ -271,9 +257,7 @@ def view_ticket(request, ticket_id):
 
     if 'subscribe' in request.GET:
         # Allow the user to subscribe him/herself to the ticket whilst viewing it.
-        ticket_cc, show_subscribe = \
-            return_ticketccstring_and_show_subscribe(request.user, ticket)
-        if show_subscribe:
+        if show_subscribe(request.user, ticket):
             subscribe_staff_member_to_ticket(ticket, request.user)
             return HttpResponseRedirect(reverse('helpdesk:view', args=[ticket.id]))
 
@@ -303,9 +287,6 @@ def view_ticket(request, ticket_id):
     # TODO: shouldn't this template get a form to begin with?
     form = TicketForm(initial={'due_date': ticket.due_date})
 
-    ticketcc_string, show_subscribe = \
-        return_ticketccstring_and_show_subscribe(request.user, ticket)
-
     return render(request, 'helpdesk/ticket.html', {
         'ticket': ticket,
         'form': form,
@@ -313,45 +294,30 @@ def view_ticket(request, ticket_id):
         'priorities': Ticket.PRIORITY_CHOICES,
         'preset_replies': PreSetReply.objects.filter(
             Q(queues=ticket.queue) | Q(queues__isnull=True)),
-        'ticketcc_string': ticketcc_string,
-        'SHOW_SUBSCRIBE': show_subscribe,
+        'ticketcc_string': ticketcc_string(ticket),
+        'SHOW_SUBSCRIBE': show_subscribe(request.user, ticket),
     })
 view_ticket = staff_member_required(view_ticket)
 
 
-def return_ticketccstring_and_show_subscribe(user, ticket):
-    """used in view_ticket() and followup_edit()"""
-    # create the ticketcc_string and check whether current user is already
-    # subscribed
-    username = user.get_username().upper()
-    useremail = user.email.upper()
-    strings_to_check = list()
-    strings_to_check.append(username)
-    strings_to_check.append(useremail)
-
-    ticketcc_string = ''
-    all_ticketcc = ticket.ticketcc_set.all()
-    counter_all_ticketcc = len(all_ticketcc) - 1
-    show_subscribe = True
-    for i, ticketcc in enumerate(all_ticketcc):
-        ticketcc_this_entry = str(ticketcc.display)
-        ticketcc_string += ticketcc_this_entry
-        if i < counter_all_ticketcc:
-            ticketcc_string += ', '
-        if strings_to_check.__contains__(ticketcc_this_entry.upper()):
-            show_subscribe = False
-
-    # check whether current user is a submitter or assigned to ticket
-    assignedto_username = str(ticket.assigned_to).upper()
-    strings_to_check = list()
-    if ticket.submitter_email is not None:
-        submitter_email = ticket.submitter_email.upper()
-        strings_to_check.append(submitter_email)
-    strings_to_check.append(assignedto_username)
-    if strings_to_check.__contains__(username) or strings_to_check.__contains__(useremail):
-        show_subscribe = False
-
-    return ticketcc_string, show_subscribe
+def ticketcc_string(ticket):
+    """The people following the ticket, with their users loaded in the same query."""
+    return ', '.join('%s' % ticketcc.display for ticketcc in ticket.ticketcc_set.select_related('user'))
+
+
+def show_subscribe(user, ticket):
+    """
+    Whether the user may subscribe to the ticket: they don't already follow
+    it, either as a user or by e-mail address, and they are neither its
+    submitter nor its owner.
+    """
+    email = (user.email or '').upper()
+    if ticket.assigned_to_id == user.pk or (email and (ticket.submitter_email or '').upper() == email):
+        return False
+    followers = Q(user=user)
+    if email:
+        followers |= Q(email__iexact=email)
+    return not TicketCC.objects.filter(followers, ticket=ticket).exists()
 
 
 def subscribe_staff_member_to_ticket(ticket, user):
@@ -446,7 +412,6 @@ def update_ticket(request, ticket_id, public=False):
     if new_status != ticket.status:
         ticket.status = new_status
         ticket.modified_status = f.date
-        ticket.save()
         f.new_status = new_status
         if f.title:
             f.title += ' and %s' % ticket.get_status_display()
@@ -459,7 +424,8 @@ def update_ticket(request, ticket_id, public=False):
         else:
             f.title = _('Updated')
 
-    f.save()
+    # the ticket is saved once all the changes are made, below
+    f.save(touch_ticket=False)
 
     files = process_attachments(f, request.FILES.getlist('attachment'))
 
@@ -580,10 +546,10 @@ def update_ticket(request, ticket_id, public=False):
 
         if (not reassigned or
                 (reassigned and
-                    ticket.assigned_to.usersettings_helpdesk.settings.get(
+                    UserSettings.objects.settings_for(ticket.assigned_to).get(
                         'email_on_ticket_assign', False))) or \
             (not reassigned and
-                ticket.assigned_to.usersettings_helpdesk.settings.get(
+                UserSettings.objects.settings_for(ticket.assigned_to).get(
                     'email_on_ticket_change', False)):
             send_templated_mail(
                 template_staff,
@@ -623,8 +589,7 @@ def update_ticket(request, ticket_id, public=False):
 
     # auto subscribe user if enabled
     if helpdesk_settings.HELPDESK_AUTO_SUBSCRIBE_ON_TICKET_RESPONSE and request.user.is_authenticated():
-        ticketcc_string, SHOW_SUBSCRIBE = return_ticketccstring_and_show_subscribe(request.user, ticket)
-        if SHOW_SUBSCRIBE:
+        if show_subscribe(request.user, ticket):
             subscribe_staff_member_to_ticket(ticket, request.user)
 
     return return_to_ticket(request.user, helpdesk_settings, ticket)
@@ -653,105 +618,46 @@ def mass_update(request):
         user = request.user
         action = 'assign'
 
-    for t in Ticket.objects.filter(id__in=tickets):
-        if not _has_access_to_queue(request.user, t.queue):
-            continue
-        now = timezone.now()
-        if action == 'assign' and t.assigned_to != user:
-            t.assigned_to = user
-            t.save()
-            f = FollowUp(ticket=t,
-                         date=now,
-                         title=_('Assigned to %(username)s in bulk update' % {
-                             'username': user.get_username()
-                         }),
-                         public=True,
-                         user=request.user)
-            f.save()
-        elif action == 'unassign' and t.assigned_to is not None:
-            t.assigned_to = None
-            t.save()
-            f = FollowUp(ticket=t,
-                         date=now,
-                         title=_('Unassigned in bulk update'),
-                         public=True,
-                         user=request.user)
-            f.save()
-        elif action == 'close' and t.status != Ticket.CLOSED_STATUS:
-            t.status = Ticket.CLOSED_STATUS
-            t.modified_status = now
-            t.save()
-            f = FollowUp(ticket=t,
-                         date=now,
-                         title=_('Closed in bulk update'),
-                         public=False,
-                         user=request.user,
-                         new_status=Ticket.CLOSED_STATUS)
-            f.save()
-        elif action == 'close_public' and t.status != Ticket.CLOSED_STATUS:
-            t.status = Ticket.CLOSED_STATUS
-            t.modified_status = now
-            t.save()
-            f = FollowUp(ticket=t,
-                         date=now,
-                         title=_('Closed in bulk update'),
-                         public=True,
-                         user=request.user,
-                         new_status=Ticket.CLOSED_STATUS)
-            f.save()
-            # Send email to Submitter, Owner, Queue CC
-            context = safe_template_context(t)
-            context.update(resolution=t.resolution,
-                           queue=t.queue)
-
-            messages_sent_to = []
-
-            if t.submitter_email:
-                send_templated_mail(
-                    'closed_submitter',
-                    context,
-                    recipients=t.submitter_email,
-                    sender=t.queue.from_address,
-                    fail_silently=True,
-                )
-                messages_sent_to.append(t.submitter_email)
-
-            for cc in t.ticketcc_set.all():
-                if cc.email_address not in messages_sent_to:
-                    send_templated_mail(
-                        'closed_submitter',
-                        context,
-                        recipients=cc.email_address,
-                        sender=t.queue.from_address,
-                        fail_silently=True,
-                    )
-                    messages_sent_to.append(cc.email_address)
-
-            if t.assigned_to and \
-                    request.user != t.assigned_to and \
-                    t.assigned_to.email and \
-                    t.assigned_to.email not in messages_sent_to:
-                send_templated_mail(
-                    'closed_owner',
-                    context,
-                    recipients=t.assigned_to.email,
-                    sender=t.queue.from_address,
-                    fail_silently=True,
-                )
-                messages_sent_to.append(t.assigned_to.email)
+    tickets = Ticket.objects.filter(id__in=tickets).filter(Queue.objects.user_filter(request.user))
 
-            if t.queue.updated_ticket_cc and \
-                    t.queue.updated_ticket_cc not in messages_sent_to:
-                send_templated_mail(
-                    'closed_cc',
-                    context,
-                    recipients=t.queue.updated_ticket_cc,
-                    sender=t.queue.from_address,
-                    fail_silently=True,
-                )
-
-        elif action == 'delete':
-            t.delete()
+    if action == 'assign':
+        bulk_update_tickets(
+            tickets.exclude(assigned_to=user),
+            request.user,
+            _('Assigned to %(username)s in bulk update' % {
+                'username': user.get_username()
+            }),
+            assigned_to=user,
+        )
+    elif action == 'unassign':
+        bulk_update_tickets(
+            tickets.filter(assigned_to__isnull=False),
+            request.user,
+            _('Unassigned in bulk update'),
+            assigned_to=None,
+        )
+    elif action == 'close':
+        bulk_update_tickets(
+            tickets.exclude(status=Ticket.CLOSED_STATUS),
+            request.user,
+            _('Closed in bulk update'),
+            public=False,
+            new_status=Ticket.CLOSED_STATUS,
+        )
+    elif action == 'close_public':
+        closed = bulk_update_tickets(
+            tickets.exclude(status=Ticket.CLOSED_STATUS).prefetch_related('ticketcc_set__user'),
+            request.user,
+            _('Closed in bulk update'),
+            public=True,
+            new_status=Ticket.CLOSED_STATUS,
+        )
+        # Send email to Submitter, Owner, Queue CC
+        with MailBatch(fail_silently=True) as mails:
+            for t in closed:
+                queue_closed_mail(mails, t, request.user)
+    elif action == 'delete':
+        tickets.delete()
 
     return HttpResponseRedirect(reverse('helpdesk:list'))
 mass_update = staff_member_required(mass_update)
@@ -923,7 +829,7 @@ def ticket_list(request):
     return render(request, 'helpdesk/ticket_list.html', dict(
         context,
         tickets=ticket_qs,
-        default_tickets_per_page=request.user.usersettings_helpdesk.settings.get('tickets_per_page') or 25,
+        default_tickets_per_page=UserSettings.objects.settings_for(request.user).get('tickets_per_page') or 25,
         user_choices=User.objects.filter(is_active=True, is_staff=True),
         queue_choices=user_queues,
         status_choices=Ticket.STATUS_CHOICES,
@@ -971,7 +877,7 @@ def create_ticket(request):
                 return HttpResponseRedirect(reverse('helpdesk:dashboard'))
     else:
         initial_data = {}
-        if request.user.usersettings_helpdesk.settings.get('use_email_as_submitter', False) and request.user.email:
+        if UserSettings.objects.settings_for(request.user).get('use_email_as_submitter', False) and request.user.email:
             initial_data['submitter_email'] = request.user.email
         if 'queue' in request.GET:
             initial_data['queue'] = request.GET['queue']
@@ -1023,9 +929,9 @@ def hold_ticket(request, ticket_id, unhold=False):
         date=timezone.now(),
         public=True,
     )
-    f.save()
+    f.save(touch_ticket=False)
 
-    ticket.save()
+    ticket.save(update_fields=['on_hold', 'modified'])
 
     return HttpResponseRedirect(ticket.get_absolute_url())
 hold_ticket = staff_member_required(hold_ticket)
@@ -1055,7 +961,7 @@ def report_index(request):
     # Queue 1    10     4
     # Queue 2     4    12
 
-    queues = _get_user_queues(request.user).values_list('id', flat=True)
+    queues = sorted(Queue.objects.accessible_ids(request.user))
 
     from_clause = """FROM    helpdesk_ticket t,
                     helpdesk_queue q"""
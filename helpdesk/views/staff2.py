@@ -1,9 +1,11 @@
 import csv
 import json
-from django.http import QueryDict, HttpResponseBadRequest, HttpResponse
+from datetime import timedelta
+
+from django.http import QueryDict, HttpResponseBadRequest, HttpResponse, JsonResponse
 from django.contrib.auth import get_user_model
 from django.db import transaction
-from django.db.models import Q, Sum, F, Case, When, Value
+from django.db.models import Q, Sum, F, Case, When, Value, Count, Max, IntegerField
 from django.shortcuts import render, redirect, get_object_or_404
 from django.utils.translation import ugettext as _
 from django.core.urlresolvers import reverse
@@ -12,13 +14,13 @@ from django.views.generic import View, CreateView
 from django.views.generic.detail import SingleObjectMixin
 
 from helpdesk.filters import TicketsFilter
-from helpdesk.forms import TicketsBulkAssignForm, SavedSearchAddForm
-from helpdesk.lib import safe_template_context, send_templated_mail
+from helpdesk.forms import TicketsBulkAssignForm, SavedSearchAddForm, BulkActionJobForm
+from helpdesk.lib import bulk_update_tickets, queue_closed_mail, MailBatch
 from helpdesk.templatetags.helpdesk_util_tags import seconds_to_time
 from helpdesk.utils import StaffLoginRequiredMixin, get_current_page_size, success_message, BulkableActionMixin, \
     error_message, warning_message, to_bool, send_form_errors, to_query_dict
-from helpdesk.models import Ticket, Queue, FollowUp, SavedSearch, TicketTimeTrack
-from helpdesk import settings as helpdesk_settings
+from helpdesk.models import Ticket, Queue, FollowUp, SavedSearch, TicketTimeTrack, EmailIngestionRun, UserSettings, \
+    BulkActionJob
 from helpdesk.lib import b64decode, b64encode
 
 
@@ -26,33 +28,22 @@ User = get_user_model()
 
 
 def _get_user_queues(user):
-    """Return the list of Queues the user can access.
+    """Return the Queues the user can access.
 
     :param user: The User (the class should have the has_perm method)
-    :return: A Python list of Queues
+    :return: A QuerySet of Queues
     """
-    all_queues = Queue.objects.all()
-    limit_queues_by_user = \
-        helpdesk_settings.HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION \
-        and not user.is_superuser
-    if limit_queues_by_user:
-        id_list = [q.pk for q in all_queues if user.has_perm(q.permission_name)]
-        return all_queues.filter(pk__in=id_list)
-    else:
-        return all_queues
+    return Queue.objects.for_user(user)
 
 
 def _has_access_to_queue(user, queue):
     """Check if a certain user can access a certain queue.
 
     :param user: The User (the class should have the has_perm method)
-    :param queue: The django-helpdesk Queue instance
+    :param queue: The django-helpdesk Queue instance, or its id
     :return: True if the user has permission (either by default or explicitly), false otherwise
     """
-    if user.is_superuser or not helpdesk_settings.HELPDESK_ENABLE_PER_QUEUE_STAFF_PERMISSION:
-        return True
-    else:
-        return user.has_perm(queue.permission_name)
+    return Queue.objects.has_access(user, queue)
 
 
 def _has_access_to_saved_search(user, saved_search):
@@ -96,7 +87,7 @@ class TicketListView(StaffLoginRequiredMixin, View):
         user_saved_queries = SavedSearch.objects.filter(Q(user=request.user) | Q(shared__exact=True))
         use_default = False
         if (not saved_query) and set(data.keys()).issubset({'order_by', 'page_size', 'page'}):
-            saved_query = request.user.usersettings_helpdesk.settings.get('default_ticket_saved_query')
+            saved_query = UserSettings.objects.settings_for(request.user).get('default_ticket_saved_query')
             use_default = True
 
         if saved_query:
@@ -128,6 +119,10 @@ class TicketListView(StaffLoginRequiredMixin, View):
             'tickets': tickets,
             'page_size': get_current_page_size(request),
             'bulk_assign_form': TicketsBulkAssignForm(),
+            'bulk_job_form': BulkActionJobForm(user=request.user, initial={
+                'query': urlsafe_query,
+                'saved_query': saved_query.pk if saved_query else None,
+            }),
             'urlsafe_query': urlsafe_query,
             'saved_query': saved_query,
             'user_saved_queries': user_saved_queries,
@@ -222,12 +217,12 @@ class TicketHoldView(StaffLoginRequiredMixin, SingleObjectMixin, View):
             return redirect(self.get_success_url())
 
         ticket.assigned_to = request.user
-        ticket.save()
+        ticket.save(update_fields=['assigned_to', 'modified'])
         f = FollowUp(ticket=ticket,
                      date=timezone.now(),
                      title=_('Assigned to [{}]'.format(request.user.get_username())),
                      user=request.user)
-        f.save()
+        f.save(touch_ticket=False)
         success_message('[{}] Ticket assigned to you successfully!'.format(ticket), request)
         return redirect(self.get_success_url())
 
@@ -236,20 +231,31 @@ class TicketHoldView(StaffLoginRequiredMixin, SingleObjectMixin, View):
         return self.request.META.get('HTTP_REFERER') or reverse('helpdesk:ticket-list')
 
 
+def _accessible_tickets(request, tickets):
+    """Return the tickets of the queryset the user can access, with an error
+    message for each of the others.
+
+    :param request: The request of the user
+    :param tickets: A QuerySet of Tickets
+    :return: The QuerySet, limited to the queues the user can access
+    """
+    if not Queue.objects.limited_for_user(request.user):
+        return tickets
+    queue_filter = Queue.objects.user_filter(request.user)
+    for ticket in tickets.exclude(queue_filter):
+        error_message('No access to ticket [{}]'.format(ticket), request)
+    return tickets.filter(queue_filter)
+
+
 class TicketsBulkDeleteView(StaffLoginRequiredMixin, BulkableActionMixin, View):
     model = Ticket
 
     # noinspection PyUnusedLocal
     @transaction.atomic
     def post(self, request, *args, **kwargs):
-        tickets = self.get_queryset()
-        deleted_tickets = 0
-        for ticket in tickets:
-            if not _has_access_to_queue(request.user, ticket.queue):
-                error_message('No access to ticket [{}]'.format(ticket), request)
-                continue
-            ticket.delete()
-            deleted_tickets += 1
+        tickets = _accessible_tickets(request, self.get_queryset())
+        deleted, deleted_per_model = tickets.delete()
+        deleted_tickets = deleted_per_model.get(Ticket._meta.label, 0)
 
         if deleted_tickets == 0:
             warning_message('No ticket deleted!', request)
@@ -275,27 +281,14 @@ class TicketsBulkAssignView(StaffLoginRequiredMixin, BulkableActionMixin, View):
             return redirect(self.get_success_url())
         user = form.cleaned_data['assigned_to']
 
-        assigned_tickets = 0
         if user:
             title = _('Assigned to [{}] in bulk update'.format(user.get_username()))
+            tickets = tickets.exclude(assigned_to=user)
         else:
             title = _('Unassigned in bulk update')
-        for ticket in tickets:
-            if not _has_access_to_queue(request.user, ticket.queue):
-                error_message('No access to ticket [{}]'.format(ticket), request)
-                continue
-            if ticket.assigned_to == user:
-                continue
-
-            ticket.assigned_to = user
-            ticket.save()
-            f = FollowUp(ticket=ticket,
-                         date=timezone.now(),
-                         title=title,
-                         public=True,
-                         user=request.user)
-            f.save()
-            assigned_tickets += 1
+            tickets = tickets.filter(assigned_to__isnull=False)
+        tickets = _accessible_tickets(request, tickets)
+        assigned_tickets = len(bulk_update_tickets(tickets, request.user, title, assigned_to=user))
 
         if assigned_tickets == 0:
             warning_message('No ticket {}!'.format('assigned' if user else 'unassigned'), request)
@@ -311,100 +304,25 @@ class TicketsBulkAssignView(StaffLoginRequiredMixin, BulkableActionMixin, View):
 class TicketsBulkCloseView(StaffLoginRequiredMixin, BulkableActionMixin, View):
     model = Ticket
 
-    def _close_ticket(self, request, ticket, send_mail=False):
-        if ticket.status == Ticket.CLOSED_STATUS:
-            return False
-        now = timezone.now()
-        if not send_mail:
-            ticket.status = Ticket.CLOSED_STATUS
-            ticket.modified_status = now
-            ticket.save()
-            f = FollowUp(ticket=ticket,
-                         date=now,
-                         title=_('Closed in bulk update'),
-                         public=False,
-                         user=request.user,
-                         new_status=Ticket.CLOSED_STATUS)
-            f.save()
-        else:
-            ticket.status = Ticket.CLOSED_STATUS
-            ticket.modified_status = now
-            ticket.save()
-            f = FollowUp(ticket=ticket,
-                         date=now,
-                         title=_('Closed in bulk update'),
-                         public=True,
-                         user=request.user,
-                         new_status=Ticket.CLOSED_STATUS)
-            f.save()
-            # Send email to Submitter, Owner, Queue CC
-            context = safe_template_context(ticket)
-            context.update(resolution=ticket.resolution)
-
-            messages_sent_to = []
-
-            if ticket.submitter_email:
-                send_templated_mail(
-                    'closed_submitter',
-                    context,
-                    recipients=ticket.submitter_email,
-                    sender=ticket.queue.from_address,
-                    fail_silently=True,
-                )
-                messages_sent_to.append(ticket.submitter_email)
-
-            for cc in ticket.ticketcc_set.all():
-                if cc.email_address not in messages_sent_to:
-                    send_templated_mail(
-                        'closed_submitter',
-                        context,
-                        recipients=cc.email_address,
-                        sender=ticket.queue.from_address,
-                        fail_silently=True,
-                    )
-                    messages_sent_to.append(cc.email_address)
-
-            if ticket.assigned_to and \
-                    request.user != ticket.assigned_to and \
-                    ticket.assigned_to.email and \
-                    ticket.assigned_to.email not in messages_sent_to:
-                send_templated_mail(
-                    'closed_owner',
-                    context,
-                    recipients=ticket.assigned_to.email,
-                    sender=ticket.queue.from_address,
-                    fail_silently=True,
-                )
-                messages_sent_to.append(ticket.assigned_to.email)
-
-            if ticket.queue.updated_ticket_cc and \
-                            ticket.queue.updated_ticket_cc not in messages_sent_to:
-                send_templated_mail(
-                    'closed_cc',
-                    context,
-                    recipients=ticket.queue.updated_ticket_cc,
-                    sender=ticket.queue.from_address,
-                    fail_silently=True,
-                )
-        return True
     # noinspection PyUnusedLocal
     @transaction.atomic
     def post(self, request, *args, **kwargs):
-        tickets = self.get_queryset()
-        closed_tickets = 0
         send_mail = to_bool(request.POST.get('send_mail'))
-        for ticket in tickets:
-            if not _has_access_to_queue(request.user, ticket.queue):
-                error_message('No access to ticket [{}]'.format(ticket), request)
-                continue
-            closed = self._close_ticket(request, ticket, send_mail=send_mail)
-            if closed:
-                closed_tickets += 1
-
-        if closed_tickets == 0:
+        tickets = _accessible_tickets(request, self.get_queryset().exclude(status=Ticket.CLOSED_STATUS))
+        if send_mail:
+            tickets = tickets.prefetch_related('ticketcc_set__user')
+        closed = bulk_update_tickets(tickets, request.user, _('Closed in bulk update'),
+                                     public=send_mail, new_status=Ticket.CLOSED_STATUS)
+        if send_mail:
+            # Send email to Submitter, Owner, Queue CC
+            with MailBatch(fail_silently=True) as mails:
+                for ticket in closed:
+                    queue_closed_mail(mails, ticket, request.user)
+
+        if not closed:
             warning_message('No ticket closed!', request)
         else:
-            success_message('[{}] Tickets bulk closed!'.format(closed_tickets), request)
+            success_message('[{}] Tickets bulk closed!'.format(len(closed)), request)
         return redirect(self.get_success_url())
 
     # noinspection PyMethodMayBeStatic
@@ -412,6 +330,51 @@ class TicketsBulkCloseView(StaffLoginRequiredMixin, BulkableActionMixin, View):
         return self.request.META.get('HTTP_REFERER') or reverse('helpdesk:ticket-list')
 
 
+class BulkActionJobAddView(StaffLoginRequiredMixin, View):
+    """
+    Queue a bulk action on all the tickets matching a ticket list query or a
+    saved query, for the process_bulk_jobs command to run in the
+    background. Ajax requests get the job as JSON, with the URL of its
+    progress.
+    """
+
+    # noinspection PyUnusedLocal
+    def post(self, request, *args, **kwargs):
+        form = BulkActionJobForm(request.POST, user=request.user)
+        if not form.is_valid():
+            if request.is_ajax():
+                return JsonResponse({'errors': form.errors}, status=400)
+            send_form_errors(form, request)
+            return redirect(self.get_success_url())
+        job = form.save()
+
+        if request.is_ajax():
+            data = job.as_dict()
+            data['progress_url'] = reverse('helpdesk:tickets-bulk-job', kwargs={'pk': job.pk})
+            return JsonResponse(data, status=202)
+        success_message('Bulk action [{}] queued!'.format(job.get_action_display()), request)
+        return redirect(self.get_success_url())
+
+    # noinspection PyMethodMayBeStatic
+    def get_success_url(self):
+        return self.request.META.get('HTTP_REFERER') or reverse('helpdesk:ticket-list')
+
+
+class BulkActionJobProgressView(StaffLoginRequiredMixin, SingleObjectMixin, View):
+    """The status and progress of one of the user's bulk action jobs."""
+    model = BulkActionJob
+    pk_url_kwarg = 'pk'
+
+    def get_queryset(self):
+        if self.request.user.is_superuser:
+            return BulkActionJob.objects.all()
+        return BulkActionJob.objects.filter(user=self.request.user)
+
+    # noinspection PyUnusedLocal
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(self.get_object().as_dict())
+
+
 class SavedSearchListView(StaffLoginRequiredMixin, View):
 
     def get(self, request, *args, **kwargs):
@@ -498,3 +461,37 @@ class SavedSearchSwitchSharedView(StaffLoginRequiredMixin, SingleObjectMixin, Vi
         return self.request.META.get('HTTP_REFERER') or reverse('helpdesk:saved_search-list')
 
 
+class EmailIngestionMetricsView(StaffLoginRequiredMixin, View):
+    """
+    Totals of the e-mail ingestion runs recorded by get_email, per queue the
+    user can access. Pass ?days=N to only count the runs of the last N days.
+    """
+    SUMMED_FIELDS = ('messages', 'bytes_received', 'tickets_created', 'followups_created', 'ignored', 'failed',
+                     'network_seconds', 'parse_seconds', 'db_seconds')
+
+    def get(self, request, *args, **kwargs):
+        runs = EmailIngestionRun.objects.filter(queue__in=_get_user_queues(request.user))
+        days = request.GET.get('days')
+        if days:
+            try:
+                days = int(days)
+                if days < 0:
+                    raise ValueError(days)
+                runs = runs.filter(started__gte=timezone.now() - timedelta(days=days))
+            except (ValueError, OverflowError):
+                return HttpResponseBadRequest('Invalid days value')
+
+        aggregates = dict((field, Sum(field)) for field in self.SUMMED_FIELDS)
+        totals = runs.order_by().values('queue__slug').annotate(
+            runs=Count('id'),
+            last_run=Max('started'),
+            aborted_runs=Sum(Case(When(error='', then=Value(0)), default=Value(1), output_field=IntegerField())),
+            **aggregates
+        ).order_by('queue__slug')
+
+        queues = []
+        for row in totals:
+            row['queue'] = row.pop('queue__slug')
+            row['last_run'] = row['last_run'].isoformat()
+            queues.append(row)
+        return JsonResponse({'queues': queues})
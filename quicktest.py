@@ -1,6 +1,8 @@
 import os
 import sys
 import argparse
+import shutil
+import tempfile
 
 import django
 from django.conf import settings
@@ -66,6 +68,8 @@ class QuickDjangoTest(object):
 
     def _tests(self):
 
+        # attachments saved by the tests are written here, not into the tree
+        media_root = tempfile.mkdtemp()
         settings.configure(
             DEBUG=True,
             DATABASES={
@@ -81,6 +85,7 @@ class QuickDjangoTest(object):
             INSTALLED_APPS=self.INSTALLED_APPS + self.apps,
             MIDDLEWARE_CLASSES=self.MIDDLEWARE_CLASSES,
             ROOT_URLCONF='helpdesk.tests.urls',
+            MEDIA_ROOT=media_root,
             STATIC_URL='/static/',
             TEMPLATES=self.TEMPLATES
         )
@@ -89,7 +94,10 @@ class QuickDjangoTest(object):
         test_runner = DiscoverRunner(verbosity=1)
         django.setup()
 
-        failures = test_runner.run_tests(self.apps)
+        try:
+            failures = test_runner.run_tests(self.apps)
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
         if failures:
             sys.exit(failures)
 